@@ -0,0 +1,255 @@
+"""Benchmarks of the hot paths of cdh.files, run by the bench_files command.
+
+Every benchmark is a function which gets a BenchmarkContext, sets up what
+it needs and returns the callable to measure. It's called anew for every
+repetition, so the measured callable never sees state left behind by the
+previous one. For every benchmark the median wall time, the peak memory
+allocated by Python and the number of executed queries are recorded.
+"""
+import functools
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from django.core.files import File
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import SingleFile, TrackedFile
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'bench_baseline.json')
+
+# Fixed, so results can be compared with the baseline
+SIZES = {
+    '1KiB': 2 ** 10,
+    '1MiB': 2 ** 20,
+    '32MiB': 32 * 2 ** 20,
+}
+
+# Time differences smaller than this (in seconds) are noise
+MIN_TIME_DIFFERENCE = 0.0005
+# Memory differences smaller than this (in bytes) are noise
+MIN_MEMORY_DIFFERENCE = 64 * 2 ** 10
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+class BenchmarkContext:
+    """Source files and helpers shared by the benchmarks"""
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp()
+        self.client = Client()
+        self._sources = {}
+        self._opened = []
+
+    def source(self, size: int) -> str:
+        """Returns the path of a file of the given size, with contents that
+        don't compress"""
+        if size not in self._sources:
+            path = os.path.join(self.directory, f'{size}.bin')
+            with open(path, 'wb') as file:
+                file.write(os.urandom(size))
+            self._sources[size] = path
+        return self._sources[size]
+
+    def file(self, size: int = SIZES['1KiB']) -> File:
+        file = open(self.source(size), mode='rb')
+        self._opened.append(file)
+        return File(file, name='benchmark.bin')
+
+    def single(self, size: int = SIZES['1KiB']) -> SingleFile:
+        obj = SingleFile()
+        obj.required_file = self.file(size)
+        obj.nullable_file = self.file()
+        obj.save()
+        return SingleFile.objects.get(pk=obj.pk)
+
+    def tracked(self, num_files: int) -> TrackedFile:
+        obj = TrackedFile.objects.create()
+        for _ in range(num_files):
+            obj.files.add(self.file())
+        return TrackedFile.objects.get(pk=obj.pk)
+
+    def download(self, url):
+        response = self.client.get(url)
+        # Consumed chunk by chunk, as a WSGI server would
+        for _ in response.streaming_content:
+            pass
+        response.close()
+        return response
+
+    def cleanup(self) -> None:
+        """Closes the files opened by the last benchmark"""
+        for file in self._opened:
+            file.close()
+        self._opened = []
+
+    def close(self) -> None:
+        self.cleanup()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _save(context, size):
+    obj = SingleFile()
+    obj.required_file = context.file(size)
+    return obj.save
+
+
+def _download(context, size):
+    obj = context.single(size)
+    url = reverse('dev_files:file_view', args=[obj.required_file.uuid])
+    return lambda: context.download(url)
+
+
+BENCHMARKS.update({
+    f'save-{label}': functools.partial(_save, size=size)
+    for label, size in SIZES.items()
+})
+BENCHMARKS.update({
+    f'download-{label}': functools.partial(_download, size=size)
+    for label, size in SIZES.items()
+})
+
+
+@benchmark('download-field-limited')
+def _download_field_limited(context):
+    obj = context.single()
+    url = reverse(
+        'dev_files:field_limited_file_view',
+        args=[obj.required_file.uuid]
+    )
+    return lambda: context.download(url)
+
+
+@benchmark('descriptor-get')
+def _descriptor_get(context):
+    obj = context.single()
+    return lambda: (obj.required_file.name, obj.nullable_file.name)
+
+
+@benchmark('descriptor-set')
+def _descriptor_set(context):
+    obj = context.single()
+    file = context.file()
+
+    def run():
+        obj.required_file = file
+    return run
+
+
+@benchmark('descriptor-replace')
+def _descriptor_replace(context):
+    obj = context.single()
+    file = context.file()
+
+    def run():
+        obj.required_file = file
+        obj.save()
+    return run
+
+
+@benchmark('tracked-add')
+def _tracked_add(context):
+    obj = context.tracked(5)
+    file = context.file()
+    return lambda: obj.files.add(file)
+
+
+@benchmark('tracked-current-file')
+def _tracked_current_file(context):
+    obj = context.tracked(10)
+    return lambda: obj.files.current_file.name
+
+
+@benchmark('tracked-all')
+def _tracked_all(context):
+    obj = context.tracked(10)
+    return lambda: [file_wrapper.name for file_wrapper in obj.files.all]
+
+
+@benchmark('delete-single')
+def _delete_single(context):
+    return context.single().delete
+
+
+@benchmark('delete-tracked')
+def _delete_tracked(context):
+    return context.tracked(5).delete
+
+
+def run_benchmark(name: str, context: BenchmarkContext, repeat: int) -> dict:
+    """Runs a benchmark and returns its median time (in seconds), peak
+    memory (in bytes) and number of queries"""
+    func = BENCHMARKS[name]
+
+    timings = []
+    for _ in range(repeat):
+        measured = func(context)
+        started = time.perf_counter()
+        measured()
+        timings.append(time.perf_counter() - started)
+        context.cleanup()
+
+    # Tracing memory slows everything down, so it gets its own run
+    measured = func(context)
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            measured()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        context.cleanup()
+
+    return {
+        'time': statistics.median(timings),
+        'peak_memory': peak_memory,
+        'queries': len(queries),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Returns a message for every result worse than the baseline. Any extra
+    query is a regression; time and memory may be a fraction (tolerance)
+    worse. Measurements missing from the baseline are not compared, so a
+    baseline can hold just the (machine independent) query counts."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+
+        if 'queries' in base and result['queries'] > base['queries']:
+            regressions.append(
+                f"{name}: {result['queries']} queries, was {base['queries']}"
+            )
+        if 'time' in base and \
+                result['time'] > base['time'] * (1 + tolerance) and \
+                result['time'] - base['time'] > MIN_TIME_DIFFERENCE:
+            regressions.append(
+                f"{name}: {result['time'] * 1000:.2f} ms, was "
+                f"{base['time'] * 1000:.2f} ms"
+            )
+        if 'peak_memory' in base and \
+                result['peak_memory'] > base['peak_memory'] * (1 + tolerance) and \
+                result['peak_memory'] - base['peak_memory'] > \
+                MIN_MEMORY_DIFFERENCE:
+            regressions.append(
+                f"{name}: peak memory {result['peak_memory'] // 1024} KiB, "
+                f"was {base['peak_memory'] // 1024} KiB"
+            )
+
+    return regressions
@@ -0,0 +1,93 @@
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from django.db.models.signals import ModelSignal, post_save
+
+from cdh.files.db import fields
+from cdh.files.db.dispatch import mark_files_changed
+
+
+def _create_model(num_fields):
+    """Creates an unmanaged model with the given number of FileFields. It
+    never touches the database, we only send its signals."""
+    attrs = {
+        '__module__': __name__,
+        'Meta': type('Meta', (), {
+            'app_label': 'dev_files',
+            'managed': False,
+        }),
+    }
+    for i in range(num_fields):
+        attrs[f'file_{i}'] = fields.FileField(null=True, blank=True)
+    return type(f'SignalBenchmark{num_fields}', (models.Model,), attrs)
+
+
+class Command(BaseCommand):
+    help = "Measures the overhead the file fields of a model add to every " \
+           "save, for models with 0 to 10 FileFields. Compares the " \
+           "per-model dispatcher with connecting a post_save receiver per " \
+           "field, as cdh.files used to do. Only the signal handling is " \
+           "measured, not the query."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-fields',
+            type=int,
+            default=10,
+            help="Largest number of FileFields to measure",
+        )
+        parser.add_argument(
+            '--number',
+            type=int,
+            default=20000,
+            help="Number of saves to time per model",
+        )
+
+    def handle(self, *args, **options):
+        if options['max_fields'] < 0 or options['number'] < 1:
+            raise CommandError("Invalid --max-fields or --number")
+
+        number = options['number']
+        self.stdout.write(
+            f"{'fields':>6} {'per field':>12} {'dispatcher':>12} "
+            f"{'changed':>12}  (µs per save)"
+        )
+        for num_fields in range(options['max_fields'] + 1):
+            model = _create_model(num_fields)
+            instance = model()
+            send_kwargs = {
+                'sender': model,
+                'instance': instance,
+                'created': False,
+                'update_fields': None,
+                'raw': False,
+                'using': 'default',
+            }
+
+            # What every field connecting its own receiver costs
+            per_field_signal = ModelSignal(use_caching=True)
+            for field in model._meta.get_fields():
+                if isinstance(field, fields.FileField):
+                    per_field_signal.connect(field.post_save, sender=model)
+
+            per_field = timeit.timeit(
+                lambda: per_field_signal.send(**send_kwargs),
+                number=number,
+            )
+            dispatcher = timeit.timeit(
+                lambda: post_save.send(**send_kwargs),
+                number=number,
+            )
+
+            # Saves after assigning a file still visit every field
+            def send_changed():
+                mark_files_changed(instance)
+                post_save.send(**send_kwargs)
+            changed = timeit.timeit(send_changed, number=number)
+
+            self.stdout.write(
+                f"{num_fields:>6} {per_field / number * 1e6:>12.2f} "
+                f"{dispatcher / number * 1e6:>12.2f} "
+                f"{changed / number * 1e6:>12.2f}"
+            )
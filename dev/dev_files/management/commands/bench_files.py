@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+
+from cdh.files import settings
+from cdh.files.utils import storages
+from dev_files.benchmarks import BASELINE_PATH, BENCHMARKS, \
+    BenchmarkContext, compare, run_benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmarks saving, retrieving, deleting and downloading files. " \
+           "Records the median time, the peak memory and the number of " \
+           "queries of every benchmark, and compares them with the stored " \
+           "baseline. Exits with an error if any of them got worse. Runs " \
+           "on a throwaway test database and file root."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names',
+            nargs='*',
+            help="Only run the benchmarks whose name starts with one of "
+                 "these. Available: " + ', '.join(BENCHMARKS),
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help="Number of timed runs per benchmark",
+        )
+        parser.add_argument(
+            '--baseline',
+            default=BASELINE_PATH,
+            help="The JSON file holding the baseline",
+        )
+        parser.add_argument(
+            '--save-baseline',
+            action='store_true',
+            help="Store the results as the new baseline instead of "
+                 "comparing them",
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.25,
+            help="Fraction by which time and memory may be worse than the "
+                 "baseline. Any extra query is a regression",
+        )
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat should be at least 1")
+        names = [
+            name for name in BENCHMARKS
+            if not options['names'] or
+            any(name.startswith(prefix) for prefix in options['names'])
+        ]
+        if not names:
+            raise CommandError("No benchmarks match the given names")
+
+        baseline = {}
+        if os.path.exists(options['baseline']):
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+
+        results = self._run(names, options['repeat'])
+        self._report(results, baseline)
+
+        if options['save_baseline']:
+            # Benchmarks we didn't run keep their old values
+            baseline.update(results)
+            with open(options['baseline'], 'w') as file:
+                json.dump(baseline, file, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(
+                f"Saved the baseline to {options['baseline']}"
+            ))
+            return
+
+        if not baseline:
+            self.stdout.write(
+                "No baseline to compare with; store one with --save-baseline"
+            )
+            return
+
+        regressions = compare(results, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError(
+                "Worse than the baseline:\n" + "\n".join(regressions)
+            )
+        self.stdout.write(self.style.SUCCESS("No regressions"))
+
+    def _run(self, names, repeat) -> dict:
+        old_database = connection.settings_dict['NAME']
+        old_file_root = settings.FILE_ROOT
+        settings.FILE_ROOT = tempfile.mkdtemp()
+        # Storages cache their location
+        storages.clear()
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        context = BenchmarkContext()
+        try:
+            results = {}
+            for name in names:
+                self.stdout.write(f"Running {name}...")
+                results[name] = run_benchmark(name, context, repeat)
+            return results
+        finally:
+            context.close()
+            connection.creation.destroy_test_db(old_database, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(settings.FILE_ROOT, ignore_errors=True)
+            settings.FILE_ROOT = old_file_root
+            storages.clear()
+
+    def _report(self, results, baseline) -> None:
+        self.stdout.write(
+            f"{'benchmark':<24} {'time (ms)':>10} {'Δ':>7} "
+            f"{'peak (KiB)':>11} {'Δ':>7} {'queries':>8} {'Δ':>4}"
+        )
+        for name, result in results.items():
+            base = baseline.get(name)
+            time_delta = memory_delta = query_delta = ''
+            if base:
+                time_delta = _percentage(result['time'], base.get('time'))
+                memory_delta = _percentage(
+                    result['peak_memory'],
+                    base.get('peak_memory')
+                )
+                if 'queries' in base:
+                    query_delta = f"{result['queries'] - base['queries']:+d}"
+            self.stdout.write(
+                f"{name:<24} {result['time'] * 1000:>10.2f} {time_delta:>7} "
+                f"{result['peak_memory'] / 1024:>11.1f} {memory_delta:>7} "
+                f"{result['queries']:>8} {query_delta:>4}"
+            )
+
+
+def _percentage(value, base) -> str:
+    if not base:
+        return ''
+    return f"{(value - base) / base * 100:+.0f}%"
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_blob_file_blob'),
+        ('dev_files', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customfile',
+            name='blob',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='files.blob'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dev_files', '0002_customfile_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customfile',
+            name='checksum',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='customfile',
+            name='size',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='customfile',
+            name='stored_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dev_files', '0003_customfile_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customfile',
+            name='encoding',
+            field=models.CharField(blank=True, editable=False, max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dev_files', '0005_customfile_tier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customfile',
+            name='verified_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
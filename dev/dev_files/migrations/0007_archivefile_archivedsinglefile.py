@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import cdh.files.db.fields
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0010_file_verified_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dev_files', '0006_customfile_verified_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True, verbose_name='Universally Unique IDentifier')),
+                ('original_filename', models.CharField(max_length=255)),
+                ('content_type', models.CharField(max_length=100)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('modified_on', models.DateTimeField(auto_now=True)),
+                ('size', models.BigIntegerField(blank=True, editable=False, null=True)),
+                ('checksum', models.CharField(blank=True, editable=False, max_length=64)),
+                ('stored_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('encoding', models.CharField(blank=True, editable=False, max_length=20)),
+                ('tier', models.CharField(default='hot', editable=False, max_length=10)),
+                ('verified_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('blob', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='files.blob')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedSingleFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', cdh.files.db.fields.FileField(filename_generator=cdh.files.db.fields._default_filename_generator, on_delete=django.db.models.deletion.CASCADE, to='dev_files.archivefile')),
+            ],
+        ),
+    ]
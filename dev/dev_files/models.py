@@ -1,11 +1,13 @@
 from django.db import models
 
-from cdh.files.db import fields, BaseFile
+from cdh.files.db import fields, BaseFile, WithFilesManager
 
 
 # Create your models here.
 class SingleFile(models.Model):
 
+    objects = WithFilesManager()
+
     nullable_file = fields.FileField(
         null=True,
         blank=True,
@@ -23,6 +25,8 @@ class CustomFile(BaseFile):
 
 class CustomSingleFile(models.Model):
 
+    objects = WithFilesManager()
+
     nullable_file = fields.FileField(
         to=CustomFile,
         null=True,
@@ -38,6 +42,8 @@ class CustomSingleFile(models.Model):
 
 class TrackedFile(models.Model):
 
+    objects = WithFilesManager()
+
     files = fields.TrackedFileField(
         url_pattern='dev_files:field_limited_tracked_file_view',
     )
@@ -45,7 +51,23 @@ class TrackedFile(models.Model):
 
 class TrackedCustomFile(models.Model):
 
+    objects = WithFilesManager()
+
     files = fields.TrackedFileField(
         to=CustomFile,
         url_pattern='dev_files:custom_file_view',
     )
+
+
+class ArchiveFile(BaseFile):
+    pass
+
+
+class ArchivedSingleFile(models.Model):
+
+    objects = WithFilesManager()
+
+    file = fields.FileField(
+        to=ArchiveFile,
+        storage='archive',
+    )
@@ -0,0 +1,15 @@
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import cached_property
+
+from cdh.files import settings
+from cdh.files.storage import CDHFileStorage
+
+
+@deconstructible
+class ArchiveStorage(CDHFileStorage):
+    """Second storage, used by ArchivedSingleFile to show per-field storage
+    routing"""
+
+    @cached_property
+    def base_location(self):
+        return f"{settings.FILE_ROOT}_archive"
@@ -1,12 +1,55 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import uuid
+import zipfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files import File
-from django.test import TestCase
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.forms import BaseModelFormSet, modelform_factory, \
+    modelformset_factory
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, \
+    override_settings
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.http import http_date
 
 from cdh.files import settings
+from cdh.files.archives import is_compressed, stream_zip
+from cdh.files.db import Blob, UnlinkedFile, UploadSession, fields
+from cdh.files.db.dispatch import get_dispatcher
 from cdh.files.db.fields import _default_filename_generator
-from cdh.files.utils import get_storage
-
-from .models import CustomSingleFile, SingleFile, TrackedCustomFile, TrackedFile
+from cdh.files.deletion import wait_for_deletions
+from cdh.files.encryption import DecryptionError, EncryptedFileStorage
+from cdh.files.forms import FileResolverFormMixin, \
+    FileResolverFormSetMixin, SimpleFileInput
+from cdh.files.ingest import ingest, read_manifest
+from cdh.files.management.commands.files_gc import \
+    Command as GarbageCollectionCommand
+from cdh.files.storage import CDHFileStorage, CompressedFileStorage, \
+    ContentAddressedFileStorage, TieredFileStorage
+from cdh.files.utils import get_storage, storages
+from cdh.files.views import AsyncUploadSessionCreateView, \
+    AsyncUploadSessionView
+
+from .benchmarks import BASELINE_PATH, BENCHMARKS, BenchmarkContext, \
+    compare, run_benchmark
+from .forms import SingleFileForm
+from .models import ArchiveFile, ArchivedSingleFile, CustomSingleFile, \
+    SingleFile, TrackedCustomFile, TrackedFile
 
 
 class FakeStorage:
@@ -39,6 +82,91 @@ class FakeStorage:
         return repr(self._storage)
 
 
+class TemporaryLocationMixin:
+    """Roots a filesystem storage in a temporary directory"""
+
+    root = None
+
+    @cached_property
+    def base_location(self):
+        return TemporaryLocationMixin.root
+
+
+class TemporaryStorage(TemporaryLocationMixin, CDHFileStorage):
+    pass
+
+
+class TemporaryContentAddressedStorage(
+    TemporaryLocationMixin,
+    ContentAddressedFileStorage
+):
+    pass
+
+
+class TemporaryCompressedStorage(TemporaryLocationMixin, CompressedFileStorage):
+    pass
+
+
+class TemporaryEncryptedStorage(TemporaryLocationMixin, EncryptedFileStorage):
+    # Small chunks, so even small files span several of them
+    encryption_chunk_size = 256
+
+
+class TemporaryTieredStorage(TemporaryLocationMixin, TieredFileStorage):
+
+    @cached_property
+    def cold_location(self):
+        return TemporaryLocationMixin.root + '-cold'
+
+
+class TemporaryArchiveStorage(TemporaryLocationMixin, CDHFileStorage):
+
+    @cached_property
+    def base_location(self):
+        return TemporaryLocationMixin.root + '-archive'
+
+
+class TemporaryTieredArchiveStorage(TemporaryLocationMixin, TieredFileStorage):
+
+    @cached_property
+    def base_location(self):
+        return TemporaryLocationMixin.root + '-archive'
+
+    @cached_property
+    def cold_location(self):
+        return TemporaryLocationMixin.root + '-archive-cold'
+
+
+class TemporaryStorageMixin:
+    """Mixin for tests that need a storage that behaves like the real thing"""
+    storage = 'dev_files.tests.TemporaryStorage'
+
+    def setUp(self) -> None:
+        super().setUp()
+        TemporaryLocationMixin.root = tempfile.mkdtemp()
+        self._old_storage = settings.STORAGE
+        settings.STORAGE = self.storage
+        # Storages cache their location
+        storages.clear()
+
+    def tearDown(self):
+        settings.STORAGE = self._old_storage
+        storages.clear()
+        shutil.rmtree(TemporaryLocationMixin.root, ignore_errors=True)
+        super().tearDown()
+
+    def files_on_disk(self):
+        return sorted(
+            os.path.relpath(os.path.join(directory, file), self.root)
+            for directory, _, files in os.walk(self.root)
+            for file in files
+        )
+
+    @property
+    def root(self):
+        return TemporaryLocationMixin.root
+
+
 class FileTests(TestCase):
     single_cls = SingleFile
     tracked_cls = TrackedFile
@@ -48,6 +176,9 @@ class FileTests(TestCase):
 
     def setUp(self) -> None:
         settings.STORAGE = 'dev_files.tests.FakeStorage'
+        # TestCase never commits, so deferred deletions would never happen.
+        # See DeferredDeletionTests for those
+        settings.DEFER_DELETION = False
         self.url_pattern_single = self.single_cls._meta.get_field(
             'required_file'
         ).url_pattern
@@ -56,6 +187,7 @@ class FileTests(TestCase):
         ).url_pattern
 
     def tearDown(self):
+        settings.DEFER_DELETION = True
         get_storage().clear()
 
     def test_fake_storage(self):
@@ -705,6 +837,147 @@ class FileTests(TestCase):
 
         obj.delete()
 
+    def test_reference_counts(self):
+        obj_1 = self.single_cls()
+        obj_1.required_file = File(open(self.file_cat, mode='rb'))
+        obj_1.save()
+        obj_2 = self.single_cls()
+        obj_2.required_file = obj_1.required_file.file_instance
+        obj_2.save()
+        tracked = self.tracked_cls()
+        tracked.save()
+        tracked.files.current_file = obj_1.required_file.file_instance
+
+        file_instance = obj_1.required_file.file_instance
+        tracked_field = self.tracked_cls._meta.get_field('files')
+        through_field = tracked_field.remote_field.through._meta.get_field(
+            tracked_field.m2m_reverse_field_name()
+        )
+
+        with self.assertNumQueries(1):
+            counts = file_instance._get_reference_counts()
+        self.assertEqual(
+            {
+                self.single_cls._meta.get_field('required_file'): 2,
+                through_field: 1,
+            },
+            {field: count for field, count in counts.items() if count}
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(3, file_instance._num_child_instances)
+        with self.assertNumQueries(1):
+            self.assertEqual(2, len(file_instance._child_fields))
+
+        obj_1.delete()
+        obj_2.delete()
+        tracked.delete()
+
+    def test_tracked_current_is_per_owner(self):
+        obj_1 = self.tracked_cls()
+        obj_1.save()
+        obj_1.files.add(File(open(self.file_cat, mode='rb')))
+        obj_2 = self.tracked_cls()
+        obj_2.save()
+        obj_2.files.add(File(open(self.file_dog, mode='rb')))
+        obj_2.files.add(File(open(self.file_cat, mode='rb')))
+        obj_2_dog = list(obj_2.files.all)[1]
+
+        obj_2.files.set_as_current(obj_2_dog)
+
+        # Use fresh instances, so nothing is cached
+        obj_1 = self.tracked_cls.objects.get(pk=obj_1.pk)
+        obj_2 = self.tracked_cls.objects.get(pk=obj_2.pk)
+        self.assertEqual(self.file_cat, obj_1.files.current_file.name)
+        self.assertEqual(self.file_dog, obj_2.files.current_file.name)
+        self.assertEqual(
+            1,
+            self.tracked_cls.files.through.objects.filter(
+                current=True,
+                **{self.tracked_cls.files.field.m2m_field_name(): obj_2}
+            ).count()
+        )
+
+        # Files of other owners can't be made current
+        with self.assertRaises(ValueError):
+            obj_1.files.set_as_current(obj_2_dog)
+        self.assertEqual(self.file_cat, obj_1.files.current_file.name)
+
+        obj_1.delete()
+        obj_2.delete()
+
+    def test_tracked_current_without_partial_indexes(self):
+        obj = self.tracked_cls()
+        obj.save()
+        obj.files.add(File(open(self.file_cat, mode='rb')))
+        obj.files.add(File(open(self.file_dog, mode='rb')))
+        obj_cat = list(obj.files.all)[1]
+
+        with self.assertNumQueries(4):
+            obj.files.set_as_current(obj_cat)
+        # Without the unique constraint, the links of the owner are locked
+        # first
+        with mock.patch.object(
+                connection.features,
+                'supports_partial_indexes',
+                False
+        ):
+            with self.assertNumQueries(5):
+                obj.files.set_as_current(obj_cat)
+
+        self.assertEqual(
+            1,
+            self.tracked_cls.files.through.objects.filter(
+                current=True,
+                **{self.tracked_cls.files.field.m2m_field_name(): obj}
+            ).count()
+        )
+
+        obj.delete()
+
+    def test_tracked_current_retries_conflicts(self):
+        from django.db import IntegrityError
+        from cdh.files.db.wrappers import TrackedFileWrapper
+
+        obj = self.tracked_cls()
+        obj.save()
+        obj.files.add(File(open(self.file_cat, mode='rb')))
+        obj.files.add(File(open(self.file_dog, mode='rb')))
+        obj_cat = list(obj.files.all)[1]
+
+        # The first attempt loses against a concurrent change
+        replace_current = TrackedFileWrapper._replace_current
+        attempts = []
+
+        def _conflicting(wrapper, *args):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise IntegrityError('UNIQUE constraint failed')
+            return replace_current(wrapper, *args)
+
+        with mock.patch.object(
+                TrackedFileWrapper,
+                '_replace_current',
+                _conflicting
+        ):
+            obj.files.set_as_current(obj_cat)
+        self.assertEqual(2, len(attempts))
+        self.assertEqual(obj_cat, obj.files.current_file)
+
+        # Conflicts that keep happening are not hidden
+        with mock.patch.object(
+                TrackedFileWrapper,
+                '_replace_current',
+                side_effect=IntegrityError('UNIQUE constraint failed')
+        ) as replace:
+            with self.assertRaises(IntegrityError):
+                obj.files.set_as_current(obj_cat)
+        self.assertEqual(
+            TrackedFileWrapper.SET_CURRENT_ATTEMPTS,
+            replace.call_count
+        )
+
+        obj.delete()
+
     def test_filename_generator(self):
         static_name = "I love cats"
         def _static_generator(file_wrapper):
@@ -782,3 +1055,2488 @@ class FileTests(TestCase):
 class CustomFileTests(FileTests):
     single_cls = CustomSingleFile
     tracked_cls = TrackedCustomFile
+
+
+class DownloadViewTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.obj = SingleFile()
+        self.obj.required_file = File(open(self.file_cat, mode='rb'))
+        self.obj.save()
+        self.url = reverse(
+            'dev_files:file_view',
+            args=[self.obj.required_file.uuid]
+        )
+        with open(self.file_cat, mode='rb') as f:
+            self.content = f.read()
+
+    def test_full_download(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertEqual(self.content, b''.join(response.streaming_content))
+        self.assertEqual(str(len(self.content)), response['Content-Length'])
+        self.assertEqual('bytes', response['Accept-Ranges'])
+        self.assertIn('ETag', response)
+        self.assertIn('inline', response['Content-Disposition'])
+
+    def test_head_does_not_open_file(self):
+        with mock.patch.object(TemporaryStorage, 'open') as mock_open:
+            response = self.client.head(self.url)
+            mock_open.assert_not_called()
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(str(len(self.content)), response['Content-Length'])
+
+    def test_single_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(self.content[10:20],
+                         b''.join(response.streaming_content))
+        self.assertEqual(
+            f"bytes 10-19/{len(self.content)}",
+            response['Content-Range']
+        )
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(self.content[-5:],
+                         b''.join(response.streaming_content))
+
+    def test_multiple_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-4,100-104')
+
+        self.assertEqual(206, response.status_code)
+        self.assertTrue(
+            response['Content-Type'].startswith('multipart/byteranges')
+        )
+        body = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(self.content[0:5], body)
+        self.assertIn(self.content[100:105], body)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(
+            self.url,
+            HTTP_RANGE=f'bytes={len(self.content) + 10}-'
+        )
+
+        self.assertEqual(416, response.status_code)
+        self.assertEqual(
+            f"bytes */{len(self.content)}",
+            response['Content-Range']
+        )
+
+    def test_conditional_requests(self):
+        etag = self.client.get(self.url)['ETag']
+
+        # A 304 should not touch the storage at all
+        with mock.patch.object(TemporaryStorage, 'size') as mock_size, \
+                mock.patch.object(TemporaryStorage, 'open') as mock_open:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            mock_size.assert_not_called()
+            mock_open.assert_not_called()
+        self.assertEqual(304, response.status_code)
+
+        modified_on = self.obj.required_file.modified_on
+        response = self.client.get(
+            self.url,
+            HTTP_IF_MODIFIED_SINCE=http_date(modified_on.timestamp() + 60)
+        )
+        self.assertEqual(304, response.status_code)
+
+    def test_if_range_mismatch_returns_full_file(self):
+        response = self.client.get(
+            self.url,
+            HTTP_RANGE='bytes=0-9',
+            HTTP_IF_RANGE='"outdated"',
+        )
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.content, b''.join(response.streaming_content))
+
+    def test_offload_delivery_backends(self):
+        old_backend = settings.DELIVERY_BACKEND
+        name_on_disk = self.obj.required_file.name_on_disk
+
+        try:
+            settings.DELIVERY_BACKEND = \
+                'cdh.files.delivery.XAccelRedirectDeliveryBackend'
+            with mock.patch.object(TemporaryStorage, 'open') as mock_open:
+                response = self.client.get(self.url)
+                mock_open.assert_not_called()
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(b'', response.content)
+            self.assertEqual(
+                f"/protected-files/{name_on_disk}",
+                response['X-Accel-Redirect']
+            )
+            self.assertEqual('image/png', response['Content-Type'])
+            self.assertIn('inline', response['Content-Disposition'])
+
+            settings.DELIVERY_BACKEND = \
+                'cdh.files.delivery.XSendfileDeliveryBackend'
+            response = self.client.get(self.url)
+            self.assertEqual(
+                get_storage().path(name_on_disk),
+                response['X-Sendfile']
+            )
+
+            settings.DELIVERY_BACKEND = \
+                'cdh.files.delivery.LiteSpeedDeliveryBackend'
+            response = self.client.get(self.url)
+            self.assertEqual(
+                f"/protected-files/{name_on_disk}",
+                response['X-LiteSpeed-Location']
+            )
+        finally:
+            settings.DELIVERY_BACKEND = old_backend
+
+
+class AsyncDownloadViewTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.obj = SingleFile()
+        self.obj.required_file = File(open(self.file_cat, mode='rb'))
+        self.obj.nullable_file = ContentFile(b'text', name='text.txt')
+        self.obj.save()
+        # Async tests can't use the lazy (sync) descriptors
+        self.required_uuid = self.obj.required_file.uuid
+        self.nullable_uuid = self.obj.nullable_file.uuid
+        self.url = reverse(
+            'dev_files:async_file_view',
+            args=[self.required_uuid]
+        )
+        with open(self.file_cat, mode='rb') as f:
+            self.content = f.read()
+
+    @staticmethod
+    async def _read(response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_full_download(self):
+        response = await self.async_client.get(self.url)
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.is_async)
+        self.assertEqual(self.content, await self._read(response))
+        self.assertEqual(str(len(self.content)), response['Content-Length'])
+        self.assertIn('inline', response['Content-Disposition'])
+
+    async def test_ranges(self):
+        response = await self.async_client.get(
+            self.url,
+            headers={'range': 'bytes=10-19'}
+        )
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(self.content[10:20], await self._read(response))
+
+        response = await self.async_client.get(
+            self.url,
+            headers={'range': 'bytes=0-4,100-104'}
+        )
+        self.assertEqual(206, response.status_code)
+        body = await self._read(response)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(self.content[0:5], body)
+        self.assertIn(self.content[100:105], body)
+
+    async def test_head_and_conditional_requests(self):
+        with mock.patch.object(TemporaryStorage, 'open') as mock_open:
+            response = await self.async_client.head(self.url)
+            etag = response['ETag']
+            response = await self.async_client.get(
+                self.url,
+                headers={'if-none-match': etag}
+            )
+            mock_open.assert_not_called()
+        self.assertEqual(304, response.status_code)
+
+    async def test_not_found(self):
+        response = await self.async_client.get(reverse(
+            'dev_files:async_file_view',
+            args=[uuid.uuid4()]
+        ))
+        self.assertEqual(404, response.status_code)
+
+    async def test_field_limited(self):
+        response = await self.async_client.get(reverse(
+            'dev_files:async_field_limited_file_view',
+            args=[self.required_uuid]
+        ))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.content, await self._read(response))
+
+        # Not a file of the required_file field
+        response = await self.async_client.get(reverse(
+            'dev_files:async_field_limited_file_view',
+            args=[self.nullable_uuid]
+        ))
+        self.assertEqual(404, response.status_code)
+
+
+class ContentAddressedStorageTests(TemporaryStorageMixin, TestCase):
+    storage = 'dev_files.tests.TemporaryContentAddressedStorage'
+    file_cat = 'dev_files/test_files/cat.png'
+    file_dog = 'dev_files/test_files/dog.jpg'
+
+    def test_identical_files_are_stored_once(self):
+        obj_1 = SingleFile()
+        obj_1.required_file = File(open(self.file_cat, mode='rb'))
+        obj_1.save()
+        obj_2 = SingleFile()
+        obj_2.required_file = File(open(self.file_cat, mode='rb'))
+        obj_2.save()
+
+        self.assertNotEqual(
+            obj_1.required_file.uuid,
+            obj_2.required_file.uuid
+        )
+        self.assertEqual(1, Blob.objects.count())
+        self.assertEqual(2, Blob.objects.get().ref_count)
+        self.assertEqual(1, len(self.files_on_disk()))
+        self.assertEqual(
+            obj_1.required_file.name_on_disk,
+            obj_2.required_file.name_on_disk
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            obj_1.delete()
+
+        self.assertEqual(1, Blob.objects.get().ref_count)
+        self.assertEqual(1, len(self.files_on_disk()))
+        with obj_2.required_file.open() as file:
+            with open(self.file_cat, mode='rb') as original:
+                self.assertEqual(original.read(), file.read())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            obj_2.delete()
+
+        self.assertEqual(0, Blob.objects.count())
+        self.assertEqual([], self.files_on_disk())
+
+    def test_content_type_is_sniffed_while_staging(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        # Not by reading the stored blob again
+        with mock.patch('cdh.files.db.wrappers.magic') as wrapper_magic:
+            obj.save()
+        wrapper_magic.from_buffer.assert_not_called()
+
+        self.assertEqual('image/png', obj.required_file.content_type)
+
+    def test_replacing_file_releases_blob(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        obj.required_file = File(open(self.file_dog, mode='rb'))
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.save()
+
+        self.assertEqual(1, Blob.objects.count())
+        self.assertEqual(1, len(self.files_on_disk()))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.delete()
+
+        self.assertEqual(0, Blob.objects.count())
+        self.assertEqual([], self.files_on_disk())
+
+    def test_blob_is_kept_on_rollback(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        pk = obj.pk
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    obj.delete()
+                    raise RuntimeError()
+
+        self.assertEqual(1, Blob.objects.get().ref_count)
+        obj = SingleFile.objects.get(pk=pk)
+        with obj.required_file.open() as file:
+            with open(self.file_cat, mode='rb') as original:
+                self.assertEqual(original.read(), file.read())
+
+    def test_reacquired_blob_is_kept(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            obj.delete()
+            # Stored again before the release is committed
+            obj = SingleFile()
+            obj.required_file = File(open(self.file_cat, mode='rb'))
+            obj.save()
+
+        for callback in callbacks:
+            callback()
+
+        self.assertEqual(1, Blob.objects.get().ref_count)
+        self.assertEqual(1, len(self.files_on_disk()))
+        with obj.required_file.open() as file:
+            with open(self.file_cat, mode='rb') as original:
+                self.assertEqual(original.read(), file.read())
+
+    def test_deduplicate_command(self):
+        settings.STORAGE = 'dev_files.tests.TemporaryStorage'
+        objects = []
+        for _ in range(2):
+            obj = SingleFile()
+            obj.required_file = File(open(self.file_cat, mode='rb'))
+            obj.save()
+            objects.append(obj)
+        self.assertEqual(2, len(self.files_on_disk()))
+
+        settings.STORAGE = self.storage
+        call_command('files_deduplicate', stdout=StringIO())
+
+        self.assertEqual(1, len(self.files_on_disk()))
+        self.assertEqual(2, Blob.objects.get().ref_count)
+        for obj in SingleFile.objects.all():
+            with obj.required_file.open() as file:
+                with open(self.file_cat, mode='rb') as original:
+                    self.assertEqual(original.read(), file.read())
+
+
+class CompressedStorageTests(TemporaryStorageMixin, TestCase):
+    storage = 'dev_files.tests.TemporaryCompressedStorage'
+    file_cat = 'dev_files/test_files/cat.png'
+    text = b'The cat sat on the mat. ' * 200
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.obj = SingleFile()
+        self.obj.required_file = File(open(self.file_cat, mode='rb'))
+        self.obj.nullable_file = ContentFile(self.text, name='cat.txt')
+        self.obj.save()
+        self.url = reverse(
+            'dev_files:file_view',
+            args=[self.obj.nullable_file.uuid]
+        )
+
+    def _stored(self, file_wrapper):
+        with open(file_wrapper.path, mode='rb') as file:
+            return file.read()
+
+    def test_compressed_at_rest(self):
+        obj = SingleFile.objects.get(pk=self.obj.pk)
+        text = obj.nullable_file
+        self.assertEqual('gzip', text.encoding)
+        self.assertEqual(len(self.text), text.size)
+        self.assertLess(len(self._stored(text)), len(self.text) / 5)
+        self.assertEqual(self.text, gzip.decompress(self._stored(text)))
+
+        with text.open() as file:
+            self.assertEqual(self.text, file.read())
+        self.assertEqual(self.text[100:150], b''.join(text.stream(100, 50)))
+        self.assertTrue(text.verify_on_disk(checksum=True))
+
+        # Already compressed, so stored as is
+        self.assertEqual('', obj.required_file.encoding)
+        with open(self.file_cat, mode='rb') as original:
+            self.assertEqual(
+                original.read(),
+                self._stored(obj.required_file)
+            )
+
+    def test_readable_after_switching_storage(self):
+        settings.STORAGE = 'dev_files.tests.TemporaryStorage'
+        obj = SingleFile.objects.get(pk=self.obj.pk)
+        with obj.nullable_file.open() as file:
+            self.assertEqual(self.text, file.read())
+
+    def test_download_passes_compressed_file_through(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, br')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+        body = b''.join(response.streaming_content)
+        self.assertEqual(str(len(body)), response['Content-Length'])
+        self.assertEqual(self.text, gzip.decompress(body))
+        self.assertTrue(response['ETag'].endswith('-gzip"'))
+
+        response = self.client.get(
+            self.url,
+            HTTP_ACCEPT_ENCODING='gzip',
+            HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        self.assertEqual(304, response.status_code)
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_download_decompresses(self):
+        for accept_encoding in ['', 'br', 'gzip;q=0, *']:
+            response = self.client.get(
+                self.url,
+                HTTP_ACCEPT_ENCODING=accept_encoding
+            )
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertEqual(str(len(self.text)), response['Content-Length'])
+            self.assertEqual(
+                self.text,
+                b''.join(response.streaming_content)
+            )
+
+        # Ranges are taken from the decompressed file
+        response = self.client.get(
+            self.url,
+            HTTP_ACCEPT_ENCODING='gzip',
+            HTTP_RANGE='bytes=24-47',
+        )
+        self.assertEqual(206, response.status_code)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(
+            self.text[24:48],
+            b''.join(response.streaming_content)
+        )
+
+    def test_deduplicate_decompresses(self):
+        settings.STORAGE = 'dev_files.tests.TemporaryContentAddressedStorage'
+        call_command('files_deduplicate', stdout=StringIO())
+
+        obj = SingleFile.objects.get(pk=self.obj.pk)
+        self.assertEqual('', obj.nullable_file.encoding)
+        self.assertEqual(
+            hashlib.sha256(self.text).hexdigest(),
+            obj.nullable_file.file_instance.blob_id
+        )
+        self.assertEqual(self.text, self._stored(obj.nullable_file))
+
+    def test_offload_backend_falls_back(self):
+        old_backend = settings.DELIVERY_BACKEND
+        settings.DELIVERY_BACKEND = \
+            'cdh.files.delivery.XSendfileDeliveryBackend'
+        try:
+            response = self.client.get(self.url)
+        finally:
+            settings.DELIVERY_BACKEND = old_backend
+
+        self.assertFalse(response.has_header('X-Sendfile'))
+        self.assertEqual(self.text, b''.join(response.streaming_content))
+
+
+class EncryptedStorageTests(TemporaryStorageMixin, TestCase):
+    storage = 'dev_files.tests.TemporaryEncryptedStorage'
+    text = b'The cat sat on the mat. ' * 100
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._old_keys = settings.ENCRYPTION_KEYS
+        settings.ENCRYPTION_KEYS = 'first key'
+        self.obj = self._create(self.text)
+        self.url = reverse(
+            'dev_files:file_view',
+            args=[self.obj.nullable_file.uuid]
+        )
+
+    def tearDown(self):
+        settings.ENCRYPTION_KEYS = self._old_keys
+        super().tearDown()
+
+    def _create(self, text):
+        obj = SingleFile()
+        obj.required_file = ContentFile(b'required', name='required.txt')
+        obj.nullable_file = ContentFile(text, name='cat.txt')
+        obj.save()
+        return obj
+
+    def _stored(self, file_wrapper):
+        with open(file_wrapper.path, mode='rb') as file:
+            return file.read()
+
+    def test_encrypted_at_rest(self):
+        obj = SingleFile.objects.get(pk=self.obj.pk)
+        text = obj.nullable_file
+        stored = self._stored(text)
+
+        self.assertNotIn(b'The cat', stored)
+        self.assertEqual(len(self.text), text.size)
+        self.assertEqual(len(self.text), get_storage().size(text.name_on_disk))
+        self.assertEqual('text/plain', text.content_type)
+        with text.open() as file:
+            self.assertEqual(self.text, file.read())
+        self.assertEqual(self.text[300:700], b''.join(text.stream(300, 400)))
+        self.assertTrue(text.verify_on_disk(checksum=True))
+
+        # Every file gets its own key
+        other = self._create(self.text).nullable_file
+        self.assertNotEqual(stored[-256:], self._stored(other)[-256:])
+
+    def test_chunk_boundaries(self):
+        for size in [0, 1, 255, 256, 257, 512]:
+            text = os.urandom(size)
+            file_wrapper = self._create(text).nullable_file
+            self.assertEqual(size, get_storage().size(file_wrapper.name_on_disk))
+            with file_wrapper.open() as file:
+                self.assertEqual(text, file.read())
+                file.seek(size // 2)
+                self.assertEqual(text[size // 2:], file.read())
+
+    def test_tampering_is_detected(self):
+        path = self.obj.nullable_file.path
+        stored = self._stored(self.obj.nullable_file)
+
+        # Flipping a bit, swapping two chunks, or dropping the last chunk
+        # should all fail to decrypt
+        header, chunk = 80, 256 + 16
+        first, second = header, header + chunk
+        tampered_versions = [
+            stored[:-1] + bytes([stored[-1] ^ 1]),
+            stored[:first] + stored[second:second + chunk] +
+            stored[first:second] + stored[second + chunk:],
+            stored[:header + chunk * (len(self.text) // 256)],
+        ]
+        for tampered in tampered_versions:
+            with open(path, mode='wb') as file:
+                file.write(tampered)
+            with self.assertRaises(DecryptionError):
+                with get_storage().open(self.obj.nullable_file.name_on_disk) \
+                        as file:
+                    file.read()
+
+    def test_key_rotation(self):
+        settings.ENCRYPTION_KEYS = ['second key', 'first key']
+        storages.clear()
+        new = self._create(b'new').nullable_file
+        obj = SingleFile.objects.get(pk=self.obj.pk)
+        with obj.nullable_file.open() as file:
+            self.assertEqual(self.text, file.read())
+
+        # Storages derive their keys once, so fetch a fresh one
+        settings.ENCRYPTION_KEYS = 'second key'
+        storages.clear()
+        obj = SingleFile.objects.get(pk=self.obj.pk)
+        with new.open() as file:
+            self.assertEqual(b'new', file.read())
+        with self.assertRaises(DecryptionError):
+            obj.nullable_file.open()
+
+    def test_readable_after_switching_storage(self):
+        settings.STORAGE = 'dev_files.tests.TemporaryStorage'
+        obj = self._create(self.text)
+
+        settings.STORAGE = self.storage
+        obj = SingleFile.objects.get(pk=obj.pk)
+        with obj.nullable_file.open() as file:
+            self.assertEqual(self.text, file.read())
+        self.assertEqual(
+            len(self.text),
+            get_storage().size(obj.nullable_file.name_on_disk)
+        )
+
+    def test_download(self):
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(str(len(self.text)), response['Content-Length'])
+        self.assertEqual(self.text, b''.join(response.streaming_content))
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=500-1000')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(
+            self.text[500:1001],
+            b''.join(response.streaming_content)
+        )
+
+    def test_offload_backend_falls_back(self):
+        old_backend = settings.DELIVERY_BACKEND
+        settings.DELIVERY_BACKEND = \
+            'cdh.files.delivery.XSendfileDeliveryBackend'
+        try:
+            response = self.client.get(self.url)
+        finally:
+            settings.DELIVERY_BACKEND = old_backend
+
+        self.assertFalse(response.has_header('X-Sendfile'))
+        self.assertEqual(self.text, b''.join(response.streaming_content))
+
+
+class TieredStorageTests(TemporaryStorageMixin, TestCase):
+    storage = 'dev_files.tests.TemporaryTieredStorage'
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.cold_root = self.root + '-cold'
+        self.obj = SingleFile()
+        self.obj.required_file = File(open(self.file_cat, mode='rb'))
+        self.obj.save()
+        with open(self.file_cat, mode='rb') as file:
+            self.contents = file.read()
+        self.url = reverse(
+            'dev_files:file_view',
+            args=[self.obj.required_file.uuid]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.cold_root, ignore_errors=True)
+        super().tearDown()
+
+    def _age(self, days=100):
+        FileModel = SingleFile.required_file.field.related_model
+        FileModel.objects.update(
+            stored_at=timezone.now() - timedelta(days=days)
+        )
+
+    def _tier(self, *args):
+        call_command('files_tier', *args, stdout=StringIO())
+        return SingleFile.objects.get(pk=self.obj.pk).required_file
+
+    def test_old_files_are_moved_to_cold_tier(self):
+        name = self.obj.required_file.name_on_disk
+        self.assertEqual('hot', self.obj.required_file.tier)
+
+        # Too recent
+        self.assertEqual('hot', self._tier().tier)
+        self._age()
+        self.assertEqual('hot', self._tier('--dry-run').tier)
+        self.assertEqual([name], self.files_on_disk())
+
+        file_wrapper = self._tier()
+        self.assertEqual('cold', file_wrapper.tier)
+        self.assertEqual([], self.files_on_disk())
+        self.assertEqual([name], os.listdir(self.cold_root))
+
+        # Reads are transparent
+        self.assertEqual(os.path.join(self.cold_root, name), file_wrapper.path)
+        with file_wrapper.open() as file:
+            self.assertEqual(self.contents, file.read())
+        self.assertTrue(file_wrapper.verify_on_disk(checksum=True))
+        response = self.client.get(self.url)
+        self.assertEqual(self.contents, b''.join(response.streaming_content))
+
+        # Running again changes nothing
+        self.assertEqual('cold', self._tier().tier)
+
+    def test_move_across_filesystems(self):
+        self._age()
+        with mock.patch('cdh.files.storage.os.rename', side_effect=OSError):
+            file_wrapper = self._tier()
+
+        self.assertEqual('cold', file_wrapper.tier)
+        self.assertEqual([], self.files_on_disk())
+        self.assertEqual(
+            [file_wrapper.name_on_disk],
+            os.listdir(self.cold_root)
+        )
+        with file_wrapper.open() as file:
+            self.assertEqual(self.contents, file.read())
+
+    def test_non_default_storages(self):
+        old_storages = settings.STORAGES
+        settings.STORAGES = {
+            'archive': 'dev_files.tests.TemporaryTieredArchiveStorage',
+        }
+        archive_root = self.root + '-archive'
+        try:
+            archived = ArchivedSingleFile()
+            archived.file = File(open(self.file_cat, mode='rb'))
+            archived.save()
+            self._age()
+            ArchiveFile.objects.update(
+                stored_at=timezone.now() - timedelta(days=100)
+            )
+
+            # Only the given storage
+            self.assertEqual('hot', self._tier('--storage=archive').tier)
+            file_wrapper = ArchivedSingleFile.objects.get(
+                pk=archived.pk
+            ).file
+            self.assertEqual('cold', file_wrapper.tier)
+            self.assertEqual([], os.listdir(archive_root))
+            self.assertEqual(
+                [file_wrapper.name_on_disk],
+                os.listdir(archive_root + '-cold')
+            )
+            with file_wrapper.open() as file:
+                self.assertEqual(self.contents, file.read())
+
+            # All storages with tiers by default
+            self.assertEqual('cold', self._tier().tier)
+
+            # Storages without tiers can't be given
+            settings.STORAGES = {
+                'archive': 'dev_files.tests.TemporaryArchiveStorage',
+            }
+            with self.assertRaisesMessage(CommandError, 'has no tiers'):
+                self._tier('--storage=archive')
+            with self.assertRaisesMessage(CommandError, 'Unknown storage'):
+                self._tier('--storage=unknown')
+        finally:
+            settings.STORAGES = old_storages
+            shutil.rmtree(archive_root, ignore_errors=True)
+            shutil.rmtree(archive_root + '-cold', ignore_errors=True)
+
+    def test_promote_on_access(self):
+        self._age()
+        self._tier()
+
+        old_promote_on_access = settings.PROMOTE_ON_ACCESS
+        settings.PROMOTE_ON_ACCESS = True
+        try:
+            response = self.client.get(self.url)
+        finally:
+            settings.PROMOTE_ON_ACCESS = old_promote_on_access
+
+        self.assertEqual(self.contents, b''.join(response.streaming_content))
+        file_wrapper = SingleFile.objects.get(pk=self.obj.pk).required_file
+        self.assertEqual('hot', file_wrapper.tier)
+        self.assertEqual([file_wrapper.name_on_disk], self.files_on_disk())
+        self.assertEqual([], os.listdir(self.cold_root))
+
+    def test_offload_backend_falls_back_for_cold_files(self):
+        self._age()
+        self._tier()
+
+        old_backend = settings.DELIVERY_BACKEND
+        settings.DELIVERY_BACKEND = \
+            'cdh.files.delivery.XAccelRedirectDeliveryBackend'
+        try:
+            response = self.client.get(self.url)
+        finally:
+            settings.DELIVERY_BACKEND = old_backend
+
+        self.assertFalse(response.has_header('X-Accel-Redirect'))
+        self.assertEqual(self.contents, b''.join(response.streaming_content))
+
+    def test_delete_and_gc(self):
+        self._age()
+        file_wrapper = self._tier()
+
+        orphan = str(uuid.uuid4())
+        with open(os.path.join(self.cold_root, orphan), 'wb') as file:
+            file.write(b'orphan')
+        call_command(
+            'files_gc',
+            '--grace-period=0',
+            '--skip-rows',
+            stdout=StringIO()
+        )
+        self.assertEqual(
+            [file_wrapper.name_on_disk],
+            os.listdir(self.cold_root)
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            SingleFile.objects.get(pk=self.obj.pk).delete()
+        self.assertEqual([], os.listdir(self.cold_root))
+
+
+class DerivativeTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+    file_dog = 'dev_files/test_files/dog.jpg'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.obj = SingleFile()
+        self.obj.required_file = File(open(self.file_dog, mode='rb'))
+        self.obj.nullable_file = ContentFile(b'Not an image', name='a.txt')
+        self.obj.save()
+        self.file_wrapper = self.obj.required_file
+
+    def _image(self, derivative):
+        from PIL import Image
+        with derivative.open() as file:
+            image = Image.open(file)
+            image.load()
+        return image
+
+    def test_generated_on_first_use(self):
+        name = f"{self.file_wrapper.uuid}.thumb-256"
+        self.assertIsNone(self.file_wrapper.derivative('thumb-256', False))
+
+        derivative = self.file_wrapper.derivative('thumb-256')
+        self.assertEqual(name, derivative.name)
+        self.assertIn(name, self.files_on_disk())
+        image = self._image(derivative)
+        self.assertEqual('WEBP', image.format)
+        self.assertEqual(256, max(image.size))
+
+        # Cached from now on
+        with mock.patch('cdh.files.derivatives.render') as render:
+            self.assertEqual(
+                name,
+                self.file_wrapper.derivative('thumb-256').name
+            )
+            render.assert_not_called()
+
+    def test_crop_and_pdf(self):
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new('RGB', (600, 300), 'red').save(buffer, format='PDF')
+        self.obj.nullable_file = ContentFile(buffer.getvalue(), name='a.pdf')
+        self.obj.save()
+
+        old_derivatives = settings.DERIVATIVES
+        settings.DERIVATIVES = {
+            'square': {'width': 100, 'height': 100, 'crop': True,
+                       'format': 'JPEG'},
+        }
+        try:
+            image = self._image(self.obj.nullable_file.derivative('square'))
+            self.assertEqual((100, 100), image.size)
+            red, green, blue = image.getpixel((50, 50))[:3]
+            self.assertTrue(red > 200 and green < 50 and blue < 50)
+            image = self._image(self.file_wrapper.derivative('square'))
+            self.assertEqual((100, 100), image.size)
+        finally:
+            settings.DERIVATIVES = old_derivatives
+
+    def test_stream(self):
+        derivative = self.file_wrapper.derivative('thumb-256')
+        with derivative.open() as file:
+            data = file.read()
+
+        chunks = list(derivative.stream(chunk_size=100))
+        self.assertEqual(data, b''.join(chunks))
+        self.assertEqual(100, len(chunks[0]))
+        self.assertEqual(
+            data[200:450],
+            b''.join(derivative.stream(200, 250, chunk_size=100))
+        )
+
+    def test_unsupported(self):
+        self.assertFalse(self.obj.nullable_file.supports_derivatives)
+        self.assertIsNone(self.obj.nullable_file.derivative('thumb-256'))
+        with self.assertRaises(ValueError):
+            self.file_wrapper.derivative('unknown')
+
+        # Claims to be an image, but isn't
+        FileModel = SingleFile.nullable_file.field.related_model
+        FileModel.objects.filter(pk=self.obj.nullable_file.pk).update(
+            content_type='image/png'
+        )
+        obj = SingleFile.objects.get(pk=self.obj.pk)
+        with self.assertLogs('cdh.files', 'WARNING'):
+            self.assertIsNone(obj.nullable_file.derivative('thumb-256'))
+
+    def test_invalidated_on_save_and_delete(self):
+        name = self.file_wrapper.derivative('thumb-256').name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.obj.required_file = File(open(self.file_cat, mode='rb'))
+            self.obj.save()
+        self.assertNotIn(name, self.files_on_disk())
+
+        obj = SingleFile.objects.get(pk=self.obj.pk)
+        name = obj.required_file.derivative('thumb-256').name
+        self.assertIn(name, self.files_on_disk())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.delete()
+        self.assertEqual([], self.files_on_disk())
+
+    def test_view(self):
+        url = reverse(
+            'dev_files:file_derivative_view',
+            args=[self.file_wrapper.uuid, 'thumb-256']
+        )
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/webp', response['Content-Type'])
+        self.assertIn('-thumb-256.webp', response['Content-Disposition'])
+        self.assertEqual(
+            self.file_wrapper.derivative('thumb-256').size,
+            len(b''.join(response.streaming_content))
+        )
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+        for uuid_, spec in [
+            (self.file_wrapper.uuid, 'unknown'),
+            (self.obj.nullable_file.uuid, 'thumb-256'),
+        ]:
+            response = self.client.get(reverse(
+                'dev_files:file_derivative_view',
+                args=[uuid_, spec]
+            ))
+            self.assertEqual(404, response.status_code)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('files_derivatives', '--workers=1', stdout=out)
+        self.assertIn('generated 2 derivatives', out.getvalue())
+        self.assertIn(
+            f"{self.file_wrapper.uuid}.preview-1024",
+            self.files_on_disk()
+        )
+
+        out = StringIO()
+        call_command(
+            'files_derivatives',
+            '--workers=1',
+            '--spec=thumb-256',
+            stdout=out
+        )
+        self.assertIn('generated 0 derivatives', out.getvalue())
+
+    def test_gc_keeps_derivatives(self):
+        name = self.file_wrapper.derivative('thumb-256').name
+        orphan = f"{uuid.uuid4()}.thumb-256"
+        with open(os.path.join(self.root, orphan), 'wb') as file:
+            file.write(b'orphan')
+
+        call_command(
+            'files_gc',
+            '--grace-period=0',
+            '--skip-rows',
+            stdout=StringIO()
+        )
+        self.assertIn(name, self.files_on_disk())
+        self.assertNotIn(orphan, self.files_on_disk())
+
+
+class IngestTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+    file_dog = 'dev_files/test_files/dog.jpg'
+    text = b'The cat sat on the mat. ' * 200
+    file_model = SingleFile.required_file.field.related_model
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.source = tempfile.mkdtemp()
+        self.manifest = os.path.join(tempfile.mkdtemp(), 'manifest.csv')
+        self.contents = {}
+        for path, original in [
+            ('cat.png', self.file_cat),
+            ('a/dog.jpg', self.file_dog),
+            ('a/b/cat copy.png', self.file_cat),
+        ]:
+            with open(original, mode='rb') as file:
+                self._add(path, file.read())
+        self._add('text.txt', self.text)
+        self._add('.hidden', b'hidden')
+
+    def tearDown(self):
+        shutil.rmtree(self.source, ignore_errors=True)
+        shutil.rmtree(os.path.dirname(self.manifest), ignore_errors=True)
+        super().tearDown()
+
+    def _add(self, path, contents):
+        full_path = os.path.join(self.source, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, mode='wb') as file:
+            file.write(contents)
+        if not path.startswith('.'):
+            self.contents[path] = contents
+
+    def _ingest(self, **kwargs):
+        return ingest(self.source, self.manifest, **kwargs)
+
+    def _check_imported(self):
+        manifest = read_manifest(self.manifest)
+        self.assertEqual(set(self.contents), set(manifest))
+        for path, file_uuid in manifest.items():
+            file = self.file_model.objects.get(uuid=file_uuid)
+            self.assertEqual(os.path.basename(path), file.original_filename)
+            self.assertEqual(len(self.contents[path]), file.size)
+            self.assertEqual(
+                hashlib.sha256(self.contents[path]).hexdigest(),
+                file.checksum
+            )
+            self.assertIsNotNone(file.stored_at)
+            file_wrapper = file.get_file_wrapper(only_existing=False)
+            with file_wrapper.open() as stored:
+                self.assertEqual(self.contents[path], stored.read())
+        return manifest
+
+    def test_ingest(self):
+        # One INSERT of rows and one of UnlinkedFiles per batch, in a
+        # savepoint each
+        with self.assertNumQueries(8):
+            result = self._ingest(workers=1, batch_size=3)
+        self.assertEqual(4, result.files)
+        self.assertEqual(0, result.failed)
+        manifest = self._check_imported()
+
+        self.assertEqual(
+            'image/png',
+            self.file_model.objects.get(uuid=manifest['cat.png']).content_type
+        )
+        self.assertEqual(
+            'text/plain',
+            self.file_model.objects.get(uuid=manifest['text.txt']).content_type
+        )
+
+    def test_gc_keeps_unlinked_files(self):
+        self._ingest(workers=1)
+        manifest = read_manifest(self.manifest)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('files_gc', '--grace-period', '0', stdout=StringIO())
+        self._check_imported()
+
+        # Once linked, they are like any other File
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        SingleFile.objects.filter(pk=obj.pk).update(
+            nullable_file=self.file_model.objects.get(uuid=manifest['cat.png'])
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('files_gc', '--grace-period', '0', stdout=StringIO())
+        self.assertEqual(
+            len(manifest) - 1,
+            UnlinkedFile.objects.for_model(self.file_model).count()
+        )
+
+    def test_resume(self):
+        self._ingest(workers=1)
+        self._add('new.txt', b'new')
+
+        result = self._ingest(workers=1)
+        self.assertEqual(1, result.files)
+        self.assertEqual(4, result.skipped)
+        self.assertEqual(5, self.file_model.objects.count())
+        self._check_imported()
+
+    def test_worker_processes(self):
+        result = self._ingest(workers=2, batch_size=2)
+        self.assertEqual(4, result.files)
+        self._check_imported()
+
+    def test_into_content_addressed_storage(self):
+        settings.STORAGE = 'dev_files.tests.TemporaryContentAddressedStorage'
+        self._ingest(workers=1)
+        self._check_imported()
+
+        # The two cats share a blob
+        with open(self.file_cat, mode='rb') as file:
+            checksum = hashlib.sha256(file.read()).hexdigest()
+        self.assertEqual(2, Blob.objects.get(pk=checksum).ref_count)
+        self.assertEqual(3, Blob.objects.count())
+
+    def test_into_compressed_storage(self):
+        settings.STORAGE = 'dev_files.tests.TemporaryCompressedStorage'
+        self._ingest(workers=1)
+        manifest = self._check_imported()
+        self.assertEqual(
+            'gzip',
+            self.file_model.objects.get(uuid=manifest['text.txt']).encoding
+        )
+
+    def test_command(self):
+        out = StringIO()
+        call_command(
+            'files_ingest',
+            self.source,
+            f'--manifest={self.manifest}',
+            '--workers=1',
+            '--include-hidden',
+            stdout=out,
+        )
+        self.assertIn('imported 5 files', out.getvalue())
+        self.assertIn('files/s', out.getvalue())
+        self.assertIn('.hidden', read_manifest(self.manifest))
+
+
+class ScrubTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+    text = b'The cat sat on the mat. ' * 200
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.obj = SingleFile()
+        self.obj.required_file = File(open(self.file_cat, mode='rb'))
+        self.obj.nullable_file = ContentFile(self.text, name='cat.txt')
+        self.obj.save()
+        self.file_model = SingleFile.required_file.field.related_model
+
+    def _scrub(self, *args):
+        out = StringIO()
+        self.err = StringIO()
+        call_command('files_scrub', '--workers=1', *args, stdout=out,
+                     stderr=self.err)
+        return out.getvalue()
+
+    def _verified_at(self, file_wrapper):
+        return self.file_model.objects.get(
+            pk=file_wrapper.file_instance.pk
+        ).verified_at
+
+    def _corrupt(self, file_wrapper):
+        with open(file_wrapper.path, 'r+b') as file:
+            file.seek(100)
+            file.write(b'rot')
+
+    def test_scrub(self):
+        self.assertIn('verified 2 files', self._scrub())
+        verified_at = self._verified_at(self.obj.required_file)
+        self.assertIsNotNone(verified_at)
+
+        # Verified files are skipped until the interval has passed
+        self.assertIn('verified 0 files', self._scrub())
+        self.assertIn('verified 2 files', self._scrub('--interval=0'))
+        self.assertGreater(
+            self._verified_at(self.obj.required_file),
+            verified_at
+        )
+
+    def test_corrupt_and_missing_files(self):
+        self._corrupt(self.obj.required_file)
+        os.remove(self.obj.nullable_file.path)
+
+        with self.assertLogs('cdh.files', 'ERROR') as logs:
+            with self.assertRaisesMessage(
+                    CommandError,
+                    '1 corrupt, 1 missing'
+            ):
+                self._scrub()
+        self.assertIsNone(self._verified_at(self.obj.required_file))
+        self.assertIsNone(self._verified_at(self.obj.nullable_file))
+        self.assertEqual(2, len(logs.records))
+        self.assertIn(
+            f'{self.obj.required_file.uuid} is corrupt',
+            logs.output[0]
+        )
+        self.assertIn(
+            f'{self.obj.nullable_file.uuid} is missing',
+            logs.output[1]
+        )
+        # Only listed on stderr when asked for
+        self.assertEqual('', self.err.getvalue())
+
+        with self.assertLogs('cdh.files', 'ERROR'):
+            with self.assertRaises(CommandError):
+                self._scrub('--verbosity=2')
+        self.assertIn(
+            f'{self.obj.required_file.uuid} is corrupt',
+            self.err.getvalue()
+        )
+        self.assertIn(
+            f'{self.obj.nullable_file.uuid} is missing',
+            self.err.getvalue()
+        )
+
+    def test_truncated_file(self):
+        with open(self.obj.required_file.path, 'r+b') as file:
+            file.truncate(100)
+
+        with self.assertLogs('cdh.files', 'ERROR'):
+            with self.assertRaisesMessage(CommandError, '1 corrupt'):
+                self._scrub()
+        self.assertEqual('', self.err.getvalue())
+
+    def test_resaved_file_is_verified_again(self):
+        self._scrub()
+        self.file_model.objects.filter(
+            pk=self.obj.required_file.file_instance.pk
+        ).update(stored_at=timezone.now())
+
+        self.assertIn('verified 1 files', self._scrub())
+
+    def test_max_rate(self):
+        with mock.patch(
+                'cdh.files.management.commands.files_scrub.time.sleep'
+        ) as sleep:
+            self._scrub('--max-rate=0.001')
+        self.assertTrue(sleep.called)
+
+    def test_worker_processes(self):
+        self.assertIn('verified 2 files', self._scrub('--workers=2'))
+
+
+class CompressedScrubTests(ScrubTests):
+    storage = 'dev_files.tests.TemporaryCompressedStorage'
+
+    def test_is_compressed(self):
+        self.assertEqual('gzip', self.obj.nullable_file.encoding)
+        self.assertEqual('', self.obj.required_file.encoding)
+
+
+class StorageRegistryTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.archive_root = self.root + '-archive'
+        self._old_storages = settings.STORAGES
+        settings.STORAGES = {
+            'archive': 'dev_files.tests.TemporaryArchiveStorage',
+        }
+
+    def tearDown(self):
+        settings.STORAGES = self._old_storages
+        shutil.rmtree(self.archive_root, ignore_errors=True)
+        super().tearDown()
+
+    def _create(self):
+        obj = ArchivedSingleFile()
+        obj.file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        return obj
+
+    def test_storages_are_cached(self):
+        storage = get_storage()
+        with mock.patch('cdh.files.utils.importlib') as importlib:
+            self.assertIs(storage, get_storage())
+            self.assertIs(storage, get_storage('default'))
+        importlib.import_module.assert_not_called()
+
+        self.assertIsInstance(get_storage('archive'), TemporaryArchiveStorage)
+        self.assertIs(get_storage('archive'), get_storage('archive'))
+
+        # Changing the configured storage is picked up
+        settings.STORAGE = 'dev_files.tests.TemporaryCompressedStorage'
+        self.assertIsInstance(get_storage(), TemporaryCompressedStorage)
+
+    def test_unknown_storage(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_storage('unknown')
+
+        errors = fields.FileField(storage='unknown')._check_storage()
+        self.assertEqual(['cdh.files.E003'], [error.id for error in errors])
+        self.assertEqual([], fields.FileField(storage='archive')._check_storage())
+
+    def test_field_storage(self):
+        obj = self._create()
+        name = obj.file.name_on_disk
+
+        self.assertEqual([], self.files_on_disk())
+        self.assertEqual([name], os.listdir(self.archive_root))
+        self.assertEqual('archive', obj.file.storage_name)
+
+        obj = ArchivedSingleFile.objects.get(pk=obj.pk)
+        self.assertEqual(os.path.join(self.archive_root, name), obj.file.path)
+        with obj.file.open() as file, open(self.file_cat, mode='rb') as cat:
+            self.assertEqual(cat.read(), file.read())
+
+        # Without a field, the storage follows from the File model
+        file_instance = obj.file.file_instance
+        file_instance._file_wrappers = {}
+        with self.assertNumQueries(0):
+            self.assertIs(
+                get_storage('archive'),
+                file_instance.get_file_wrapper(only_existing=False).storage
+            )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.delete()
+        self.assertEqual([], os.listdir(self.archive_root))
+
+    def test_gc_scans_all_storages(self):
+        self._create()
+        orphan = str(uuid.uuid4())
+        with open(os.path.join(self.archive_root, orphan), 'wb') as file:
+            file.write(b'orphan')
+
+        out = StringIO()
+        call_command(
+            'files_gc',
+            '--grace-period=0',
+            '--skip-rows',
+            stdout=out
+        )
+        self.assertIn('archive: files: scanned 2, 1 orphaned', out.getvalue())
+        self.assertNotIn(orphan, os.listdir(self.archive_root))
+
+
+class FileSignalDispatcherTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    @staticmethod
+    def _receivers(signal, model):
+        return [
+            receiver for receiver in signal.receivers
+            if receiver[0][1] == id(model)
+        ]
+
+    def test_one_receiver_per_model(self):
+        for signal in [post_save, pre_delete, post_delete]:
+            self.assertEqual(1, len(self._receivers(signal, SingleFile)))
+            self.assertEqual(1, len(self._receivers(signal, TrackedFile)))
+
+        dispatcher = get_dispatcher(SingleFile)
+        self.assertEqual(
+            [
+                SingleFile._meta.get_field('nullable_file'),
+                SingleFile._meta.get_field('required_file'),
+            ],
+            dispatcher.file_fields
+        )
+        self.assertTrue(
+            get_dispatcher(SingleFile.required_file.field.related_model)
+            .is_file_model
+        )
+
+    def test_unchanged_saves_skip_fields(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        with mock.patch.object(
+                fields.FileField,
+                'post_save',
+                autospec=True
+        ) as field_post_save:
+            obj.save()
+            self.assertEqual(2, field_post_save.call_count)
+
+            field_post_save.reset_mock()
+            obj = SingleFile.objects.get(pk=obj.pk)
+            obj.required_file.name
+            obj.save()
+            field_post_save.assert_not_called()
+
+    def test_replaced_file_is_removed(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        old_name = obj.required_file.name_on_disk
+
+        obj = SingleFile.objects.get(pk=obj.pk)
+        obj.required_file = ContentFile(b'new', name='new.txt')
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.save()
+        self.assertEqual([obj.required_file.name_on_disk], self.files_on_disk())
+        self.assertNotEqual(old_name, obj.required_file.name_on_disk)
+
+        # The state is reset after saving
+        with mock.patch.object(fields.FileField, 'post_save') as post_save_:
+            obj.save()
+        post_save_.assert_not_called()
+
+
+class ResolvingSingleFileForm(FileResolverFormMixin, SingleFileForm):
+    pass
+
+
+class ResolvingFormSet(FileResolverFormSetMixin, BaseModelFormSet):
+    pass
+
+
+class FilteredSingleFileForm(SingleFileForm):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name in ['required_file', 'nullable_file']:
+            field = self.fields[name]
+            field.queryset = field.queryset.exclude(original_filename='')
+
+
+class FileResolverTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.objs = []
+        for i in range(3):
+            obj = SingleFile()
+            obj.required_file = File(open(self.file_cat, mode='rb'))
+            obj.nullable_file = ContentFile(b'text', name=f'{i}.txt')
+            obj.save()
+            self.objs.append(obj)
+        self.formset_class = modelformset_factory(
+            SingleFile,
+            form=SingleFileForm,
+            formset=ResolvingFormSet,
+            extra=0,
+        )
+
+    def _post_data(self, changed=None):
+        data = {
+            'form-TOTAL_FORMS': str(len(self.objs)),
+            'form-INITIAL_FORMS': str(len(self.objs)),
+        }
+        for i, obj in enumerate(self.objs):
+            data[f'form-{i}-id'] = str(obj.pk)
+            for name in ['required_file', 'nullable_file']:
+                data[f'form-{i}-{name}_id'] = str(getattr(obj, name).uuid)
+                data[f'form-{i}-{name}_changed'] = \
+                    '1' if changed == (i, name) else '0'
+        return data
+
+    def test_form(self):
+        form = ResolvingSingleFileForm(
+            instance=SingleFile.objects.get(pk=self.objs[0].pk)
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.file_cat,
+                form['required_file'].value().name
+            )
+            self.assertEqual('0.txt', form['nullable_file'].value().name)
+
+    def test_formset_render(self):
+        formset = self.formset_class(queryset=SingleFile.objects.order_by('pk'))
+        forms = formset.forms
+
+        with self.assertNumQueries(1):
+            names = [
+                (form['required_file'].value().name,
+                 form['nullable_file'].value().name)
+                for form in forms
+            ]
+        self.assertEqual(
+            [(self.file_cat, f'{i}.txt') for i in range(3)],
+            names
+        )
+
+    def test_formset_render_filtered_querysets(self):
+        formset = modelformset_factory(
+            SingleFile,
+            form=FilteredSingleFileForm,
+            formset=ResolvingFormSet,
+            extra=0,
+        )(queryset=SingleFile.objects.order_by('pk'))
+        forms = formset.forms
+
+        # Every field got its own (equal) queryset
+        with self.assertNumQueries(1):
+            names = [
+                form['nullable_file'].value().name for form in forms
+            ]
+        self.assertEqual([f'{i}.txt' for i in range(3)], names)
+
+    def test_unknown_values_fall_back(self):
+        form = ResolvingSingleFileForm(
+            instance=SingleFile.objects.get(pk=self.objs[0].pk)
+        )
+        form['required_file'].value()
+        field = form.fields['nullable_file']
+        unknown_pk = self.objs[1].nullable_file.pk
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(field.prepare_value(None))
+        with self.assertNumQueries(1):
+            self.assertEqual('1.txt', field.prepare_value(unknown_pk).name)
+
+    def test_bound_formset_render(self):
+        formset = self.formset_class(
+            self._post_data(),
+            queryset=SingleFile.objects.order_by('pk')
+        )
+        forms = formset.forms
+
+        with self.assertNumQueries(1):
+            uuids = [
+                form['nullable_file'].value().uuid for form in forms
+            ]
+        self.assertEqual([obj.nullable_file.uuid for obj in self.objs], uuids)
+
+    def test_bound_formset_save(self):
+        old_name = self.objs[1].nullable_file.name_on_disk
+        formset = self.formset_class(
+            self._post_data(changed=(1, 'nullable_file')),
+            {'form-1-nullable_file': ContentFile(b'new', name='new.txt')},
+            queryset=SingleFile.objects.order_by('pk')
+        )
+        self.assertTrue(formset.is_valid())
+
+        # The files were cached on the instances, which the descriptor uses
+        field = SingleFile._meta.get_field('required_file')
+        for form in formset.forms:
+            self.assertTrue(field.is_cached(form.instance))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            formset.save()
+
+        obj = SingleFile.objects.get(pk=self.objs[1].pk)
+        self.assertEqual('new.txt', obj.nullable_file.name)
+        self.assertEqual(self.file_cat, obj.required_file.name)
+        self.assertNotIn(old_name, self.files_on_disk())
+
+    def test_descriptor_uses_cached_file(self):
+        obj = SingleFile.objects.get(pk=self.objs[0].pk)
+        old_file = obj.nullable_file
+
+        # Only the new File is created; the replaced one is taken from the
+        # cache
+        with self.assertNumQueries(1):
+            obj.nullable_file = (
+                ContentFile(b'new', name='new.txt'),
+                str(old_file.uuid),
+                True
+            )
+        self.assertTrue(old_file._removed)
+        self.assertEqual('new.txt', obj.nullable_file.name)
+
+
+class ShardedStorageTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._old_shard_depth = settings.SHARD_DEPTH
+
+    def tearDown(self):
+        settings.SHARD_DEPTH = self._old_shard_depth
+        super().tearDown()
+
+    def _create(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        return obj
+
+    def test_sharded_layout(self):
+        settings.SHARD_DEPTH = 2
+        obj = self._create()
+        name = obj.required_file.name_on_disk
+
+        self.assertEqual(
+            [f"{name[0:2]}/{name[2:4]}/{name}"],
+            self.files_on_disk()
+        )
+        self.assertEqual(
+            os.path.join(self.root, name[0:2], name[2:4], name),
+            obj.required_file.path
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.delete()
+        self.assertEqual([], self.files_on_disk())
+
+    def test_content_addressed(self):
+        settings.SHARD_DEPTH = 2
+        settings.STORAGE = 'dev_files.tests.TemporaryContentAddressedStorage'
+        storage = get_storage()
+        obj = self._create()
+        checksum = obj.required_file.file_instance.blob_id
+
+        # Staged next to the blobs, and stored under their fan-out only
+        self.assertEqual(
+            os.path.join(self.root, 'blobs'),
+            storage._staging_directory()
+        )
+        self.assertEqual([storage.blob_name(checksum)], self.files_on_disk())
+
+        orphan = 'f' * 64
+        orphan_path = storage.path(storage.blob_name(orphan))
+        os.makedirs(os.path.dirname(orphan_path))
+        with open(orphan_path, 'wb') as file:
+            file.write(b'orphan')
+
+        call_command('files_gc', '--grace-period=0', stdout=StringIO())
+        self.assertEqual([storage.blob_name(checksum)], self.files_on_disk())
+
+    def test_fallback_and_migration(self):
+        settings.SHARD_DEPTH = 0
+        obj = self._create()
+        name = obj.required_file.name_on_disk
+        self.assertEqual([name], self.files_on_disk())
+
+        settings.SHARD_DEPTH = 2
+        storages.clear()
+        obj = SingleFile.objects.get(pk=obj.pk)
+        self.assertTrue(get_storage().exists(name))
+        with obj.required_file.open() as file:
+            self.assertTrue(file.read())
+
+        call_command('files_shard', stdout=StringIO())
+
+        self.assertEqual(
+            [f"{name[0:2]}/{name[2:4]}/{name}"],
+            self.files_on_disk()
+        )
+        obj = SingleFile.objects.get(pk=obj.pk)
+        with obj.required_file.open() as file:
+            self.assertTrue(file.read())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.delete()
+        self.assertEqual([], self.files_on_disk())
+
+
+@override_settings(FILE_UPLOAD_HANDLERS=[
+    'cdh.files.uploadhandler.StorageUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+])
+class StorageUploadHandlerTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def _upload(self):
+        with open(self.file_cat, mode='rb') as file:
+            return self.client.post(reverse('dev_files:single_create'), {
+                'required_file': file,
+                'required_file_changed': '1',
+                'nullable_file_changed': '0',
+            })
+
+    def test_upload_is_stored_without_rereading(self):
+        with mock.patch('cdh.files.db.wrappers.magic') as wrapper_magic:
+            response = self._upload()
+            wrapper_magic.from_buffer.assert_not_called()
+
+        self.assertEqual(302, response.status_code)
+        obj = SingleFile.objects.get()
+        self.assertEqual('image/png', obj.required_file.content_type)
+        self.assertEqual('cat.png', obj.required_file.original_filename)
+        # The upload itself should have been moved, not copied
+        self.assertEqual(
+            [obj.required_file.name_on_disk],
+            self.files_on_disk()
+        )
+        with obj.required_file.open() as stored:
+            with open(self.file_cat, mode='rb') as original:
+                self.assertEqual(original.read(), stored.read())
+
+    def test_unsaved_upload_is_removed(self):
+        with open(self.file_cat, mode='rb') as file:
+            response = self.client.post(reverse('dev_files:single_create'), {
+                'nullable_file': file,
+                'nullable_file_changed': '1',
+                'required_file_changed': '0',
+            })
+
+        # The form is invalid, as the required file is missing
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, SingleFile.objects.count())
+        self.assertEqual([], self.files_on_disk())
+
+    def test_upload_into_content_addressed_storage(self):
+        settings.STORAGE = 'dev_files.tests.TemporaryContentAddressedStorage'
+        self._upload()
+
+        obj = SingleFile.objects.get()
+        with open(self.file_cat, mode='rb') as original:
+            checksum = hashlib.sha256(original.read()).hexdigest()
+        self.assertEqual(checksum, obj.required_file.file_instance.blob_id)
+        self.assertEqual(
+            [get_storage().blob_name(checksum)],
+            self.files_on_disk()
+        )
+
+
+class ChunkedUploadTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._old_chunk_size = settings.CHUNKED_UPLOAD_CHUNK_SIZE
+        settings.CHUNKED_UPLOAD_CHUNK_SIZE = 1024
+        # The test client isn't logged in
+        settings.CHUNKED_UPLOAD_ALLOW_ANONYMOUS = True
+        with open(self.file_cat, mode='rb') as file:
+            self.contents = file.read()
+
+    def tearDown(self):
+        settings.CHUNKED_UPLOAD_CHUNK_SIZE = self._old_chunk_size
+        settings.CHUNKED_UPLOAD_ALLOW_ANONYMOUS = False
+        super().tearDown()
+
+    def _start(self, url=None):
+        url = url or reverse('cdh.files:upload_create')
+        response = self.client.post(url, {
+            'filename': 'cat.png',
+            'size': len(self.contents),
+            'content_type': 'image/png',
+        })
+        self.assertEqual(201, response.status_code)
+        return response.json()
+
+    def _put(self, session, offset, length=1024):
+        return self.client.put(
+            f"{session['url']}?offset={offset}",
+            self.contents[offset:offset + length],
+            content_type='application/octet-stream',
+        )
+
+    def _upload(self, url=None):
+        session = self._start(url)
+        # Out of order, as parallel uploads would
+        for index in reversed(session['missing_chunks']):
+            response = self._put(session, index * session['chunk_size'])
+            self.assertEqual(204, response.status_code)
+        response = self.client.post(session['url'])
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.json()['completed'])
+        return session
+
+    def test_upload_and_submit(self):
+        session = self._upload()
+
+        with mock.patch('cdh.files.db.wrappers.magic') as wrapper_magic:
+            response = self.client.post(reverse('dev_files:single_create'), {
+                'required_file_upload': session['id'],
+                'required_file_changed': '1',
+                'nullable_file_changed': '0',
+            })
+            wrapper_magic.from_buffer.assert_not_called()
+        self.assertEqual(302, response.status_code)
+
+        obj = SingleFile.objects.get()
+        self.assertEqual('cat.png', obj.required_file.original_filename)
+        self.assertEqual('image/png', obj.required_file.content_type)
+        self.assertEqual(
+            hashlib.sha256(self.contents).hexdigest(),
+            obj.required_file.file_instance.checksum
+        )
+        with obj.required_file.open() as stored:
+            self.assertEqual(self.contents, stored.read())
+        # Moved into place, and the session is gone
+        self.assertEqual(
+            [obj.required_file.name_on_disk],
+            self.files_on_disk()
+        )
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_anonymous_users_and_size_limit(self):
+        settings.CHUNKED_UPLOAD_ALLOW_ANONYMOUS = False
+        data = {
+            'filename': 'cat.png',
+            'size': len(self.contents),
+        }
+        response = self.client.post(reverse('cdh.files:upload_create'), data)
+        self.assertEqual(403, response.status_code)
+        with mock.patch.object(SimpleFileInput, 'get_user', return_value=None):
+            self.assertEqual('', SimpleFileInput().get_upload_url())
+
+        user = get_user_model().objects.create(username='uploader')
+        with mock.patch.object(SimpleFileInput, 'get_user', return_value=user):
+            self.assertEqual(
+                reverse('cdh.files:upload_create'),
+                SimpleFileInput().get_upload_url()
+            )
+
+        # Larger than the default limit
+        settings.CHUNKED_UPLOAD_ALLOW_ANONYMOUS = True
+        data['size'] = 2 * 2 ** 30 + 1
+        response = self.client.post(reverse('cdh.files:upload_create'), data)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual([], self.files_on_disk())
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_upload_of_other_user_is_not_accepted(self):
+        session = self._upload()
+        user = get_user_model().objects.create(username='other')
+
+        form = SingleFileForm(data={
+            'required_file_upload': session['id'],
+            'required_file_changed': '1',
+            'nullable_file_changed': '0',
+        })
+        with mock.patch.object(SimpleFileInput, 'get_user', return_value=user):
+            self.assertFalse(form.is_valid())
+        self.assertIn('required_file', form.errors)
+        self.assertTrue(UploadSession.objects.exists())
+
+    def test_upload_into_other_storage(self):
+        archive_root = self.root + '-archive'
+        old_storages = settings.STORAGES
+        settings.STORAGES = {
+            'archive': 'dev_files.tests.TemporaryArchiveStorage',
+        }
+        self.addCleanup(shutil.rmtree, archive_root, ignore_errors=True)
+        self.addCleanup(setattr, settings, 'STORAGES', old_storages)
+        form_class = modelform_factory(ArchivedSingleFile, fields=['file'])
+
+        url = form_class()['file'].field.widget.get_upload_url()
+        self.assertEqual(
+            reverse('cdh.files:upload_create') + '?storage=archive',
+            url
+        )
+        session = self._upload(url)
+        self.assertEqual([], self.files_on_disk())
+
+        form = form_class(data={
+            'file_upload': session['id'],
+            'file_changed': '1',
+        })
+        with mock.patch.object(SimpleFileInput, 'get_user', return_value=None):
+            self.assertTrue(form.is_valid(), form.errors)
+            # Not an upload for a field using the default storage
+            self.assertIsNone(
+                SimpleFileInput.get_chunked_upload(session['id'])
+            )
+        obj = form.save()
+
+        with obj.file.open() as stored:
+            self.assertEqual(self.contents, stored.read())
+        self.assertEqual([obj.file.name_on_disk], os.listdir(archive_root))
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_resume(self):
+        session = self._start()
+        num_chunks = len(session['missing_chunks'])
+        self._put(session, 0)
+        self._put(session, 2048)
+
+        response = self.client.get(session['url'])
+        self.assertEqual(
+            [1] + list(range(3, num_chunks)),
+            response.json()['missing_chunks']
+        )
+        # Not everything is in yet
+        self.assertEqual(400, self.client.post(session['url']).status_code)
+
+    def test_invalid_chunks(self):
+        session = self._start()
+        # Not at a chunk boundary, past the end, and too short
+        self.assertEqual(400, self._put(session, 512).status_code)
+        self.assertEqual(
+            400,
+            self._put(session, len(self.contents) + 1024).status_code
+        )
+        self.assertEqual(400, self._put(session, 0, 512).status_code)
+        self.assertEqual(
+            len(session['missing_chunks']),
+            len(self.client.get(session['url']).json()['missing_chunks'])
+        )
+
+    def test_incomplete_upload_is_not_accepted(self):
+        session = self._start()
+        response = self.client.post(reverse('dev_files:single_create'), {
+            'required_file_upload': session['id'],
+            'required_file_changed': '1',
+            'nullable_file_changed': '0',
+        })
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(SingleFile.objects.exists())
+
+    def test_abort(self):
+        session = self._start()
+        self._put(session, 0)
+        self.assertEqual(204, self.client.delete(session['url']).status_code)
+        self.assertEqual(404, self.client.get(session['url']).status_code)
+        self.assertEqual([], self.files_on_disk())
+
+    def test_expiry(self):
+        session = self._upload()
+        # Recent sessions are left alone
+        call_command('files_expire_uploads', stdout=StringIO())
+        self.assertEqual(1, UploadSession.objects.count())
+
+        UploadSession.objects.update(
+            modified_on=timezone.now() - timedelta(
+                seconds=settings.CHUNKED_UPLOAD_EXPIRY + 1
+            )
+        )
+        # Expired sessions are cleaned up when starting new ones
+        new_session = self._start()
+        self.assertEqual(
+            [new_session['id']],
+            [str(value) for value in UploadSession.objects.values_list(
+                'uuid', flat=True
+            )]
+        )
+        self.assertNotIn(session['id'], self.files_on_disk())
+
+        # The files of sessions in progress are not garbage
+        self.assertEqual(
+            {new_session['id']},
+            GarbageCollectionCommand._existing_files({new_session['id']})
+        )
+
+
+class AsyncChunkedUploadTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self._old_chunk_size = settings.CHUNKED_UPLOAD_CHUNK_SIZE
+        settings.CHUNKED_UPLOAD_CHUNK_SIZE = 1024
+        # The test client isn't logged in
+        settings.CHUNKED_UPLOAD_ALLOW_ANONYMOUS = True
+        with open(self.file_cat, mode='rb') as file:
+            self.contents = file.read()
+        self.factory = AsyncRequestFactory()
+
+    def tearDown(self):
+        settings.CHUNKED_UPLOAD_CHUNK_SIZE = self._old_chunk_size
+        settings.CHUNKED_UPLOAD_ALLOW_ANONYMOUS = False
+        super().tearDown()
+
+    async def _session_request(self, request, session):
+        return await AsyncUploadSessionView.as_view()(
+            request,
+            uuid=session['id']
+        )
+
+    async def test_upload(self):
+        response = await AsyncUploadSessionCreateView.as_view()(
+            self.factory.post('/', {
+                'filename': 'cat.png',
+                'size': len(self.contents),
+                'content_type': 'image/png',
+            })
+        )
+        self.assertEqual(201, response.status_code)
+        session = json.loads(response.content)
+
+        for index in session['missing_chunks']:
+            offset = index * session['chunk_size']
+            response = await self._session_request(
+                self.factory.put(
+                    f'/?offset={offset}',
+                    self.contents[offset:offset + 1024],
+                    content_type='application/octet-stream',
+                ),
+                session
+            )
+            self.assertEqual(204, response.status_code)
+
+        response = await self._session_request(
+            self.factory.post('/'),
+            session
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(json.loads(response.content)['completed'])
+
+    async def test_unknown_session(self):
+        response = await self._session_request(
+            self.factory.get('/'),
+            {'id': str(uuid.uuid4())}
+        )
+        self.assertEqual(404, response.status_code)
+
+
+class FileMetadataTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def _save_cat(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        return obj
+
+    def _cat_checksum(self):
+        with open(self.file_cat, mode='rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def test_metadata_recorded_on_save(self):
+        obj = self._save_cat()
+        file_instance = obj.required_file.file_instance
+
+        self.assertEqual(os.path.getsize(self.file_cat), file_instance.size)
+        self.assertEqual(self._cat_checksum(), file_instance.checksum)
+        self.assertIsNotNone(file_instance.stored_at)
+        self.assertEqual('image/png', file_instance.content_type)
+
+    def test_size_and_existence_do_not_query_storage(self):
+        pk = self._save_cat().pk
+        obj = SingleFile.objects.get(pk=pk)
+
+        with mock.patch.object(TemporaryStorage, 'exists') as exists, \
+                mock.patch.object(TemporaryStorage, 'size') as size, \
+                mock.patch.object(TemporaryStorage, 'open') as open_:
+            self.assertTrue(obj.required_file)
+            self.assertTrue(obj.required_file.exists())
+            self.assertEqual(
+                os.path.getsize(self.file_cat),
+                obj.required_file.size
+            )
+
+        exists.assert_not_called()
+        size.assert_not_called()
+        open_.assert_not_called()
+
+    def test_verify_on_disk(self):
+        obj = self._save_cat()
+        wrapper = obj.required_file
+        path = os.path.join(self.root, wrapper.name_on_disk)
+
+        self.assertTrue(wrapper.verify_on_disk(checksum=True))
+
+        # Same size, different contents
+        with open(path, 'r+b') as file:
+            file.write(b'\0')
+        self.assertTrue(wrapper.verify_on_disk())
+        self.assertFalse(wrapper.verify_on_disk(checksum=True))
+
+        os.remove(path)
+        self.assertFalse(wrapper.verify_on_disk())
+        # The database still believes it's there
+        self.assertTrue(wrapper.exists())
+
+    def test_backfill_command(self):
+        obj = self._save_cat()
+        missing = self._save_cat()
+        os.remove(os.path.join(self.root, missing.required_file.name_on_disk))
+        FileModel = SingleFile.required_file.field.related_model
+        FileModel.objects.update(size=None, checksum='', stored_at=None)
+
+        call_command('files_backfill_metadata', stdout=StringIO())
+
+        file_instance = FileModel.objects.get(pk=obj.required_file.pk)
+        self.assertEqual(os.path.getsize(self.file_cat), file_instance.size)
+        self.assertEqual(self._cat_checksum(), file_instance.checksum)
+        self.assertEqual(file_instance.modified_on, file_instance.stored_at)
+
+        missing_instance = FileModel.objects.get(
+            pk=missing.required_file.pk
+        )
+        self.assertIsNone(missing_instance.stored_at)
+        self.assertFalse(missing_instance.get_file_wrapper())
+
+
+class WithFilesTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+    file_dog = 'dev_files/test_files/dog.jpg'
+
+    def setUp(self) -> None:
+        super().setUp()
+        for i in range(3):
+            obj = SingleFile()
+            obj.required_file = File(open(self.file_cat, mode='rb'))
+            if i:
+                obj.nullable_file = File(open(self.file_dog, mode='rb'))
+            obj.save()
+
+            tracked = TrackedFile.objects.create()
+            tracked.files.add(File(open(self.file_cat, mode='rb')))
+            tracked.files.add(File(open(self.file_dog, mode='rb')))
+        TrackedFile.objects.create()
+
+    def test_file_fields(self):
+        # One query for the objects, one per field
+        with self.assertNumQueries(3):
+            objects = list(SingleFile.objects.with_files())
+            for obj in objects:
+                self.assertEqual(self.file_cat, obj.required_file.name)
+                self.assertEqual(
+                    os.path.getsize(self.file_cat),
+                    obj.required_file.size
+                )
+                self.assertTrue(obj.required_file)
+                if obj.nullable_file is not None:
+                    self.assertEqual(self.file_dog, obj.nullable_file.name)
+        self.assertEqual(
+            2,
+            len([obj for obj in objects if obj.nullable_file is not None])
+        )
+
+        with self.assertNumQueries(2):
+            for obj in SingleFile.objects.with_files('required_file'):
+                self.assertTrue(obj.required_file)
+
+    def test_tracked_file_fields(self):
+        with self.assertNumQueries(2):
+            objects = list(TrackedFile.objects.with_files('files'))
+            for obj in objects:
+                files = list(obj.files.all)
+                if not files:
+                    self.assertIsNone(obj.files.current_file)
+                    continue
+                self.assertEqual(
+                    [self.file_dog, self.file_cat],
+                    [file.name for file in files]
+                )
+                self.assertEqual(files[0], obj.files.current_file)
+
+        # Changes after prefetching should still be visible
+        obj = objects[0]
+        cat = list(obj.files.all)[1]
+        obj.files.delete(cat)
+        self.assertEqual(1, len(list(obj.files.all)))
+        obj.files.add(File(open(self.file_cat, mode='rb')))
+        self.assertEqual(2, len(list(obj.files.all)))
+        self.assertEqual(self.file_cat, obj.files.current_file.name)
+
+    def test_with_files_is_chainable(self):
+        queryset = SingleFile.objects.with_files('required_file')
+        self.assertEqual(
+            ('required_file', 'nullable_file'),
+            queryset.with_files('nullable_file')._file_fields
+        )
+        self.assertIsNone(queryset.with_files(None)._file_fields)
+        self.assertEqual(
+            ('required_file',),
+            queryset.filter(pk__gt=0).order_by('pk')._file_fields
+        )
+        with self.assertRaises(ValueError):
+            list(SingleFile.objects.with_files('id'))
+
+
+class TrackedFileHistoryTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+    file_dog = 'dev_files/test_files/dog.jpg'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.obj = TrackedFile.objects.create()
+        for i in range(5):
+            self.obj.files.add(
+                File(open(self.file_cat if i % 2 else self.file_dog, 'rb'))
+            )
+        # Files of other owners should not show up
+        TrackedFile.objects.create().files.add(
+            File(open(self.file_cat, mode='rb'))
+        )
+
+    def test_history_pages(self):
+        obj = TrackedFile.objects.get(pk=self.obj.pk)
+        expected = [file.uuid for file in obj.files.all]
+
+        with self.assertNumQueries(1):
+            first = obj.files.history(limit=2)
+            self.assertEqual(
+                [self.file_dog, self.file_cat],
+                [version.file.name for version in first]
+            )
+            self.assertEqual([True, False], [v.current for v in first])
+            for version in first:
+                self.assertIsNone(version.file.created_by)
+                self.assertIsNotNone(version.file.created_on)
+
+        second = obj.files.history(limit=2, before=first[-1])
+        third = obj.files.history(limit=2, before=second[-1].cursor)
+        self.assertEqual(1, len(third))
+        self.assertEqual(
+            expected,
+            [version.file.uuid for version in first + second + third]
+        )
+        self.assertEqual([], obj.files.history(before=third[-1]))
+        self.assertEqual(expected, [
+            version.file.uuid for version in obj.files.history(limit=None)
+        ])
+
+    def test_all_is_paged(self):
+        from cdh.files.db.wrappers import TrackedFileWrapper
+
+        obj = TrackedFile.objects.get(pk=self.obj.pk)
+        expected = [
+            version.file.uuid for version in obj.files.history(limit=None)
+        ]
+
+        with mock.patch.object(TrackedFileWrapper, 'ALL_PAGE_SIZE', 2):
+            # Only the first page is fetched until more is needed
+            with self.assertNumQueries(1):
+                self.assertEqual(expected[0], next(obj.files.all).uuid)
+            with self.assertNumQueries(3):
+                self.assertEqual(
+                    expected,
+                    [file.uuid for file in obj.files.all]
+                )
+
+    def test_history_follows_current(self):
+        obj = TrackedFile.objects.get(pk=self.obj.pk)
+        oldest = obj.files.history(limit=None)[-1].file
+        obj.files.set_as_current(oldest)
+
+        history = obj.files.history(limit=None)
+        self.assertEqual(
+            [version.file.uuid == oldest.uuid for version in history],
+            [version.current for version in history]
+        )
+
+    def test_widget_renders_latest_page(self):
+        response = self.client.get(
+            reverse('dev_files:tracked_update', args=[self.obj.pk])
+        )
+        self.assertEqual(
+            5,
+            response.content.decode().count('uil-files-existing-file"')
+        )
+
+
+class ZipArchiveTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+    file_dog = 'dev_files/test_files/dog.jpg'
+
+    def _read(self, path):
+        with open(path, mode='rb') as file:
+            return file.read()
+
+    def _zip(self, files, chunk_size=None):
+        return zipfile.ZipFile(io.BytesIO(b''.join(
+            stream_zip(files, chunk_size=chunk_size)
+        )))
+
+    def test_stream_zip(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.nullable_file = ContentFile(b'cat ' * 1000, name='notes.txt')
+        obj.save()
+
+        chunks = list(stream_zip(
+            [obj.required_file, obj.nullable_file],
+            chunk_size=256
+        ))
+        # Streamed as the files are read, instead of in one go
+        self.assertGreater(len(chunks), 10)
+        self.assertLessEqual(max(len(chunk) for chunk in chunks[:-1]), 1024)
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        self.assertIsNone(archive.testzip())
+        cat, notes = archive.infolist()
+        # The name of the original file includes directories
+        self.assertEqual(self.file_cat.replace('/', '_'), cat.filename)
+        # PNGs are already compressed, text is not
+        self.assertEqual(zipfile.ZIP_STORED, cat.compress_type)
+        self.assertEqual(zipfile.ZIP_DEFLATED, notes.compress_type)
+        self.assertLess(notes.compress_size, notes.file_size)
+        self.assertEqual(self._read(self.file_cat), archive.read(cat))
+        self.assertEqual(b'cat ' * 1000, archive.read(notes))
+
+    def test_names(self):
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        file = obj.required_file.file_instance
+
+        archive = self._zip([
+            ('cats/cat.png', file),
+            ('cats/cat.png', file),
+            ('CATS/CAT.PNG', obj.required_file),
+        ])
+        self.assertEqual(
+            ['cats/cat.png', 'cats/cat (2).png', 'CATS/CAT (3).PNG'],
+            archive.namelist()
+        )
+
+    def test_tracked_history_view(self):
+        obj = TrackedFile.objects.create()
+        obj.files.add(File(open(self.file_cat, mode='rb')))
+        obj.files.add(File(open(self.file_dog, mode='rb')))
+
+        response = self.client.get(
+            reverse('dev_files:tracked_zip', args=[obj.pk])
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/zip', response['Content-Type'])
+        self.assertIn(f"tracked-{obj.pk}.zip", response['Content-Disposition'])
+
+        archive = zipfile.ZipFile(
+            io.BytesIO(b''.join(response.streaming_content))
+        )
+        self.assertEqual(
+            [self._read(self.file_dog), self._read(self.file_cat)],
+            [archive.read(name) for name in archive.namelist()]
+        )
+
+    def test_compressed_content_types(self):
+        self.assertTrue(is_compressed('image/jpeg'))
+        self.assertTrue(is_compressed('application/zip'))
+        self.assertTrue(is_compressed(
+            'application/vnd.openxmlformats-officedocument.'
+            'wordprocessingml.document'
+        ))
+        self.assertFalse(is_compressed('image/svg+xml'))
+        self.assertFalse(is_compressed('text/plain'))
+        self.assertFalse(is_compressed('application/zip-ish'))
+        self.assertFalse(is_compressed(''))
+
+
+class DeferredDeletionTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+    file_dog = 'dev_files/test_files/dog.jpg'
+
+    def _create_tracked(self):
+        obj = TrackedFile.objects.create()
+        for file in [self.file_cat, self.file_dog, self.file_cat]:
+            obj.files.add(File(open(file, mode='rb')))
+        return obj
+
+    def test_files_are_removed_on_commit(self):
+        obj = self._create_tracked()
+        self.assertEqual(3, len(self.files_on_disk()))
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            obj.delete()
+            self.assertEqual(3, len(self.files_on_disk()))
+
+        # All files are removed in one batch
+        self.assertEqual(1, len(callbacks))
+        callbacks[0]()
+        self.assertEqual([], self.files_on_disk())
+
+    def test_files_are_kept_on_rollback(self):
+        obj = self._create_tracked()
+        pk = obj.pk
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    obj.delete()
+                    raise RuntimeError()
+
+        self.assertEqual(3, len(self.files_on_disk()))
+        self.assertTrue(TrackedFile.objects.filter(pk=pk).exists())
+
+        # The rolled back batch should not swallow later deletions
+        obj = TrackedFile.objects.get(pk=pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.delete()
+        self.assertEqual([], self.files_on_disk())
+
+    def test_rolled_back_savepoint_is_kept(self):
+        obj = self._create_tracked()
+        kept = obj.files.current_file.name_on_disk
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                with self.assertRaises(RuntimeError):
+                    with transaction.atomic():
+                        obj.delete()
+                        raise RuntimeError()
+                # Removed outside of the rolled back savepoint
+                other = self._create_tracked()
+                other.delete()
+
+        self.assertEqual(3, len(self.files_on_disk()))
+        self.assertIn(kept, self.files_on_disk())
+
+    def test_deletion_worker(self):
+        obj = self._create_tracked()
+
+        settings.DELETION_WORKER = True
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                obj.delete()
+            wait_for_deletions()
+        finally:
+            settings.DELETION_WORKER = False
+
+        self.assertEqual([], self.files_on_disk())
+
+
+class GarbageCollectionTests(TemporaryStorageMixin, TestCase):
+    file_cat = 'dev_files/test_files/cat.png'
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.referenced = SingleFile()
+        self.referenced.required_file = File(open(self.file_cat, mode='rb'))
+        self.referenced.save()
+
+        # Dereference a File behind the back of FileField
+        obj = SingleFile()
+        obj.required_file = File(open(self.file_cat, mode='rb'))
+        obj.nullable_file = File(open(self.file_cat, mode='rb'))
+        obj.save()
+        self.unreferenced_uuid = obj.nullable_file.uuid
+        SingleFile.objects.filter(pk=obj.pk).update(nullable_file=None)
+
+        self.orphan = str(uuid.uuid4())
+        for name in [self.orphan, 'not-ours.txt']:
+            with open(os.path.join(self.root, name), 'wb') as file:
+                file.write(b'orphan')
+
+    def _gc(self, *args):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('files_gc', *args, stdout=out)
+        return out.getvalue()
+
+    def test_unreferenced_rows_query(self):
+        FileModel = SingleFile.required_file.field.related_model
+        self.assertEqual(
+            [self.unreferenced_uuid],
+            list(FileModel.objects.unreferenced().values_list(
+                'uuid',
+                flat=True
+            ))
+        )
+
+    def test_dry_run_and_grace_period(self):
+        before = self.files_on_disk()
+
+        output = self._gc('--dry-run', '--grace-period', '0')
+        self.assertIn('files.File: 1 unreferenced rows (dry run', output)
+        self.assertIn('files: scanned 5, 1 orphaned (dry run', output)
+        self.assertEqual(before, self.files_on_disk())
+
+        self._gc()
+        self.assertEqual(before, self.files_on_disk())
+
+    def test_garbage_collection(self):
+        FileModel = SingleFile.required_file.field.related_model
+
+        self._gc('--grace-period', '0', '--batch-size', '2')
+
+        self.assertFalse(
+            FileModel.objects.filter(uuid=self.unreferenced_uuid).exists()
+        )
+        self.assertEqual(2, FileModel.objects.count())
+        self.assertEqual(
+            sorted(
+                [str(uuid) for uuid in FileModel.objects.values_list(
+                    'uuid',
+                    flat=True
+                )] + ['not-ours.txt']
+            ),
+            self.files_on_disk()
+        )
+        with self.referenced.required_file.open() as file:
+            with open(self.file_cat, mode='rb') as original:
+                self.assertEqual(original.read(), file.read())
+
+
+class TrackedFileIndexTests(TransactionTestCase):
+
+    def test_linking_table_indexes(self):
+        through = TrackedFile.files.through
+        with connection.cursor() as cursor:
+            existing = connection.introspection.get_constraints(
+                cursor,
+                through._meta.db_table
+            )
+        for index in through._meta.indexes + through._meta.constraints:
+            self.assertIn(index.name, existing)
+
+        out = StringIO()
+        call_command('files_add_indexes', stdout=out)
+        self.assertIn('added 0 indexes', out.getvalue())
+
+        with connection.schema_editor() as schema_editor:
+            schema_editor.remove_index(through, through._meta.indexes[0])
+        out = StringIO()
+        call_command('files_add_indexes', stdout=out)
+        self.assertIn('added 1 indexes', out.getvalue())
+
+
+class BenchmarkTests(TemporaryStorageMixin, TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.context = BenchmarkContext()
+
+    def tearDown(self):
+        self.context.close()
+        super().tearDown()
+
+    def test_run_benchmark(self):
+        result = run_benchmark('descriptor-get', self.context, 2)
+
+        self.assertGreater(result['time'], 0)
+        self.assertGreater(result['peak_memory'], 0)
+        self.assertGreater(result['queries'], 0)
+
+    def test_compare(self):
+        baseline = {
+            'bench': {'time': 0.01, 'peak_memory': 2 ** 20, 'queries': 3},
+        }
+
+        self.assertEqual([], compare(
+            {'bench': {'time': 0.011, 'peak_memory': 2 ** 20, 'queries': 3}},
+            baseline,
+            0.25
+        ))
+        # Unknown benchmarks are not compared
+        self.assertEqual([], compare(
+            {'other': {'time': 1, 'peak_memory': 2 ** 30, 'queries': 100}},
+            baseline,
+            0.25
+        ))
+        regressions = compare(
+            {'bench': {'time': 0.02, 'peak_memory': 2 ** 22, 'queries': 4}},
+            baseline,
+            0.25
+        )
+        self.assertEqual(3, len(regressions))
+        self.assertIn('4 queries, was 3', regressions[0])
+        # Only the measurements in the baseline are compared
+        regressions = compare(
+            {'bench': {'time': 0.02, 'peak_memory': 2 ** 22, 'queries': 4}},
+            {'bench': {'queries': 3}},
+            0.25
+        )
+        self.assertEqual(['bench: 4 queries, was 3'], regressions)
+
+    def test_baseline(self):
+        # The committed baseline covers the query counts of every benchmark
+        with open(BASELINE_PATH) as file:
+            baseline = json.load(file)
+        self.assertEqual(set(BENCHMARKS), set(baseline))
+        for result in baseline.values():
+            self.assertIsInstance(result['queries'], int)
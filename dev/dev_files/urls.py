@@ -1,13 +1,15 @@
 from django.urls import path
 
-from .views import CustomFileView, CustomSingleFileCreateView, \
+from .views import AsyncFieldLimitedSingleFileView, AsyncFileView, \
+    CustomFileView, CustomSingleFileCreateView, \
     CustomSingleFileListView, \
     CustomSingleFileUpdateView, CustomTrackedFileListView, \
-    FieldLimitedSingleFileView, FieldLimitedTrackedFileView, FileView, \
+    FieldLimitedSingleFileView, FieldLimitedTrackedFileView, \
+    FileDerivativeView, FileView, \
     SingleFileCreateView, \
     SingleFileListView, SingleFileUpdateView, TrackedCustomFileCreateView, \
     TrackedCustomFileUpdateView, TrackedFileCreateView, \
-    TrackedFileListView, TrackedFileUpdateView
+    TrackedFileListView, TrackedFileUpdateView, TrackedFileZipView
 
 app_name = 'dev_files'
 
@@ -33,13 +35,22 @@ urlpatterns = [
          name='tracked_update'),
     path('custom-tracked/<int:pk>/', TrackedCustomFileUpdateView.as_view(),
          name='customtracked_update'),
+    path('tracked/<int:pk>/zip/', TrackedFileZipView.as_view(),
+         name='tracked_zip'),
 
     path('file/<uuid:uuid>/', FileView.as_view(), name='file_view'),
+    path('file/<uuid:uuid>/<slug:spec>/', FileDerivativeView.as_view(),
+         name='file_derivative_view'),
     path('custom-file/<uuid:uuid>/', CustomFileView.as_view(),
          name='custom_file_view'),
     path('field-limited-file/<uuid:uuid>/',
          FieldLimitedSingleFileView.as_view(),
          name='field_limited_file_view'),
+    path('async-file/<uuid:uuid>/', AsyncFileView.as_view(),
+         name='async_file_view'),
+    path('async-field-limited-file/<uuid:uuid>/',
+         AsyncFieldLimitedSingleFileView.as_view(),
+         name='async_field_limited_file_view'),
     path('field-limited-tracked-file/<uuid:uuid>/',
          FieldLimitedTrackedFileView.as_view(),
          name='field_limited_tracked_file_view'),
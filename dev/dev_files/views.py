@@ -1,7 +1,10 @@
+from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.views import generic
 
-from cdh.files.views import BaseFieldLimitedFileView, BaseFileView
+from cdh.files.views import AsyncBaseFieldLimitedFileView, \
+    AsyncBaseFileView, BaseFieldLimitedFileView, BaseFileView, BaseZipView, \
+    DerivativeViewMixin
 
 from .models import CustomFile, SingleFile, CustomSingleFile, TrackedCustomFile, \
     TrackedFile
@@ -74,6 +77,10 @@ class FileView(BaseFileView):
     pass
 
 
+class FileDerivativeView(DerivativeViewMixin, FileView):
+    pass
+
+
 class CustomFileView(FileView):
     file_class = CustomFile
 
@@ -88,6 +95,25 @@ class FieldLimitedTrackedFileView(BaseFieldLimitedFileView):
     model_field_name = 'files'
 
 
+class AsyncFileView(AsyncBaseFileView):
+    pass
+
+
+class AsyncFieldLimitedSingleFileView(AsyncBaseFieldLimitedFileView):
+    model = SingleFile
+    model_field_name = 'required_file'
+
+
+class TrackedFileZipView(BaseZipView):
+
+    def get_files(self):
+        obj = get_object_or_404(TrackedFile, pk=self.kwargs['pk'])
+        return obj.files.history(limit=None)
+
+    def get_archive_name(self) -> str:
+        return f"tracked-{self.kwargs['pk']}.zip"
+
+
 class TrackedFileListView(generic.ListView):
     model = TrackedFile
 
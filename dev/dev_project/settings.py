@@ -190,6 +190,13 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 
+# CDH Files
+
+CDH_FILES_STORAGES = {
+    'archive': 'dev_files.storage.ArchiveStorage',
+}
+
+
 # Security
 # https://docs.djangoproject.com/en/2.0/topics/security/
 
@@ -0,0 +1,189 @@
+"""Streaming ZIP archives of multiple files.
+
+stream_zip() builds the archive while it's being sent: every file is read
+from the storage in chunks, which are compressed and yielded right away.
+Nothing is buffered beyond a single chunk and no temporary files are used,
+so memory use is the same for an archive of 1 MB or 100 GB. ZIP64 is used
+where needed, so neither the size of the files nor the number of files is
+limited.
+
+Files whose MIME type indicates they are already compressed (most images,
+video, audio, archives and office documents) are stored as-is, as
+compressing them again costs a lot of CPU for no gain.
+"""
+import logging
+import os
+import zipfile
+from typing import Iterable, Iterator, Set, Tuple, TYPE_CHECKING, Union
+
+from django.db.models import QuerySet
+from django.utils import timezone
+
+if TYPE_CHECKING:
+    from cdh.files.db import BaseFile
+    from cdh.files.db.wrappers import FileWrapper, TrackedFileVersion
+
+logger = logging.getLogger('cdh.files')
+
+# MIME types (or prefixes thereof, ending in a / or .) that are not worth
+# compressing again
+COMPRESSED_CONTENT_TYPES = (
+    'image/',
+    'video/',
+    'audio/',
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-7z-compressed',
+    'application/x-rar',
+    'application/vnd.rar',
+    'application/zstd',
+    'application/pdf',
+    'application/epub+zip',
+    'application/vnd.openxmlformats-officedocument.',
+    'application/vnd.oasis.opendocument.',
+)
+
+# Exceptions to the above; uncompressed formats with a compressed sibling
+UNCOMPRESSED_CONTENT_TYPES = (
+    'image/bmp',
+    'image/svg+xml',
+    'image/tiff',
+    'image/x-ms-bmp',
+    'audio/wav',
+    'audio/x-wav',
+)
+
+
+def is_compressed(content_type: str) -> bool:
+    """Whether files of the given MIME type are already compressed"""
+    content_type = (content_type or '').lower()
+    if content_type in UNCOMPRESSED_CONTENT_TYPES:
+        return False
+    return any(
+        content_type.startswith(compressed) if compressed.endswith(('/', '.'))
+        else content_type == compressed
+        for compressed in COMPRESSED_CONTENT_TYPES
+    )
+
+
+class _DrainableBuffer:
+    """Write-only file-like object collecting what ZipFile writes, until
+    it's drained. As it cannot seek, ZipFile will use data descriptors
+    instead of going back to fill in sizes and checksums."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _get_wrappers(files) -> Iterator[Tuple[str, 'FileWrapper']]:
+    """Yields (name, FileWrapper) pairs for everything stream_zip accepts"""
+    # Local import to prevent cycles
+    from cdh.files.db import BaseFile
+    from cdh.files.db.wrappers import FileWrapper, TrackedFileVersion
+
+    if isinstance(files, QuerySet):
+        files = files.iterator()
+
+    for file in files:
+        name = None
+        if isinstance(file, tuple) and not isinstance(
+                file,
+                TrackedFileVersion
+        ):
+            name, file = file
+        if isinstance(file, TrackedFileVersion):
+            file = file.file
+        if isinstance(file, BaseFile):
+            file = file.get_file_wrapper(only_existing=False)
+        if not isinstance(file, FileWrapper):
+            raise ValueError(f"Cannot add {file!r} to an archive")
+
+        if name is None:
+            # Generated names are not meant to be paths
+            name = file.name.replace('/', '_').replace('\\', '_')
+        yield name, file
+
+
+def _unique_name(name: str, used: Set[str]) -> str:
+    """Appends a number to the given name if it's already used"""
+    unique_name = name
+    base, extension = os.path.splitext(name)
+    number = 1
+    while unique_name.lower() in used:
+        number += 1
+        unique_name = f"{base} ({number}){extension}"
+    used.add(unique_name.lower())
+    return unique_name
+
+
+def stream_zip(
+        files: Iterable[Union[
+            'BaseFile',
+            'FileWrapper',
+            'TrackedFileVersion',
+            Tuple[str, Union['BaseFile', 'FileWrapper']],
+        ]],
+        chunk_size: int = None,
+) -> Iterator[bytes]:
+    """Generator yielding a ZIP archive of the given files, see the module
+    documentation.
+
+    :param files: A queryset of File models, or an iterable of Files,
+                  FileWrappers, TrackedFileVersions (e.g. from
+                  TrackedFileWrapper.history(None)), or (name, file) pairs
+                  to put a file in the archive under a different name. Names
+                  may contain slashes to place files in directories.
+                  Duplicate names get a number appended.
+    :param chunk_size: The size of the chunks files are read in
+    """
+    buffer = _DrainableBuffer()
+    used_names = set()
+
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+        for name, file_wrapper in _get_wrappers(files):
+            if not file_wrapper:
+                logger.warning(
+                    f"Leaving {file_wrapper.name_on_disk} out of the archive, "
+                    f"as it has no contents"
+                )
+                continue
+
+            modified_on = file_wrapper.modified_on or timezone.now()
+            if timezone.is_aware(modified_on):
+                modified_on = timezone.localtime(modified_on)
+            info = zipfile.ZipInfo(
+                _unique_name(name, used_names),
+                date_time=modified_on.timetuple()[:6],
+            )
+            info.compress_type = zipfile.ZIP_STORED if \
+                is_compressed(file_wrapper.content_type) else \
+                zipfile.ZIP_DEFLATED
+            size = file_wrapper.file_instance.size
+            info.file_size = size or 0
+
+            # Without a recorded size, we can't know whether the entry needs
+            # ZIP64 until it's too late
+            with archive.open(info, 'w', force_zip64=size is None) as entry:
+                for chunk in file_wrapper.stream(chunk_size=chunk_size):
+                    entry.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+
+    # The last entry's data descriptor and the central directory
+    yield buffer.drain()
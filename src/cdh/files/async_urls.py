@@ -0,0 +1,13 @@
+from django.urls import path
+
+from .views import AsyncUploadSessionCreateView, AsyncUploadSessionView
+
+# Drop-in replacement for cdh.files.urls for sites running under ASGI
+app_name = 'cdh.files'
+
+urlpatterns = [
+    path('uploads/', AsyncUploadSessionCreateView.as_view(),
+         name='upload_create'),
+    path('uploads/<uuid:uuid>/', AsyncUploadSessionView.as_view(),
+         name='upload_session'),
+]
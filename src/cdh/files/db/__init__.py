@@ -1,2 +1,4 @@
 from .fields import FileField, TrackedFileField
-from .models import File, BaseFile
+from .models import Blob, File, BaseFile, UnlinkedFile, UploadSession
+from .manager import WithFilesManager, WithFilesQuerySet, \
+    WithFilesQuerySetMixin, prefetch_files
@@ -6,6 +6,7 @@ from django.db.models.fields.related_descriptors import \
     ReverseManyToOneDescriptor
 from django.utils.functional import cached_property
 
+from cdh.files.db.dispatch import mark_files_changed
 from cdh.files.db.manager import create_tracked_file_manager
 from cdh.files.db.wrappers import FileWrapper, TrackedFileWrapper
 
@@ -68,8 +69,12 @@ class ForwardFileDescriptor(ForwardManyToOneDescriptor):
 
             return file_wrapper
         except KeyError:
-            # Try to fetch it from the DB instead
-            file_obj = self.get_object(instance)
+            # Try to fetch it from the DB instead, unless we already know
+            # there's nothing to fetch
+            if None in self.field.get_local_related_value(instance):
+                file_obj = None
+            else:
+                file_obj = self.get_object(instance)
 
         # From this point on we are dealing with a fresh non-cached File object
 
@@ -130,6 +135,8 @@ class ForwardFileDescriptor(ForwardManyToOneDescriptor):
             )
 
         self.field.set_cached_value(instance, return_value)
+        # Files might need to be saved or removed on the next save
+        mark_files_changed(instance)
 
         if return_value is None or return_value._removed:
             # If we got returned None, or a FileWrapper marked for deletion, we
@@ -205,8 +212,11 @@ class ForwardFileDescriptor(ForwardManyToOneDescriptor):
         # say in whether it's actually deleted. (It might be referenced by a
         # different FileField).
         if uuid:
-            old_obj = self.field.remote_field.model.objects.get(uuid=uuid)
-            old_file_wrapper = old_obj.get_file_wrapper(self.field)
+            # Forms using a FileResolver have already cached it for us
+            old_file_wrapper = self._get_cached_by_uuid(instance, uuid)
+            if old_file_wrapper is None:
+                old_obj = self.field.remote_field.model.objects.get(uuid=uuid)
+                old_file_wrapper = old_obj.get_file_wrapper(self.field)
             old_file_wrapper._removed = True
             # Cache it, so the field can remove it later on save
             # The new FW will be set later in the chain, so this cached value
@@ -221,7 +231,9 @@ class ForwardFileDescriptor(ForwardManyToOneDescriptor):
 
         file_wrapper = obj.get_file_wrapper(self.field, False)
 
+        # The wrapper copied the (still empty) name from the File
         obj.original_filename = file.name
+        file_wrapper.original_filename = file.name
         file_wrapper.file = file
         file_wrapper._committed = False  # Mark the wrapper as need-to-save
         file_wrapper._removed = False  # Just to be safe. There _should_ be
@@ -229,6 +241,15 @@ class ForwardFileDescriptor(ForwardManyToOneDescriptor):
 
         return file_wrapper
 
+    def _get_cached_by_uuid(self, instance, uuid):
+        """Returns the cached FileWrapper with the given UUID, or None"""
+        file_wrapper = self.field.get_cached_value(instance, None)
+        if file_wrapper is None or file_wrapper.file_instance is None:
+            return None
+        if str(file_wrapper.uuid) != str(uuid):
+            return None
+        return file_wrapper
+
     def _set_from_file_wrapper(self, instance, value):
         """Set this field's value from an existing FileWrapper
 
@@ -0,0 +1,95 @@
+"""Hands the save and delete signals of a model to its file fields.
+
+Every model with file fields gets one FileSignalDispatcher, which receives
+post_save, pre_delete and post_delete once per instance and passes them on
+to all FileFields and TrackedFileFields of the model. File models get their
+files removed from the storage by it as well. This replaces one set of
+receivers per field, which made every save pay for a signal dispatch per
+field.
+
+Saving only needs work if a FileField was assigned to since the last save,
+as only then files might need to be removed. ForwardFileDescriptor marks the
+instance when that happens, so the dispatcher can skip all other saves.
+
+The files removed while handling one signal are removed in one batch once
+the transaction commits, see cdh.files.deletion.
+"""
+from django.db.models.signals import post_delete, post_save, pre_delete
+
+from ..deletion import deletion_batch
+
+
+def mark_files_changed(instance) -> None:
+    """Marks the FileFields of the instance as assigned to, so they are
+    processed on the next save"""
+    instance._state.files_changed = True
+
+
+def files_changed(instance) -> bool:
+    return getattr(instance._state, 'files_changed', False)
+
+
+class FileSignalDispatcher:
+
+    def __init__(self, model):
+        self.model = model
+        self.file_fields = []
+        self.tracked_file_fields = []
+        # Whether the model is a File model, whose file in the storage should
+        # be removed along with it
+        self.is_file_model = False
+
+        # Strong references; we're kept alive by the registry anyway
+        post_save.connect(self.post_save, sender=model, weak=False)
+        pre_delete.connect(self.pre_delete, sender=model, weak=False)
+        post_delete.connect(self.post_delete, sender=model, weak=False)
+
+    def add_file_field(self, field) -> None:
+        if field not in self.file_fields:
+            self.file_fields.append(field)
+
+    def add_tracked_file_field(self, field) -> None:
+        if field not in self.tracked_file_fields:
+            self.tracked_file_fields.append(field)
+
+    def post_save(self, sender, instance, created, **kwargs):
+        if not self.file_fields or not files_changed(instance):
+            return
+
+        with deletion_batch(kwargs.get('using')):
+            for field in self.file_fields:
+                field.post_save(sender, instance, created, **kwargs)
+        instance._state.files_changed = False
+
+    def pre_delete(self, sender, instance, **kwargs):
+        with deletion_batch(kwargs.get('using')):
+            for field in self.file_fields:
+                field.pre_delete(sender, instance, **kwargs)
+            for field in self.tracked_file_fields:
+                field.pre_delete(sender, instance, **kwargs)
+
+            if self.is_file_model:
+                # save=False means we will only touch the file on disk,
+                # leaving the DB object alone. (That will obviously be
+                # handled by the ORM, so we don't want to delete it
+                # prematurely)
+                # force=True means we will ALWAYS delete the file, even if
+                # the ORM still sees some references to it
+                instance.get_file_wrapper().delete(save=False, force=True)
+
+    def post_delete(self, sender, instance, **kwargs):
+        with deletion_batch(kwargs.get('using')):
+            for field in self.file_fields:
+                field.post_delete(sender, instance, **kwargs)
+
+
+_dispatchers = {}
+
+
+def get_dispatcher(model) -> FileSignalDispatcher:
+    """Returns the dispatcher of the given model, creating it if needed"""
+    try:
+        return _dispatchers[model]
+    except KeyError:
+        dispatcher = _dispatchers[model] = FileSignalDispatcher(model)
+        return dispatcher
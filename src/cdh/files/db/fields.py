@@ -2,22 +2,23 @@ from functools import partial
 
 from django.core import checks, exceptions
 from django.db import router
+from django.db.backends.utils import names_digest
 from django.db.models import ForeignObject, ForeignObjectRel, ManyToOneRel, \
     CASCADE, SET_DEFAULT, \
     SET_NULL
 from django.db.models.fields.related import ManyToManyField, \
     RECURSIVE_RELATIONSHIP_CONSTANT, lazy_related_operation, resolve_relation
 from django.db.models.query_utils import PathInfo
-from django.db.models.signals import post_delete, post_save, pre_delete
 from django.db.models.utils import make_model_tuple
-from django.dispatch import receiver
 from django.utils.hashable import make_hashable
 from django.utils.translation import gettext_lazy as _
 from cdh.core.collections import IndexedOrderedSet
 
 from .descriptors import FileDescriptor, ForwardFileDescriptor, \
     TrackedFileDescriptor
+from .dispatch import get_dispatcher
 from ..forms import fields
+from ..utils import StorageRegistry
 from .models import BaseFile, File
 from .wrappers import FileWrapper, TrackedFileWrapper
 
@@ -130,7 +131,7 @@ class FileField(FileFieldCacheMixin, ForeignObject):
 
     def __init__(self, to=None, on_delete=None, to_field=None, db_constraint=True,
                  filename_generator: callable = None, url_pattern: str = None,
-                 **kwargs):
+                 storage: str = None, **kwargs):
         """
 
         :param to: A File-like model.
@@ -143,6 +144,9 @@ class FileField(FileFieldCacheMixin, ForeignObject):
                                    this isn't saved anywhere! Changing the
                                    callable will change the name of all
                                    existing files
+        :param storage: The name of the storage to store files in, as
+                        configured in CDH_FILES_STORAGES. Defaults to
+                        CDH_FILES_STORAGE
         :param kwargs: See Django docs for ForeignKey
         """
         if to is None:
@@ -196,6 +200,7 @@ class FileField(FileFieldCacheMixin, ForeignObject):
         )
         self.db_constraint = db_constraint
         self.url_pattern = url_pattern
+        self.storage_name = storage
 
     def check(self, **kwargs):
         return [
@@ -205,6 +210,7 @@ class FileField(FileFieldCacheMixin, ForeignObject):
             *self._check_attr_class_subclass(),
             *self._check_basefile_subclass(),
             *self._check_file_subclass(),
+            *self._check_storage(),
         ]
 
     def _check_on_delete(self):
@@ -270,6 +276,22 @@ class FileField(FileFieldCacheMixin, ForeignObject):
              self.remote_field.model != File \
             else []
 
+    def _check_storage(self):
+        if self.storage_name is None:
+            return []
+        try:
+            StorageRegistry.get_path(self.storage_name)
+        except exceptions.ImproperlyConfigured:
+            return [
+                checks.Error(
+                    f"The storage '{self.storage_name}' is not configured",
+                    hint='Please add it to CDH_FILES_STORAGES',
+                    obj=self,
+                    id='cdh.files.E003',
+                )
+            ]
+        return []
+
     def _check_basefile_subclass(self):
         return [
             checks.Warning(
@@ -461,19 +483,17 @@ class FileField(FileFieldCacheMixin, ForeignObject):
         # that need to be deleted
         if self.is_cached(instance):
             value = self.get_cached_value(instance, None)
-            num_references = value.file_instance._num_child_instances
             # Delete the File if no other object is referencing it
-            if value is not None and num_references == 0:
+            if value is not None and \
+                    value.file_instance._num_child_instances == 0:
                 value.delete()
 
     def contribute_to_class(self, *args, **kwargs):
         super().contribute_to_class(*args, **kwargs)
-        # Connect ourselves to some signals;
+        # Have our model's dispatcher call our signal handlers;
         # Fields really ought to have these methods themselves Django,
         # you already provide the pre_save method!
-        post_save.connect(self.post_save, sender=self.model)
-        pre_delete.connect(self.pre_delete, sender=self.model)
-        post_delete.connect(self.post_delete, sender=self.model)
+        get_dispatcher(self.model).add_file_field(self)
 
     def formfield(self, *, using=None, **kwargs):
         if isinstance(self.remote_field.model, str):
@@ -485,6 +505,7 @@ class FileField(FileFieldCacheMixin, ForeignObject):
             'form_class': fields.FileField,
             'max_length': self.max_length,
             'queryset':   self.remote_field.model._default_manager.using(using),
+            'storage':    self.storage_name,
             **kwargs,
         })
 
@@ -537,12 +558,41 @@ def create_tracked_file_intermediary_model(field, cls, file_kwargs: dict):
     to = make_model_tuple(to_model)[1]
     from_ = cls._meta.model_name
 
+    db_table = field._get_m2m_db_table(cls._meta)
+    # Index names are limited to 30 characters, so we can't use the table name
+    index_prefix = f'cdh_tff_{names_digest(db_table, length=8)}'
+
     meta = type('Meta', (), {
-        'db_table': field._get_m2m_db_table(cls._meta),
+        'db_table': db_table,
         'auto_created': cls,
         'app_label': cls._meta.app_label,
         'db_tablespace': cls._meta.db_tablespace,
         'unique_together': (from_, to),
+        # Finding the current file of an owner is the most common lookup.
+        # The partial unique index also guarantees there's only one, on
+        # databases supporting it; Django skips it on others (MySQL,
+        # Oracle), where TrackedFileWrapper locks the links of the owner
+        # instead
+        'indexes': [
+            models.Index(
+                fields=[from_, 'current'],
+                name=f'{index_prefix}_cur_idx',
+            ),
+            # Used for paginating the history; links are numbered in the
+            # order they were added, so they're paged on their id instead of
+            # the created_on of the file, which this table doesn't have
+            models.Index(
+                fields=[from_, 'id'],
+                name=f'{index_prefix}_hist_idx',
+            ),
+        ],
+        'constraints': [
+            models.UniqueConstraint(
+                fields=[from_],
+                condition=models.Q(current=True),
+                name=f'{index_prefix}_one_cur',
+            ),
+        ],
         'verbose_name': _('%(from)s-%(to)s relationship') % {'from': from_, 'to': to},
         'verbose_name_plural': _('%(from)s-%(to)s relationships') % {'from': from_, 'to': to},
         'apps': field.model._meta.apps,
@@ -570,37 +620,6 @@ def create_tracked_file_intermediary_model(field, cls, file_kwargs: dict):
         )
     })
 
-    @receiver(pre_delete, sender=cls)
-    def cascade_file_m2m_delete(sender, instance, **kwargs):
-        """
-        Django does not propagate m2m deletion to the other side of the
-        relation (as in most cases, it's not needed or wanted). However,
-        in our case we actually want to delete the other side's objects as
-        well. Otherwise, we'd get files that do not belong to any other model,
-        which at best is a waste of space and at worst an AVG violation.
-
-        The easiest method to do this, is just to attach a signal listener on
-        the parent model and manually delete the other side. (Trust me,
-        this is by far the easiest!)
-
-        As we need to listen to the model we try to link to files, we cannot
-        create this signal receiver in the signals file. Thus, we attach it
-        right after creating the linking model.
-        """
-        # `field` comes from the method containing this method
-        # Is used to retrieve the right wrapper by it's owner field's
-        # accessor name
-        wrapper = getattr(
-            instance,
-            field.attname,
-            None,
-        )
-
-        # Should not really happen... *crosses fingers**
-        if wrapper:
-            for file in wrapper.all:
-                file.delete()
-
     return new_cls
 
 
@@ -662,7 +681,8 @@ class TrackedFileField(ManyToManyField):
     def __init__(self, to=None, related_name=None, related_query_name=None,
                  limit_choices_to=None, file_kwargs: dict = None,
                  db_constraint=True, db_table=None,
-                 swappable=True, url_pattern: str = None, **kwargs):
+                 swappable=True, url_pattern: str = None,
+                 storage: str = None, **kwargs):
         if to is None:
             to = File
         if file_kwargs is None:
@@ -670,6 +690,8 @@ class TrackedFileField(ManyToManyField):
 
         self.url_pattern = url_pattern
         file_kwargs['url_pattern'] = url_pattern
+        self.storage_name = storage
+        file_kwargs['storage'] = storage
 
         if related_name is None:
             related_name = f"TFF_{id(self)}"
@@ -751,6 +773,8 @@ class TrackedFileField(ManyToManyField):
                 self.file_kwargs,
             )
 
+            get_dispatcher(cls).add_tracked_file_field(self)
+
         # Add the descriptor for the m2m relation.
         setattr(
             cls,
@@ -761,6 +785,31 @@ class TrackedFileField(ManyToManyField):
         # Set up the accessor for the m2m table name for the relation.
         self.m2m_db_table = partial(self._get_m2m_db_table, cls._meta)
 
+    def pre_delete(self, sender, instance, **kwargs):
+        """
+        Django does not propagate m2m deletion to the other side of the
+        relation (as in most cases, it's not needed or wanted). However,
+        in our case we actually want to delete the other side's objects as
+        well. Otherwise, we'd get files that do not belong to any other model,
+        which at best is a waste of space and at worst an AVG violation.
+
+        The easiest method to do this, is just to listen to the deletion of
+        the parent model and manually delete the other side. (Trust me,
+        this is by far the easiest!) Called by the model's
+        FileSignalDispatcher.
+        """
+        # Retrieve the right wrapper by it's owner field's accessor name
+        wrapper = getattr(
+            instance,
+            self.attname,
+            None,
+        )
+
+        # Should not really happen... *crosses fingers**
+        if wrapper:
+            for file in wrapper.all:
+                file.delete()
+
     def contribute_to_related_class(self, cls, related):
         # Set up the accessors for the column names on the m2m table.
         self.m2m_column_name = partial(self._get_m2m_attr, related, 'column')
@@ -1,7 +1,14 @@
+import os
+from datetime import timedelta
+
 from django.db import models
 from django.db import connections, router, transaction
-from django.db.models import Q, QuerySet, signals
+from django.db.models import F, Q, QuerySet, signals
+from django.db.models.query import ModelIterable
 from django.db.models.utils import resolve_callables
+from django.utils import timezone
+
+from cdh.files import settings
 
 
 class FileManager(models.Manager):
@@ -30,6 +37,341 @@ class FileManager(models.Manager):
             field_name=field.name,
         )
 
+    def unreferenced(self, include_unlinked: bool = False):
+        """Returns a QS of all files no model refers to anymore, determined
+        in SQL. Imported files that are yet to be linked to a model are left
+        out, unless include_unlinked is set; see UnlinkedFile."""
+        # Local import to prevent cycles
+        from cdh.files.db.models import UnlinkedFile
+
+        queryset = self.get_queryset()
+        if not include_unlinked:
+            queryset = queryset.exclude(
+                uuid__in=UnlinkedFile.objects.for_model(
+                    self.model
+                ).values('uuid')
+            )
+        for related_object in self.model._get_reference_relations():
+            field = related_object.field
+            queryset = queryset.filter(~models.Exists(
+                related_object.related_model._base_manager.filter(
+                    **{field.attname: models.OuterRef(
+                        field.target_field.attname
+                    )}
+                )
+            ))
+        return queryset
+
+
+class BlobManager(models.Manager):
+
+    def acquire(self, checksum: str, size: int):
+        """Adds a reference to the blob with the given checksum, creating
+        the blob if it doesn't exist yet. The row stays locked until the
+        surrounding transaction is done, if there is one."""
+        with transaction.atomic(using=self.db):
+            blob, _ = self.select_for_update().get_or_create(
+                checksum=checksum,
+                defaults={
+                    'size': size,
+                }
+            )
+            self.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+            blob.ref_count += 1
+
+        return blob
+
+    def release(self, checksum: str, storage) -> bool:
+        """Removes a reference to the blob with the given checksum. If it was
+        the last reference, the blob is removed from the DB and the storage
+        once the surrounding transaction commits. Until then, the row is kept
+        with a ref_count of 0, so a rollback restores it along with the
+        contents.
+
+        Returns whether this was the last reference."""
+        with transaction.atomic(using=self.db):
+            try:
+                blob = self.select_for_update().get(pk=checksum)
+            except self.model.DoesNotExist:
+                return False
+
+            if blob.ref_count > 1:
+                self.filter(pk=checksum).update(ref_count=F('ref_count') - 1)
+                return False
+
+            self.filter(pk=checksum).update(ref_count=0)
+            transaction.on_commit(
+                lambda: self._remove_unused(checksum, storage),
+                using=self.db
+            )
+
+        return True
+
+    def _remove_unused(self, checksum: str, storage) -> None:
+        """Removes the blob with the given checksum, unless it's been acquired
+        again since it was released"""
+        with transaction.atomic(using=self.db):
+            blob = self.select_for_update().filter(pk=checksum).first()
+            # Gone means another release already removed it; anything it
+            # finds on disk now belongs to whoever stored it again
+            if blob is None or blob.ref_count > 0:
+                return
+
+            # The lock stops acquire() from reusing it while we remove it
+            storage.delete(storage.blob_name(checksum))
+            blob.delete()
+
+
+class UnlinkedFileManager(models.Manager):
+
+    def for_model(self, model):
+        """Returns a QS of the records of Files of the given model"""
+        return self.get_queryset().filter(model=model._meta.label)
+
+    def record(self, model, uuids) -> None:
+        """Records the Files of the given model with the given UUIDs as not
+        linked yet"""
+        self.bulk_create([
+            self.model(model=model._meta.label, uuid=uuid) for uuid in uuids
+        ])
+
+    def release_linked(self, model) -> int:
+        """Removes the records of Files of the given model that are referenced
+        by now (or are gone), returning how many were removed"""
+        unlinked = model.objects.unreferenced(include_unlinked=True)
+        return self.for_model(model).exclude(
+            uuid__in=unlinked.values('uuid')
+        ).delete()[0]
+
+
+class UploadSessionManager(models.Manager):
+
+    def start(self, storage, original_filename: str, size: int,
+              content_type: str = '', created_by=None,
+              storage_name: str = ''):
+        """Starts a new resumable upload, reserving space for it in the
+        storage. storage_name should be the name of the given storage, if
+        it's not the default storage."""
+        if size < 0:
+            raise ValueError("The size of an upload cannot be negative")
+        max_size = settings.CHUNKED_UPLOAD_MAX_SIZE
+        if max_size is not None and size > max_size:
+            raise ValueError(f"Uploads cannot be larger than {max_size} bytes")
+
+        chunk_size = settings.CHUNKED_UPLOAD_CHUNK_SIZE
+        session = self.model(
+            original_filename=original_filename,
+            content_type=content_type,
+            size=size,
+            chunk_size=chunk_size,
+            received='0' * -(-size // chunk_size),
+            created_by=created_by,
+            storage_name=storage_name,
+        )
+
+        path = storage.path(session.stored_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # O_EXCL makes sure we never write into an existing file
+        fd = os.open(path, storage.OS_OPEN_FLAGS, 0o666)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+        try:
+            session.save(force_insert=True)
+        except Exception:
+            storage.delete(session.stored_name)
+            raise
+
+        return session
+
+    def expired(self):
+        """Returns a QS of all sessions that saw no activity for
+        CDH_FILES_CHUNKED_UPLOAD_EXPIRY seconds"""
+        cutoff = timezone.now() - timedelta(
+            seconds=settings.CHUNKED_UPLOAD_EXPIRY
+        )
+        return self.get_queryset().filter(modified_on__lt=cutoff)
+
+    def expire(self, limit: int = None) -> int:
+        """Removes expired sessions and their files, returning how many were
+        removed"""
+        sessions = self.expired().order_by('pk')
+        if limit is not None:
+            sessions = sessions[:limit]
+
+        removed = 0
+        for session in sessions:
+            # Remove the row first; a file without one is garbage anyway
+            if self.filter(pk=session.pk).delete()[0]:
+                session.storage.delete(session.stored_name)
+                removed += 1
+
+        return removed
+
+
+def _get_file_fields(model, field_names):
+    # Local import to prevent cycles
+    from cdh.files.db import FileField, TrackedFileField
+
+    if not field_names:
+        return [
+            field for field in model._meta.get_fields()
+            if isinstance(field, (FileField, TrackedFileField))
+        ]
+
+    fields = []
+    for name in field_names:
+        field = model._meta.get_field(name)
+        if not isinstance(field, (FileField, TrackedFileField)):
+            raise ValueError(
+                f"'{name}' is not a FileField or TrackedFileField on "
+                f"{model._meta.label}"
+            )
+        fields.append(field)
+
+    return fields
+
+
+def _prefetch_file_field(instances, field):
+    """Loads the Files of a FileField for all instances in one query"""
+    file_ids = {
+        getattr(instance, field.attname) for instance in instances
+        if not field.is_cached(instance)
+    }
+    file_ids.discard(None)
+    if not file_ids:
+        return
+
+    target_attname = field.target_field.attname
+    files = {
+        getattr(file, target_attname): file
+        for file in field.remote_field.model.objects.using(
+            instances[0]._state.db
+        ).filter(**{f'{target_attname}__in': file_ids})
+    }
+
+    for instance in instances:
+        if field.is_cached(instance):
+            continue
+        file = files.get(getattr(instance, field.attname))
+        if file is not None:
+            # We know this File is attached to this field, no need to check
+            field.set_cached_value(
+                instance,
+                file.get_file_wrapper(field, only_existing=False)
+            )
+
+
+def _prefetch_tracked_file_field(instances, field):
+    """Loads the Files of a TrackedFileField for all instances in one query,
+    including which of them is current"""
+    through = field.remote_field.through
+    source_field = through._meta.get_field(field.m2m_field_name())
+    file_field = through._meta.get_field(field.m2m_reverse_field_name())
+    file_model = field.remote_field.model
+
+    db = instances[0]._state.db or router.db_for_read(file_model)
+    qn = connections[db].ops.quote_name
+    join_table = qn(through._meta.db_table)
+
+    # Like the prefetch of TrackedFileManager, we can select the columns of
+    # the linking table as it's already joined in
+    queryset = file_model.objects.using(db).filter(**{
+        f'{field.related_query_name()}__in': instances
+    }).extra(select={
+        '_prefetch_owner': f'{join_table}.{qn(source_field.column)}',
+        '_prefetch_current': f'{join_table}.{qn("current")}',
+    }).order_by('-created_on')
+
+    files = {}
+    current = {}
+    for file in queryset:
+        wrapper = file.get_file_wrapper(file_field, only_existing=False)
+        files.setdefault(file._prefetch_owner, []).append(wrapper)
+        if file._prefetch_current:
+            current[file._prefetch_owner] = wrapper
+
+    for instance in instances:
+        owner = getattr(instance, source_field.target_field.attname)
+        tracked_file_wrapper = getattr(instance, field.name)
+        tracked_file_wrapper.cache_value('all', files.get(owner, []))
+        tracked_file_wrapper.cache_value('current', current.get(owner))
+
+
+def prefetch_files(instances, *field_names) -> None:
+    """Loads the files of the given FileFields and TrackedFileFields for all
+    given model instances, using one query per field. If no field names are
+    given, all file fields of the model are loaded.
+
+    Afterwards, accessing these fields on the instances will not hit the
+    database. All instances should be of the same model.
+    """
+    instances = list(instances)
+    if not instances:
+        return
+
+    # Local import to prevent cycles
+    from cdh.files.db import FileField
+
+    for field in _get_file_fields(instances[0].__class__, field_names):
+        if isinstance(field, FileField):
+            _prefetch_file_field(instances, field)
+        else:
+            _prefetch_tracked_file_field(instances, field)
+
+
+class WithFilesQuerySetMixin:
+    """Adds with_files() to a QuerySet; see WithFilesQuerySet"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._file_fields = None
+        self._files_prefetched = False
+
+    def with_files(self, *field_names):
+        """Returns a new QuerySet which loads the files of the given fields
+        (or all file fields, if none are given) in bulk once evaluated.
+
+        Like prefetch_related, with_files(None) clears the list.
+        """
+        clone = self._chain()
+        if field_names == (None,):
+            clone._file_fields = None
+        elif not field_names or clone._file_fields == ():
+            clone._file_fields = ()
+        else:
+            clone._file_fields = (clone._file_fields or ()) + field_names
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._file_fields = self._file_fields
+        return clone
+
+    def _fetch_all(self):
+        super()._fetch_all()
+        if self._file_fields is not None and not self._files_prefetched:
+            if issubclass(self._iterable_class, ModelIterable):
+                prefetch_files(self._result_cache, *self._file_fields)
+            self._files_prefetched = True
+
+
+class WithFilesQuerySet(WithFilesQuerySetMixin, QuerySet):
+    """QuerySet for models with FileFields and/or TrackedFileFields.
+
+    Using with_files(), the files of all returned objects are retrieved in
+    one query per field, instead of one (or more) per object::
+
+        for obj in MyModel.objects.with_files('attachment', 'history'):
+            ...
+    """
+    pass
+
+
+WithFilesManager = models.Manager.from_queryset(WithFilesQuerySet)
+
 
 def create_tracked_file_manager(superclass, rel):
     """
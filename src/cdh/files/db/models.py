@@ -1,12 +1,18 @@
 import logging
+import os
 import uuid
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.functional import cached_property
 
 from cdh.files.db import manager
 from cdh.files.db.wrappers import FileWrapper
+from cdh.files.uploadhandler import ChunkedUploadedFile
+from cdh.files.utils import get_storage
 
 
 logger = logging.getLogger('cdh.files')
@@ -58,31 +64,91 @@ class BaseFile(models.Model):
 
     modified_on = models.DateTimeField(auto_now=True)
 
+    # Only used with a content addressed storage; points to the blob holding
+    # the contents of this file. If empty, the file is stored under its UUID
+    blob = models.ForeignKey(
+        'files.Blob',
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='+',
+    )
+
+    # Filled when the contents are stored, so listings don't need to query
+    # the storage. Rows stored before these were added are left empty until
+    # files_backfill_metadata is run.
+    size = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    # SHA-256 of the contents
+    checksum = models.CharField(max_length=64, blank=True, editable=False)
+
+    stored_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Content-Encoding of the file on disk (e.g. gzip), empty if stored as
+    # is. Set by storages compressing at rest, see CompressedFileStorage.
+    encoding = models.CharField(max_length=20, blank=True, editable=False)
+
+    # The tier of a TieredFileStorage the file is in (hot or cold); always
+    # hot for other storages. Kept up to date by files_tier.
+    tier = models.CharField(
+        max_length=10,
+        default='hot',
+        editable=False,
+    )
+
+    # When files_scrub last checked the contents against the checksum
+    verified_at = models.DateTimeField(null=True, blank=True, editable=False)
+
     _file_wrappers = _FileWrapperDict()
 
-    @property
-    def _num_child_instances(self):
-        out = 0
-        for related_object in self._meta.related_objects:
-            if not related_object or not related_object.related_name:
-                continue
+    @classmethod
+    def _get_reference_relations(cls) -> list:
+        """Returns the relations through which other models can refer to
+        this model"""
+        return [
+            related_object for related_object in cls._meta.related_objects
+            if related_object and related_object.related_name and
+            hasattr(cls, related_object.get_accessor_name())
+        ]
+
+    def _get_reference_counts(self) -> dict:
+        """Returns the number of references to this file per field, using a
+        single query"""
+        relations = self._get_reference_relations()
+        if self.pk is None or not relations:
+            return {related_object.field: 0 for related_object in relations}
+
+        annotations = {}
+        for i, related_object in enumerate(relations):
+            field = related_object.field
+            references = related_object.related_model._base_manager.filter(
+                **{field.attname: OuterRef(field.target_field.attname)}
+            ).order_by().values(field.attname).annotate(
+                num=Count('*')
+            ).values('num')
+            annotations[f'_references_{i}'] = Coalesce(
+                Subquery(references),
+                0
+            )
 
-            related_manager = getattr(self, related_object.related_name, None)
+        counts = self.__class__._base_manager.using(
+            self._state.db
+        ).filter(pk=self.pk).values(**annotations).first() or {}
 
-            if related_manager:
-                qs = related_manager.all()
-                qs._result_cache = None
-                out += qs.count()
+        return {
+            related_object.field: counts.get(f'_references_{i}', 0)
+            for i, related_object in enumerate(relations)
+        }
 
-        return out
+    @property
+    def _num_child_instances(self):
+        return sum(self._get_reference_counts().values())
 
     @property
     def _child_instances(self):
         out = []
-        for related_object in self._meta.related_objects:
-            if not related_object or not related_object.related_name:
-                continue
-
+        for related_object in self._get_reference_relations():
             related_manager = getattr(self, related_object.related_name, None)
 
             if related_manager:
@@ -101,18 +167,21 @@ class BaseFile(models.Model):
 
         return out
 
+    @cached_property
+    def _storage_names(self) -> set:
+        """The names of the storages of the fields that can refer to this
+        model; None is the default storage"""
+        return {
+            getattr(field, 'storage_name', None)
+            for field in self._related_fields
+        }
+
     @property
     def _child_fields(self):
-        out = []
-        for related_object in self._meta.related_objects:
-            if not related_object or not related_object.field:
-                continue
-
-            related_manager = getattr(self, related_object.related_name, None)
-            if related_manager and related_manager.exists():
-                out.append(related_object.field)
-
-        return out
+        return [
+            field for field, count in self._get_reference_counts().items()
+            if count
+        ]
 
     def has_file_wrapper(self, field=None):
         return field in self._file_wrappers and self._file_wrappers[field]
@@ -176,3 +245,196 @@ class BaseFile(models.Model):
 
 class File(BaseFile):
     pass
+
+
+class Blob(models.Model):
+    """Reference counted file contents, used by content addressed storages.
+
+    Files with identical contents share one blob, which is only removed from
+    storage once the last File referencing it is gone.
+    """
+    objects = manager.BlobManager()
+
+    # SHA-256 of the contents, also determines the name on disk
+    checksum = models.CharField(max_length=64, primary_key=True)
+
+    size = models.BigIntegerField()
+
+    ref_count = models.PositiveIntegerField(default=0)
+
+    created_on = models.DateTimeField(auto_now_add=True)
+
+
+class UnlinkedFile(models.Model):
+    """A File imported by cdh.files.ingest that no model refers to yet.
+
+    FileManager.unreferenced() (and thus files_gc) skips these Files, so an
+    import isn't removed before it's linked to your models. files_gc drops
+    the record once the File is referenced, after which it's treated like
+    any other File. Delete the records of an abandoned import to have
+    files_gc clean it up.
+    """
+    objects = manager.UnlinkedFileManager()
+
+    # The label of the File model, e.g. 'files.File'
+    model = models.CharField(max_length=100)
+
+    uuid = models.UUIDField()
+
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('model', 'uuid')
+
+
+class UploadSession(models.Model):
+    """A resumable upload, received in chunks.
+
+    The chunks are written straight into a file in the storage, which is
+    created with the final size when the session starts. Chunks may arrive
+    in any order (and in parallel), and can be sent again if they failed.
+    Once all chunks are in, the upload is completed and can be submitted
+    with a form by its UUID. See cdh.files.views.UploadSessionView.
+    """
+    objects = manager.UploadSessionManager()
+
+    uuid = models.UUIDField(
+        "Universally Unique IDentifier",
+        unique=True,
+        default=uuid.uuid4,
+        editable=False,
+    )
+
+    original_filename = models.CharField(max_length=255)
+
+    # As reported by the client
+    content_type = models.CharField(max_length=100, blank=True)
+
+    size = models.BigIntegerField()
+
+    chunk_size = models.PositiveIntegerField()
+
+    # One character per chunk, '1' once the chunk is received
+    received = models.TextField(blank=True)
+
+    # Filled when the upload is completed
+    checksum = models.CharField(max_length=64, blank=True)
+
+    sniffed_content_type = models.CharField(max_length=100, blank=True)
+
+    completed_on = models.DateTimeField(null=True, blank=True)
+
+    # The storage the upload is written to (see CDH_FILES_STORAGES); empty
+    # for the default storage
+    storage_name = models.CharField(max_length=100, blank=True)
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='+',
+    )
+
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    modified_on = models.DateTimeField(auto_now=True)
+
+    @property
+    def stored_name(self) -> str:
+        return str(self.uuid)
+
+    @property
+    def storage(self):
+        return get_storage(self.storage_name or None)
+
+    @property
+    def missing_chunks(self) -> list:
+        return [
+            index for index, received in enumerate(self.received)
+            if received != '1'
+        ]
+
+    def write_chunk(self, storage, offset: int, stream) -> None:
+        """Writes the chunk starting at the given offset, read from the given
+        stream. Chunks can be written concurrently."""
+        if self.completed_on:
+            raise ValueError("This upload is already completed")
+        if offset < 0 or offset >= self.size or offset % self.chunk_size:
+            raise ValueError(f"{offset} is not the offset of a chunk")
+
+        index = offset // self.chunk_size
+        length = min(self.chunk_size, self.size - offset)
+        written = 0
+        fd = os.open(
+            storage.path(self.stored_name),
+            os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+        )
+        with os.fdopen(fd, 'wb') as file:
+            file.seek(offset)
+            while written < length:
+                data = stream.read(
+                    min(FileWrapper.DEFAULT_CHUNK_SIZE, length - written)
+                )
+                if not data:
+                    break
+                file.write(data)
+                written += len(data)
+
+        # Only mark the chunk as received if we got all of it
+        if written != length or stream.read(1):
+            raise ValueError(
+                f"Chunk {index} should be exactly {length} bytes long"
+            )
+
+        with transaction.atomic():
+            received = UploadSession.objects.select_for_update().values_list(
+                'received',
+                flat=True
+            ).get(pk=self.pk)
+            received = received[:index] + '1' + received[index + 1:]
+            self.modified_on = timezone.now()
+            UploadSession.objects.filter(pk=self.pk).update(
+                received=received,
+                modified_on=self.modified_on,
+            )
+        self.received = received
+
+    write_chunk.alters_data = True
+
+    def complete(self, storage) -> None:
+        """Determines the checksum and MIME type of the received file, after
+        which it can be used"""
+        if self.completed_on:
+            return
+        if self.missing_chunks:
+            raise ValueError("Not all chunks have been received yet")
+
+        with storage.open(self.stored_name) as file:
+            self.checksum, _, self.sniffed_content_type = \
+                FileWrapper.inspect_content(file)
+
+        if storage.file_permissions_mode is not None:
+            os.chmod(
+                storage.path(self.stored_name),
+                storage.file_permissions_mode
+            )
+
+        self.completed_on = timezone.now()
+        self.save()
+
+    complete.alters_data = True
+
+    def as_uploaded_file(self, storage) -> ChunkedUploadedFile:
+        """Returns the completed upload as an UploadedFile, which can be
+        assigned to a FileField"""
+        if not self.completed_on:
+            raise ValueError("This upload is not completed yet")
+        return ChunkedUploadedFile(self, storage)
+
+    def abort(self, storage) -> None:
+        """Removes this session and everything received so far"""
+        self.delete()
+        storage.delete(self.stored_name)
+
+    abort.alters_data = True
@@ -1,13 +1,21 @@
+import hashlib
 import uuid
-from typing import Optional, Union, TYPE_CHECKING
+from typing import List, NamedTuple, Optional, Union, TYPE_CHECKING
 
 from django.core.files import File
+from django.core.files.storage import Storage
 import magic
-from django.db.models import Manager
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import F, Manager
 from django.urls import reverse_lazy
+from django.utils import timezone
+from django.utils.functional import cached_property
 
-from .. import settings
+from .. import derivatives, settings
+from ..deletion import delete_on_commit
 from ..mime_names import get_name_from_mime
+from ..storage import StagedBlob, open_decoded, read_chunks
+from ..uploadhandler import SNIFF_LENGTH, StoredUploadedFile
 from ..utils import get_storage
 
 
@@ -26,7 +34,6 @@ class FileWrapper(File):
         self.original_filename = original_filename
         self.file_instance = file_instance
         self._field = field
-        self.storage = get_storage()
         self._committed = True
         self._removed = False
 
@@ -44,9 +51,36 @@ class FileWrapper(File):
             return self.field.filename_generator(self)
         return self.original_filename
 
+    @cached_property
+    def storage_name(self) -> Optional[str]:
+        """The name of the storage of our field (see CDH_FILES_STORAGES), or
+        None for the default storage"""
+        field = self._field
+        if field is None and self.file_instance is not None:
+            storage_names = self.file_instance._storage_names
+            if len(storage_names) == 1:
+                return next(iter(storage_names))
+            if storage_names:
+                # The fields of our model use different storages; it's up
+                # to the field actually referring to us
+                field = self.field
+        return getattr(field, 'storage_name', None)
+
+    @property
+    def storage(self) -> Storage:
+        return get_storage(self.storage_name)
+
+    @property
+    def content_addressed(self) -> bool:
+        """Whether our storage stores files as shared blobs"""
+        return getattr(self.storage, 'content_addressed', False)
+
     @property
     def name_on_disk(self):
         if self.file_instance:
+            # blob_id is the checksum of the blob; no need to fetch it
+            if self.content_addressed and self.file_instance.blob_id:
+                return self.storage.blob_name(self.file_instance.blob_id)
             if not self.file_instance.uuid:
                 self.file_instance.uuid = uuid.uuid4()
             return str(self.file_instance.uuid)
@@ -60,8 +94,10 @@ class FileWrapper(File):
         if self._field:
             return self._field
 
-        if self.file_instance and self.file_instance._child_fields:
-            return self.file_instance._child_fields[0]
+        if self.file_instance:
+            child_fields = self.file_instance._child_fields
+            if child_fields:
+                return child_fields[0]
 
         return None
 
@@ -69,10 +105,44 @@ class FileWrapper(File):
         return hash(self.name_on_disk)
 
     def __bool__(self):
-        try:
-            return bool(self.file)
-        except AttributeError:
+        if not self._committed:
+            return bool(getattr(self, '_file', None))
+        return self.exists()
+
+    def exists(self) -> bool:
+        """Whether this file has contents in the storage, according to the
+        database. Use verify_on_disk() to actually check the storage."""
+        if not self.file_instance:
             return False
+        if self.file_instance.stored_at is not None:
+            return True
+        # Not backfilled yet, we have no choice but to ask the storage
+        return self.storage.exists(self.name_on_disk)
+
+    def verify_on_disk(self, checksum=False) -> bool:
+        """Checks the storage for the contents of this file, and whether
+        they match the size recorded in the database.
+
+        :param checksum: Also read the whole file to verify its checksum.
+                         This can be slow for large files.
+        """
+        if not self.file_instance or \
+                not self.storage.exists(self.name_on_disk):
+            return False
+
+        # The recorded size is that of the decoded file
+        recorded_size = self.file_instance.size
+        if recorded_size is not None and not self.file_instance.encoding and \
+                self.storage.size(self.name_on_disk) != recorded_size:
+            return False
+
+        if checksum and self.file_instance.checksum:
+            digest = hashlib.sha256()
+            for chunk in self.stream():
+                digest.update(chunk)
+            return digest.hexdigest() == self.file_instance.checksum
+
+        return True
 
     # Alias these to the file_instance, as sometimes the ORM expects these
     # values
@@ -93,6 +163,9 @@ class FileWrapper(File):
     created_by = property(lambda self: self.file_instance.created_by)
     created_on = property(lambda self: self.file_instance.created_on)
     modified_on = property(lambda self: self.file_instance.modified_on)
+    encoding = property(lambda self: self.file_instance.encoding)
+    tier = property(lambda self: self.file_instance.tier)
+    verified_at = property(lambda self: self.file_instance.verified_at)
 
     def get_content_type_display(self):
         return get_name_from_mime(self.content_type, 'Unknown file type')
@@ -109,7 +182,7 @@ class FileWrapper(File):
     def _get_file(self):
         try:
             if getattr(self, '_file', None) is None:
-                self._file = self.storage.open(self.name_on_disk, 'rb')
+                self._file = self._open_stored()
         except FileNotFoundError:
             self._file = None
         return self._file
@@ -144,19 +217,51 @@ class FileWrapper(File):
         self._require_file()
         if not self._committed:
             return self.file.size
+        if self.file_instance.size is not None:
+            return self.file_instance.size
         return self.storage.size(self.name_on_disk)
 
     def open(self, mode='rb'):
         self._require_file()
         if getattr(self, '_file', None) is None:
-            self.file = self.storage.open(self.name_on_disk, mode)
+            self.file = self._open_stored(mode)
         else:
             self.file.open(mode)
         return self
 
+    def _open_stored(self, mode='rb', decode=True):
+        """Opens our file in the storage, decoding it if it's stored
+        encoded (e.g. compressed)"""
+        file = self.storage.open(self.name_on_disk, mode)
+        if decode and self.file_instance:
+            return open_decoded(file, self.file_instance.encoding)
+        return file
+
     # open() doesn't alter the file's contents, but it does reset the pointer
     open.alters_data = True
 
+    def stream(self, start=0, length=None, chunk_size=None, decode=True):
+        """Generator yielding the contents of this file in chunks.
+
+        A separate file handle is used, which is only opened once the first
+        chunk is requested and is closed when the generator is exhausted or
+        closed. This makes it suitable for use in streaming responses.
+
+        :param start: The offset to start reading from
+        :param length: The number of bytes to read, defaults to the rest of
+                       the file
+        :param chunk_size: The maximum size of the yielded chunks
+        :param decode: Whether to decode files stored encoded. If False, the
+                       file is streamed as stored, and offsets refer to the
+                       encoded file.
+        """
+        chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        file = self._open_stored('rb', decode)
+        try:
+            yield from read_chunks(file, start, length, chunk_size)
+        finally:
+            file.close()
+
     # In addition to the standard File API, FieldFiles have extra methods
     # to further manipulate the underlying file, as well as update the
     # associated model instance.
@@ -168,22 +273,49 @@ class FileWrapper(File):
         if original_filename is None and hasattr(content, 'name'):
             original_filename = content.name
 
-        # If we overwrite the file this instance represents, we need to first
-        # delete the old one, as otherwise we would lose the new file
-        if self.storage.exists(self.name_on_disk):
-            self.storage.delete(self.name_on_disk)
-        self.storage.save(
-            self.name_on_disk,
-            content,
-            max_length=self.field.max_length
-        )
+        # Uploads received by StorageUploadHandler are already in our storage,
+        # and we know their checksum and MIME type. Storing them is only a
+        # matter of renaming, which both branches below will do.
+        stored_upload = isinstance(content, StoredUploadedFile) and \
+            content.is_stored_in(self.storage)
+
+        # Derivatives of the old contents are outdated after this
+        had_derivatives = self._may_have_derivatives()
+
+        old_blob = None
+        encoding = ''
+        if self.content_addressed:
+            old_blob = self.file_instance.blob_id
+            blob, mime = self._save_blob(content)
+            checksum, size = blob.checksum, blob.size
+        else:
+            if stored_upload:
+                checksum, size = content.checksum, content.size
+                mime = content.sniffed_content_type
+            else:
+                checksum, size, mime = self.inspect_content(content)
+            # Storages compressing at rest decide per file
+            if hasattr(self.storage, 'get_encoding'):
+                encoding = self.storage.get_encoding(mime, size)
+            # If we overwrite the file this instance represents, we need to
+            # first delete the old one, as otherwise we would lose the new file
+            if self.storage.exists(self.name_on_disk):
+                self.storage.delete(self.name_on_disk)
+            self.storage.save(
+                self.name_on_disk,
+                self.storage.encode(content, encoding) if encoding else
+                content,
+                max_length=self.field.max_length
+            )
         self._committed = True
 
-        # Use magic to determine the mime type. It's pretty obvious, I know
-        # I just liked saying 'use MAGIC'
-        with self.open() as file:
-            mime = magic.from_buffer(file.read(2048), mime=True)
         self.file_instance.content_type = mime
+        self.file_instance.size = size
+        self.file_instance.checksum = checksum
+        self.file_instance.encoding = encoding
+        # New contents are always saved in the hot tier
+        self.file_instance.tier = 'hot'
+        self.file_instance.stored_at = timezone.now()
 
         if original_filename:
             self.file_instance.original_filename = original_filename
@@ -200,8 +332,172 @@ class FileWrapper(File):
 
         self.file_instance.save()
 
+        if stored_upload:
+            content.stored()
+
+        if had_derivatives:
+            self._delete_derivatives()
+
+        # Only release the old blob now that our File no longer refers to it
+        if old_blob:
+            # Local import to prevent cycles
+            from .models import Blob
+            Blob.objects.release(old_blob, self.storage)
+
     save.alters_data = True
 
+    def _save_blob(self, content):
+        """Stores the content as a (possibly shared) blob and points our File
+        to it. Returns the blob and the MIME type of the content."""
+        # Local import to prevent cycles
+        from .models import Blob
+        if isinstance(content, StoredUploadedFile) and \
+                content.is_stored_in(self.storage):
+            staged = StagedBlob(
+                content.temporary_file_path(),
+                content.checksum,
+                content.size,
+                content_type=content.sniffed_content_type,
+            )
+        else:
+            staged = self.storage.stage_blob(content)
+        try:
+            with transaction.atomic():
+                blob = Blob.objects.acquire(staged.checksum, staged.size)
+                self.storage.commit_blob(staged)
+        finally:
+            self.storage.discard_blob(staged)
+
+        # Files stored before switching to a content addressed storage are
+        # stored under their UUID; that copy is no longer needed.
+        if self.file_instance.blob_id is None and \
+                self.storage.exists(str(self.file_instance.uuid)):
+            self.storage.delete(str(self.file_instance.uuid))
+
+        self.file_instance.blob = blob
+        return blob, staged.content_type
+
+    @staticmethod
+    def inspect_content(content):
+        """Reads the content once, returning its checksum, size and MIME
+        type. Done before saving, as the storage might not be able to give
+        us the contents back cheaply."""
+        checksum = hashlib.sha256()
+        size = 0
+        head = b''
+        for chunk in content.chunks():
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if len(head) < SNIFF_LENGTH:
+                head += chunk[:SNIFF_LENGTH - len(head)]
+            checksum.update(chunk)
+            size += len(chunk)
+
+        return checksum.hexdigest(), size, magic.from_buffer(head, mime=True)
+
+    def derivative(self, spec: str, generate: bool = True) \
+            -> Optional[derivatives.Derivative]:
+        """Returns the derivative of this file (e.g. a thumbnail) described
+        by the given spec in CDH_FILES_DERIVATIVES, generating it if it
+        doesn't exist yet. See cdh.files.derivatives.
+
+        Returns None if this file has no contents or is not an image or PDF,
+        or if the derivative doesn't exist and generate is False. Raises
+        ValueError for unknown specs.
+        """
+        spec = derivatives.get_spec(spec)
+        if not self.file_instance or not self.exists() or \
+                not derivatives.supports(self.content_type):
+            return None
+
+        name = derivatives.get_name(self.uuid, spec)
+        try:
+            modified_time = self.storage.get_modified_time(name)
+            # One generated from the old contents might have outlived them,
+            # if it was generated while those were being replaced
+            stored_at = self.file_instance.stored_at
+            if stored_at is None or modified_time >= stored_at:
+                return derivatives.Derivative(self.storage, name, spec)
+        except FileNotFoundError:
+            pass
+
+        if not generate:
+            return None
+
+        name = derivatives.generate(
+            self.storage,
+            self.name_on_disk,
+            self.content_type,
+            self.encoding,
+            spec,
+            name,
+        )
+        if name is None:
+            return None
+        return derivatives.Derivative(self.storage, name, spec)
+
+    @property
+    def supports_derivatives(self) -> bool:
+        """Whether derivative() can be used for this file"""
+        return bool(self.file_instance) and \
+            derivatives.supports(self.content_type)
+
+    def _may_have_derivatives(self) -> bool:
+        return bool(self.file_instance) and \
+            self.file_instance.stored_at is not None and \
+            derivatives.supports(self.file_instance.content_type)
+
+    def _delete_derivatives(self):
+        for spec in derivatives.get_specs():
+            delete_on_commit(
+                self.storage,
+                derivatives.get_name(self.uuid, spec),
+                using=self.file_instance._state.db
+            )
+
+    def move_to_tier(self, tier: str) -> bool:
+        """Moves this file to the given tier of our TieredFileStorage, and
+        records it on our File. Returns whether the file was moved."""
+        if not getattr(self.storage, 'tiered', False):
+            raise ValueError("The storage does not support tiers")
+        if self.content_addressed:
+            raise ValueError("Blobs are shared, and cannot be moved per file")
+
+        moved = self.storage.move(self.name_on_disk, tier)
+        if self.file_instance.tier != tier:
+            self.file_instance.tier = tier
+            if self.file_instance.pk:
+                self.file_instance.__class__.objects.filter(
+                    pk=self.file_instance.pk
+                ).update(tier=tier)
+        return moved
+
+    move_to_tier.alters_data = True
+
+    def _delete_from_storage(self):
+        if self._may_have_derivatives():
+            self._delete_derivatives()
+
+        if self.content_addressed and self.file_instance.blob_id:
+            # Local import to prevent cycles
+            from .models import Blob
+            checksum = self.file_instance.blob_id
+            # Dereference the blob first, as it cannot be removed while a
+            # File is still pointing to it
+            if self.file_instance.pk:
+                self.file_instance.__class__.objects.filter(
+                    pk=self.file_instance.pk
+                ).update(blob=None)
+            self.file_instance.blob = None
+            Blob.objects.release(checksum, self.storage)
+            return
+
+        delete_on_commit(
+            self.storage,
+            self.name_on_disk,
+            using=self.file_instance._state.db if self.file_instance else None
+        )
+
     def delete(self, save=True, force=False):
         """Deletes the file on disk. If save = True, the metadata object will
         also be deleted. Note: only delete the metadata object if no other DB
@@ -213,18 +509,18 @@ class FileWrapper(File):
         :param force: Whether to force a deletion if multiple DB objects still
                       refer to it, defaults to False
         """
-        if not self.storage.exists(self.name_on_disk):
+        if not self.exists():
             return
 
         # By default, only delete if there are no references in the DB anymore
         deletion_threshold = 0
 
         # If we are instructed to also destroy our file_instance and we still
-        # have a reference, we allow deletion with 1 more reference
+        # have a reference, we allow deletion with 1 more reference. (If our
+        # file_instance is already gone, nothing can refer to it, so there's
+        # no need to check whether it exists)
         if save and self.file_instance:
-            model = self.file_instance.__class__
-            if model.objects.filter(pk=self.file_instance.pk).exists():
-                deletion_threshold += 1
+            deletion_threshold += 1
 
         # Check if we only have the allowed amount number of references or fewer
         # If we have more, and we're not forcing a deletion, stop right here!
@@ -245,10 +541,11 @@ class FileWrapper(File):
             self.close()
             del self.file
 
-        self.storage.delete(self.name_on_disk)
+        self._delete_from_storage()
 
         self.original_filename = None
         self._committed = False
+        self.file_instance.stored_at = None
         self.file_instance.clear_file_wrappers()
 
     delete.alters_data = True
@@ -279,7 +576,7 @@ class FileWrapper(File):
 
     def __setstate__(self, state):
         self.__dict__.update(state)
-        self.storage = get_storage()
+        self._field = state['field']
 
 
 class PrivateCacheMixin:
@@ -306,7 +603,21 @@ class PrivateCacheMixin:
         self._cache = {}
 
 
+class TrackedFileVersion(NamedTuple):
+    """A single entry in the history of a TrackedFileField"""
+    file: FileWrapper
+    # Whether this is the current file
+    current: bool
+    # Pass as `before` to TrackedFileWrapper.history to get the next page
+    cursor: int
+
+
 class TrackedFileWrapper(PrivateCacheMixin):
+    # How often making a file current is tried when it conflicts with a
+    # concurrent change
+    SET_CURRENT_ATTEMPTS = 3
+    # How many files `all` fetches at a time
+    ALL_PAGE_SIZE = 100
 
     def __init__(self, manager: Manager, instance, field: 'TrackedFileField'):
         super().__init__()
@@ -320,6 +631,11 @@ class TrackedFileWrapper(PrivateCacheMixin):
         self._file_field = self._through_model._meta.get_field(
             self._field.m2m_reverse_field_name()
         )
+        # All operations on the linking table should be limited to the rows
+        # of our instance
+        self._owner_filter = {
+            self._field.m2m_field_name(): self._instance,
+        }
 
     def __repr__(self):
         return f"<{self.__class__.__module__}.{self.__class__.__name__} " \
@@ -337,7 +653,8 @@ class TrackedFileWrapper(PrivateCacheMixin):
             obj = obj.file_instance
 
         kwargs = {
-            self._file_field.attname: obj
+            self._file_field.attname: obj,
+            **self._owner_filter,
         }
         return self._through_model.objects.get(**kwargs)
 
@@ -348,7 +665,8 @@ class TrackedFileWrapper(PrivateCacheMixin):
             obj = obj.file_instance
 
         kwargs = {
-            self._file_field.attname: obj
+            self._file_field.attname: obj,
+            **self._owner_filter,
         }
         return self._through_model.objects.filter(**kwargs).exists()
 
@@ -388,23 +706,27 @@ class TrackedFileWrapper(PrivateCacheMixin):
         if self.is_cached('current'):
             return self.get_cached_value('current')
 
-        try:
-            linking_instance = self._through_model.objects.get(current=True)
-        except self._through_model.DoesNotExist:
+        # If our files were prefetched, we already know none of them is
+        # current
+        if self.is_cached('all'):
             return None
 
-        if linking_instance:
-            value = getattr(
-                linking_instance,
-                self._field.m2m_reverse_field_name()
-            )
-            self.cache_value(
-                'current',
-                value
-            )
-            return value
+        # Fetch the File directly, using the (owner, current) index of the
+        # linking table
+        current_link = self._through_model.objects.filter(
+            current=True,
+            **self._owner_filter,
+        ).values(self._file_field.attname)
+        file = self._field.related_model.objects.filter(**{
+            f'{self._file_field.target_field.attname}__in': current_link
+        }).first()
 
-        return None
+        if file is None:
+            return None
+
+        value = file.get_file_wrapper(self._file_field, False)
+        self.cache_value('current', value)
+        return value
 
     def _set_current_file(self, value: Union[
         uuid.UUID, FileWrapper, 'BaseFile', int, str
@@ -447,20 +769,118 @@ class TrackedFileWrapper(PrivateCacheMixin):
     current_file.fdel.alters_data = True
 
     def _set_as_current(self, file_wrapper: FileWrapper) -> None:
-        self._through_model.objects.update(current=False)
+        links = self._through_model.objects.filter(**self._owner_filter)
+        file_filter = {
+            self._file_field.attname: file_wrapper.file_instance.pk,
+        }
 
-        link = self._get_linking_instance(file_wrapper)
-        link.current = True
-        link.save()
+        # Only the old and the new current link are touched. The old one
+        # must be cleared first, as only one may be current at a time
+        using = router.db_for_write(self._through_model)
+        for attempt in range(self.SET_CURRENT_ATTEMPTS):
+            try:
+                with transaction.atomic(using=using):
+                    self._replace_current(
+                        links,
+                        file_filter,
+                        file_wrapper,
+                        using
+                    )
+                break
+            except IntegrityError:
+                # Another file was made current concurrently, after we
+                # cleared the old one; clear that one as well
+                if attempt + 1 == self.SET_CURRENT_ATTEMPTS:
+                    raise
 
         self.cache_value('current', file_wrapper)
 
+    def _replace_current(
+        self,
+        links,
+        file_filter,
+        file_wrapper: FileWrapper,
+        using: str
+    ) -> None:
+        if not connections[using].features.supports_partial_indexes:
+            # Nothing stops concurrent changes from both leaving a current
+            # link, so they take turns
+            list(links.select_for_update().order_by('pk').values_list(
+                'pk',
+                flat=True
+            ))
+        links.filter(current=True).exclude(**file_filter).update(
+            current=False
+        )
+        if not links.filter(**file_filter).update(current=True):
+            raise ValueError(
+                f"{file_wrapper} is not tracked by {self!r}"
+            )
+
     @property
     def all(self):
-        return map(
-            lambda file: self._resolve_to_file_wrapper(file),
-            self._manager.all().order_by('-created_on')
-        )
+        if self.is_cached('all'):
+            return iter(self.get_cached_value('all'))
+
+        return self._iter_all()
+
+    def _iter_all(self):
+        """Yields all files, newest first, fetching them a page at a time
+        instead of loading every version at once"""
+        before = None
+        while True:
+            page = self.history(limit=self.ALL_PAGE_SIZE, before=before)
+            for version in page:
+                yield version.file
+            if len(page) < self.ALL_PAGE_SIZE:
+                return
+            before = page[-1]
+
+    def history(
+            self,
+            limit: Optional[int] = 20,
+            before: Union[TrackedFileVersion, int, None] = None,
+    ) -> List[TrackedFileVersion]:
+        """Returns a page of the history of this field, newest first, using
+        a single query.
+
+        Versions are ordered by the id of the link to the file rather than
+        by its created_on; the linking table has no timestamp, and its ids
+        follow the order files were added. This lets the page be found with
+        the (owner, id) index of the linking table, instead of sorting all
+        files of the owner.
+
+        :param limit: The maximum number of versions to return, or None for
+                      all of them
+        :param before: The cursor of the last version of the previous page,
+                       (or that version itself) to continue after it
+        """
+        if isinstance(before, TrackedFileVersion):
+            before = before.cursor
+
+        # Join the linking table through its FileField, so we can select its
+        # columns along with the Files
+        link = self._file_field.related_query_name()
+        queryset = self._field.related_model.objects.filter(**{
+            f'{link}__{self._field.m2m_field_name()}': self._instance,
+        }).annotate(
+            _link_id=F(f'{link}__pk'),
+            _current=F(f'{link}__current'),
+        ).select_related('created_by').order_by('-_link_id')
+
+        if before is not None:
+            queryset = queryset.filter(_link_id__lt=before)
+        if limit is not None:
+            queryset = queryset[:limit]
+
+        return [
+            TrackedFileVersion(
+                file.get_file_wrapper(self._file_field, False),
+                file._current,
+                file._link_id,
+            )
+            for file in queryset
+        ]
 
     def add(self, file: Union[
         uuid.UUID, FileWrapper, 'BaseFile', int, str
@@ -481,6 +901,7 @@ class TrackedFileWrapper(PrivateCacheMixin):
 
         through_obj.save()
 
+        self.invalidate_cache_value('all')
         self._set_as_current(file_wrapper)
     add.alters_data = True
 
@@ -506,6 +927,7 @@ class TrackedFileWrapper(PrivateCacheMixin):
         link.delete()
         file.delete()
 
+        self.invalidate_cache_value('all')
         if link.current:
             self.invalidate_caches()
     delete.alters_data = True
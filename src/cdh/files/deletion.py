@@ -0,0 +1,162 @@
+"""Deferred, batched removal of files from storage.
+
+Removing a file from the storage cannot be rolled back. Instead of removing
+files right away, FileWrapper therefore queues them here. Queued files are
+removed once the surrounding transaction commits. If the transaction (or
+savepoint) is rolled back, they are left alone. Outside of transactions,
+files are removed immediately.
+
+Every queued file is removed by its own on_commit callback, unless it's
+queued inside a deletion_batch() block. The files queued in such a block
+share one callback, registered when the block is left; if the block is left
+by an exception, the files are left alone, as the changes that made them
+unused are presumably rolled back.
+
+With CDH_FILES_DELETION_WORKER enabled, the actual removal is done by a
+background thread, so requests don't have to wait for it. Files still queued
+when the process exits are left in the storage; the files_gc management
+command can clean those up.
+
+Blobs of content addressed storages are not handled here, but are deferred
+in the same way by BlobManager.release. Their on_commit callback checks
+again whether the blob is still unused while holding the lock on its Blob
+row, as a concurrent upload might have started to reuse it.
+"""
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from cdh.files import settings
+
+logger = logging.getLogger('cdh.files')
+
+_local = threading.local()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def delete_files(files) -> None:
+    """Removes the given (storage, name) pairs from their storages. Errors
+    are logged instead of raised, so one failure doesn't leave the other
+    files behind."""
+    for storage, name in files:
+        try:
+            storage.delete(name)
+        except Exception:  # NoQA; we really don't want to stop here
+            logger.exception(f"Could not remove '{name}' from storage")
+
+
+class DeletionBatch:
+    """Files queued for removal together. Called by Django once the
+    transaction commits."""
+
+    def __init__(self, using: str):
+        self.using = using
+        self.files = []
+
+    def add(self, storage, name: str) -> None:
+        self.files.append((storage, name))
+
+    def __call__(self):
+        files, self.files = self.files, []
+
+        if settings.DELETION_WORKER:
+            _get_worker().queue.put(files)
+        else:
+            delete_files(files)
+
+
+class DeletionWorker(threading.Thread):
+    """Background thread removing batches of files"""
+
+    def __init__(self):
+        super().__init__(name='cdh-files-deletion', daemon=True)
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            files = self.queue.get()
+            try:
+                delete_files(files)
+            finally:
+                self.queue.task_done()
+
+
+def _get_worker() -> DeletionWorker:
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = DeletionWorker()
+            _worker.start()
+    return _worker
+
+
+def wait_for_deletions() -> None:
+    """Blocks until the background worker (if any) has removed all files
+    handed to it so far"""
+    if _worker is not None and _worker.is_alive():
+        _worker.queue.join()
+
+
+def _get_batches(using: str) -> list:
+    # The open deletion_batch() blocks, innermost last, per database
+    if not hasattr(_local, 'batches'):
+        _local.batches = {}
+    return _local.batches.setdefault(using, [])
+
+
+def _schedule(batch: DeletionBatch) -> None:
+    if settings.DEFER_DELETION and \
+            transaction.get_connection(batch.using).in_atomic_block:
+        transaction.on_commit(batch, using=batch.using)
+    else:
+        batch()
+
+
+@contextmanager
+def deletion_batch(using: str = None):
+    """Groups the files queued inside the block into one batch, removed by a
+    single on_commit callback. Blocks can be nested, in which case the outer
+    block gets the files. The block should not span the end of the
+    transaction it queues files in.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    batches = _get_batches(using)
+    batch = DeletionBatch(using)
+
+    batches.append(batch)
+    try:
+        yield batch
+    finally:
+        batches.pop()
+
+    if not batch.files:
+        return
+    if batches:
+        batches[-1].files.extend(batch.files)
+    else:
+        _schedule(batch)
+
+
+def delete_on_commit(storage, name: str, using: str = None) -> None:
+    """Removes the file with the given name from the storage once the
+    current transaction on the given database commits. See the module
+    documentation for details."""
+    using = using or DEFAULT_DB_ALIAS
+
+    if not settings.DEFER_DELETION or \
+            not transaction.get_connection(using).in_atomic_block:
+        delete_files([(storage, name)])
+        return
+
+    batches = _get_batches(using)
+    if batches:
+        batches[-1].add(storage, name)
+        return
+
+    batch = DeletionBatch(using)
+    batch.add(storage, name)
+    transaction.on_commit(batch, using=using)
@@ -0,0 +1,169 @@
+"""Delivery backends determine how the download views send a file's contents
+to the client, after the view has done its lookups and permission checks.
+
+By default, files are streamed by Python. In production it's often better to
+let the front-end web server do the actual sending, so no Python worker is
+kept busy for the duration of the download. The offload backends in this
+module return an empty response with a header telling the web server which
+file to send instead.
+
+The backend is selected with the ``CDH_FILES_DELIVERY_BACKEND`` setting, or
+per view with ``BaseFileView.delivery_backend``.
+"""
+import os
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, HttpResponseNotFound
+from django.utils.module_loading import import_string
+
+from cdh.files import settings
+from cdh.files.responses import build_file_response, set_validators
+
+if TYPE_CHECKING:
+    from cdh.files.db.wrappers import FileWrapper
+    from cdh.files.views import BaseFileView
+
+
+class DeliveryBackend:
+    """Base class for delivery backends"""
+
+    def deliver(self, view: 'BaseFileView') -> HttpResponse:
+        """Returns a response sending the file of the given view.
+
+        Conditional requests have already been handled by the view when
+        this method is called.
+        """
+        raise NotImplementedError
+
+
+class PythonDeliveryBackend(DeliveryBackend):
+    """Streams the file from Python, with support for Range requests.
+
+    Used as a fallback by the offload backends, and useful for local
+    development where no front-end server is present.
+    """
+
+    def deliver(self, view: 'BaseFileView') -> HttpResponse:
+        try:
+            size = view.get_size()
+        except FileNotFoundError:
+            return HttpResponseNotFound()
+
+        # Async views need an async iterator, or Django would read the whole
+        # file into memory before sending it
+        asynchronous = getattr(view, 'view_is_async', False)
+        return build_file_response(
+            view.request,
+            stream=view.astream if asynchronous else view.stream,
+            size=size,
+            content_type=view.get_content_type(),
+            etag=view.get_etag(),
+            last_modified=view.get_last_modified(),
+            max_ranges=view.max_ranges,
+            asynchronous=asynchronous,
+        )
+
+
+class OffloadDeliveryBackend(DeliveryBackend):
+    """Base class for backends handing the actual sending off to the web
+    server.
+
+    If the storage cannot provide a location on disk below its root for a
+    file, or the file is stored encoded (e.g. compressed), the fallback
+    backend is used instead.
+    """
+    header_name = None
+    fallback_class = PythonDeliveryBackend
+
+    def get_header_value(self, file_wrapper: 'FileWrapper') -> str:
+        raise NotImplementedError
+
+    def get_relative_path(self, file_wrapper: 'FileWrapper') -> str:
+        """Returns the path of the file relative to the storage root,
+        using forward slashes"""
+        storage = file_wrapper.storage
+        path = os.path.relpath(
+            storage.path(file_wrapper.name_on_disk),
+            storage.path(''),
+        )
+        # E.g. files in the cold tier of a TieredFileStorage; the web server
+        # only knows about the storage root
+        if path == os.pardir or path.startswith(os.pardir + os.sep):
+            raise NotImplementedError
+        return path.replace(os.sep, '/')
+
+    def deliver(self, view: 'BaseFileView') -> HttpResponse:
+        # The web server would send files stored encoded or encrypted as is,
+        # whether the client accepts that or not
+        if view._file_wrapper.encoding or \
+                getattr(view._file_wrapper.storage, 'encrypted', False):
+            return self.fallback_class().deliver(view)
+
+        try:
+            header_value = self.get_header_value(view._file_wrapper)
+        except NotImplementedError:
+            return self.fallback_class().deliver(view)
+
+        response = HttpResponse(content_type=view.get_content_type())
+        response[self.header_name] = header_value
+
+        return set_validators(
+            response,
+            view.get_etag(),
+            view.get_last_modified()
+        )
+
+
+class XAccelRedirectDeliveryBackend(OffloadDeliveryBackend):
+    """Nginx, using X-Accel-Redirect.
+
+    CDH_FILES_DELIVERY_URL_PREFIX should be an internal location pointing to
+    CDH_FILES_FILE_ROOT, for example::
+
+        location /protected-files/ {
+            internal;
+            alias /path/to/cdh_files/;
+        }
+    """
+    header_name = 'X-Accel-Redirect'
+
+    def get_header_value(self, file_wrapper: 'FileWrapper') -> str:
+        return settings.DELIVERY_URL_PREFIX.rstrip('/') + '/' + quote(
+            self.get_relative_path(file_wrapper)
+        )
+
+
+class XSendfileDeliveryBackend(OffloadDeliveryBackend):
+    """Apache (mod_xsendfile) and lighttpd, using X-Sendfile with the
+    absolute path of the file"""
+    header_name = 'X-Sendfile'
+
+    def get_header_value(self, file_wrapper: 'FileWrapper') -> str:
+        return file_wrapper.storage.path(file_wrapper.name_on_disk)
+
+
+class LiteSpeedDeliveryBackend(OffloadDeliveryBackend):
+    """LiteSpeed, using X-LiteSpeed-Location. Like the nginx backend,
+    CDH_FILES_DELIVERY_URL_PREFIX should point to CDH_FILES_FILE_ROOT"""
+    header_name = 'X-LiteSpeed-Location'
+
+    def get_header_value(self, file_wrapper: 'FileWrapper') -> str:
+        return settings.DELIVERY_URL_PREFIX.rstrip('/') + '/' + quote(
+            self.get_relative_path(file_wrapper)
+        )
+
+
+def get_delivery_backend(backend: str = None) -> DeliveryBackend:
+    """Returns an instance of the given backend, or the configured one if
+    no backend is given"""
+    backend = backend or settings.DELIVERY_BACKEND
+    try:
+        cls = import_string(backend)
+    except ImportError:
+        raise ImproperlyConfigured(
+            f"CDH_FILES_DELIVERY_BACKEND: could not import '{backend}'"
+        )
+
+    return cls()
@@ -0,0 +1,226 @@
+"""Derivatives of files, like thumbnails and previews.
+
+A derivative is a smaller rendition of an image, or of the first page of a
+PDF, as described by a spec in CDH_FILES_DERIVATIVES. They are generated
+with Pillow (and pypdfium2 for PDFs) on first use by
+FileWrapper.derivative(), or in bulk by the files_derivatives management
+command. They are stored in the same storage as the originals, under the
+UUID of their File followed by the name of their spec (e.g.
+'<uuid>.thumb-256'). That keeps them next to their original, and lets
+files_gc recognise them.
+
+Derivatives are removed when their file gets new contents or is removed,
+and regenerated when they are needed again.
+
+Requires the Pillow package, and pypdfium2 for PDFs.
+"""
+import io
+import logging
+import re
+from typing import NamedTuple, Optional
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+
+from cdh.files import settings
+from cdh.files.storage import open_decoded, read_chunks
+
+logger = logging.getLogger('cdh.files')
+
+SPEC_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Formats Pillow can read, and that are worth making derivatives of
+IMAGE_CONTENT_TYPES = (
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'image/webp',
+    'image/bmp',
+    'image/x-ms-bmp',
+    'image/tiff',
+)
+
+PDF_CONTENT_TYPES = (
+    'application/pdf',
+)
+
+# Rendering PDF pages larger than this factor of their size in points only
+# costs time; it's about 144 DPI
+MAX_PDF_SCALE = 2
+
+CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+}
+
+
+class DerivativeSpec(NamedTuple):
+    """Describes a derivative. Images are scaled down to fit within width by
+    height, or to fill it if crop is set, in which case the overflow is cut
+    off. They are never scaled up."""
+    name: str
+    width: int
+    height: int
+    crop: bool = False
+    format: str = 'WEBP'
+    quality: int = 80
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.format]
+
+    @property
+    def extension(self) -> str:
+        return 'jpg' if self.format == 'JPEG' else self.format.lower()
+
+
+def get_spec(name: str) -> DerivativeSpec:
+    """Returns the spec with the given name from CDH_FILES_DERIVATIVES.
+    Raises ValueError if there is no such spec."""
+    if name not in settings.DERIVATIVES:
+        raise ValueError(f"Unknown derivative '{name}'")
+    if not SPEC_NAME_RE.match(name):
+        raise ValueError(
+            f"Invalid derivative name '{name}'; only letters, digits, _ and "
+            f"- are allowed"
+        )
+    spec = DerivativeSpec(name=name, **settings.DERIVATIVES[name])
+    if spec.format not in CONTENT_TYPES:
+        raise ValueError(
+            f"Unsupported format '{spec.format}' for derivative '{name}'"
+        )
+    return spec
+
+
+def get_specs() -> list:
+    return [get_spec(name) for name in settings.DERIVATIVES]
+
+
+def supports(content_type: str) -> bool:
+    """Whether derivatives can be made of files of the given MIME type"""
+    return content_type in IMAGE_CONTENT_TYPES or \
+        content_type in PDF_CONTENT_TYPES
+
+
+def get_name(file_uuid, spec: DerivativeSpec) -> str:
+    """Returns the name of the derivative of the File with the given UUID in
+    the storage. (Not the name of the file itself, as that's shared with
+    other files in content addressed storages.)"""
+    return f"{file_uuid}.{spec.name}"
+
+
+def _load_image(file, content_type: str, spec: DerivativeSpec):
+    # Local imports, as these are optional dependencies
+    from PIL import Image, ImageOps
+
+    if content_type in PDF_CONTENT_TYPES:
+        import pypdfium2
+
+        document = pypdfium2.PdfDocument(file)
+        try:
+            page = document[0]
+            page_width, page_height = page.get_size()
+            scales = (spec.width / page_width, spec.height / page_height)
+            scale = max(scales) if spec.crop else min(scales)
+            return page.render(scale=min(scale, MAX_PDF_SCALE)).to_pil()
+        finally:
+            document.close()
+
+    image = Image.open(file)
+    # Lets JPEG decoders skip most of the work for large photos
+    image.draft('RGB', (spec.width, spec.height))
+    # Photos are often stored sideways, with an EXIF tag to turn them
+    return ImageOps.exif_transpose(image)
+
+
+def render(file, content_type: str, spec: DerivativeSpec) -> bytes:
+    """Renders the derivative described by spec of the given file"""
+    # Local import, as this is an optional dependency
+    from PIL import ImageOps
+
+    image = _load_image(file, content_type, spec)
+    size = (spec.width, spec.height)
+    if spec.crop:
+        if image.width > spec.width or image.height > spec.height:
+            image = ImageOps.fit(
+                image,
+                (min(spec.width, image.width), min(spec.height, image.height))
+            )
+    else:
+        image.thumbnail(size)
+
+    if spec.format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=spec.format, quality=spec.quality)
+    return buffer.getvalue()
+
+
+def generate(
+        storage: Storage,
+        name_on_disk: str,
+        content_type: str,
+        encoding: str,
+        spec: DerivativeSpec,
+        name: str,
+) -> Optional[str]:
+    """Generates a derivative of the given file, and stores it under the
+    given name. Returns that name, or None if the file cannot be rendered.
+
+    Only takes plain arguments, so it can run in another process.
+    """
+    # Local import, as this is an optional dependency
+    from PIL import Image
+
+    try:
+        with open_decoded(storage.open(name_on_disk), encoding) as file:
+            data = render(file, content_type, spec)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # Not a valid image (or PDF) after all
+        logger.warning(
+            f"Could not generate {spec.name} of {name_on_disk}: {e}"
+        )
+        return None
+
+    # Someone might have generated it already, or the existing one may be
+    # outdated. Either way, we have a fresh one.
+    storage.delete(name)
+    saved_name = storage.save(name, ContentFile(data))
+    if saved_name != name:
+        # Lost a race with a concurrent generation of the same derivative
+        storage.delete(saved_name)
+    return name
+
+
+class Derivative:
+    """A stored derivative of a file, as returned by
+    FileWrapper.derivative()"""
+
+    def __init__(self, storage: Storage, name: str, spec: DerivativeSpec):
+        self.storage = storage
+        self.name = name
+        self.spec = spec
+
+    def __repr__(self):
+        return f"<Derivative: {self.name}>"
+
+    @property
+    def content_type(self) -> str:
+        return self.spec.content_type
+
+    @property
+    def size(self) -> int:
+        return self.storage.size(self.name)
+
+    def open(self, mode='rb'):
+        return self.storage.open(self.name, mode)
+
+    def stream(self, start=0, length=None, chunk_size=64 * 2 ** 10):
+        """Generator yielding the contents in chunks, see
+        FileWrapper.stream()"""
+        with self.open() as file:
+            yield from read_chunks(file, start, length, chunk_size)
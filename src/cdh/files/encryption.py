@@ -0,0 +1,335 @@
+"""Encryption at rest for cdh.files, in fixed-size authenticated chunks.
+
+EncryptedFileStorage encrypts files while they are written, and decrypts
+them while they are read. Only the chunks actually read are decrypted, so
+reading a range of a multi-GB file is cheap and memory use doesn't depend on
+the size of the file.
+
+Every file is encrypted with its own random key, which is stored in the
+header of the file, encrypted ('wrapped') with a key derived from the
+master key. Files are laid out as follows::
+
+    header:  magic (8) | chunk size (4) | master key id (8) |
+             nonce (12) | wrapped file key (32 + 16 tag)
+    chunks:  ciphertext (chunk size) | tag (16)
+             ...
+             ciphertext (<= chunk size) | tag (16)
+
+Chunks are encrypted with AES-256-GCM. Their nonce consists of their index
+and a flag marking the last chunk, which prevents chunks from being
+reordered and files from being truncated without detection. (This is the
+STREAM construction by Hoang, Reyhanitabar, Rogaway and Vizár.)
+
+The master keys are taken from CDH_FILES_ENCRYPTION_KEYS, or from
+FIELD_ENCRYPTION_KEY if that's not set. Like the latter, this can be a list
+of keys for key rotation: new files use the first key, while files using the
+other keys can still be read.
+
+Note that uploads are still written unencrypted to the storage while they
+are in progress (see cdh.files.uploadhandler and UploadSession); they are
+encrypted once they are saved to a FileField.
+
+Requires the cryptography package.
+"""
+import hashlib
+import io
+import os
+import struct
+from typing import Dict, List
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import cached_property
+
+from cdh.files import settings
+from cdh.files.storage import CDHFileStorage
+
+MAGIC = b'CDHFENC1'
+TAG_SIZE = 16
+NONCE_SIZE = 12
+KEY_ID_SIZE = 8
+# magic, chunk size, master key id, nonce, wrapped file key
+HEADER = struct.Struct(f'>8sI{KEY_ID_SIZE}s{NONCE_SIZE}s{32 + TAG_SIZE}s')
+
+
+class DecryptionError(IOError):
+    """Raised if a file cannot be decrypted; because the right master key is
+    missing, or because the file was tampered with"""
+    pass
+
+
+def _derive_key(master_key) -> bytes:
+    if isinstance(master_key, str):
+        master_key = master_key.encode()
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'cdh.files encryption at rest',
+    ).derive(master_key)
+
+
+def get_master_keys() -> List[bytes]:
+    """Returns the keys used to wrap file keys, derived from the configured
+    master keys. The first one should be used for new files."""
+    configured_keys = settings.ENCRYPTION_KEYS
+    if not isinstance(configured_keys, (tuple, list)):
+        configured_keys = [configured_keys]
+    configured_keys = [key for key in configured_keys if key]
+
+    if not configured_keys:
+        raise ImproperlyConfigured(
+            "EncryptedFileStorage needs CDH_FILES_ENCRYPTION_KEYS (or "
+            "FIELD_ENCRYPTION_KEY) to be set"
+        )
+
+    return [_derive_key(key) for key in configured_keys]
+
+
+def _key_id(master_key: bytes) -> bytes:
+    return hashlib.sha256(master_key).digest()[:KEY_ID_SIZE]
+
+
+def _chunk_nonce(index: int, last: bool) -> bytes:
+    return struct.pack('>QI', index, 1 if last else 0)
+
+
+class EncryptingContent:
+    """Encrypted view of a file, encrypting while it's being read. Passing
+    this to Storage.save() encrypts straight into the storage."""
+
+    def __init__(self, content, master_key: bytes, chunk_size: int):
+        self.content = content
+        self.name = getattr(content, 'name', None)
+        self.master_key = master_key
+        self.chunk_size = chunk_size
+
+    def _plaintext_chunks(self):
+        """Yields the content in chunks of exactly chunk_size bytes, apart
+        from the last one. Empty content yields one empty chunk."""
+        buffer = b''
+        yielded = False
+        for data in self.content.chunks(self.chunk_size):
+            if isinstance(data, str):
+                data = data.encode()
+            buffer += data
+            while len(buffer) >= self.chunk_size:
+                yield buffer[:self.chunk_size]
+                buffer = buffer[self.chunk_size:]
+                yielded = True
+        if buffer or not yielded:
+            yield buffer
+
+    def chunks(self, chunk_size=None):
+        file_key = AESGCM.generate_key(bit_length=256)
+        nonce = os.urandom(NONCE_SIZE)
+        key_id = _key_id(self.master_key)
+        associated_data = MAGIC + struct.pack('>I', self.chunk_size) + key_id
+        wrapped_key = AESGCM(self.master_key).encrypt(
+            nonce,
+            file_key,
+            associated_data
+        )
+        yield HEADER.pack(MAGIC, self.chunk_size, key_id, nonce, wrapped_key)
+
+        cipher = AESGCM(file_key)
+        # We need to know whether a chunk is the last one before encrypting
+        # it, so we stay one chunk ahead. Empty content still gets one
+        # (empty) chunk, so truncation to just the header is detected.
+        chunks = self._plaintext_chunks()
+        current = next(chunks)
+        index = 0
+        for upcoming in chunks:
+            yield cipher.encrypt(_chunk_nonce(index, False), current, None)
+            index += 1
+            current = upcoming
+        yield cipher.encrypt(_chunk_nonce(index, True), current, None)
+
+
+class DecryptingReader(io.RawIOBase):
+    """Seekable, read-only file object decrypting an encrypted file. Only
+    the chunk holding the current position is kept in memory."""
+
+    def __init__(self, file, master_keys: Dict[bytes, bytes]):
+        super().__init__()
+        self.encrypted_file = file
+        header = file.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise DecryptionError("Not an encrypted file")
+        magic, chunk_size, key_id, nonce, wrapped_key = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise DecryptionError("Not an encrypted file")
+        if key_id not in master_keys:
+            raise DecryptionError(
+                "This file was encrypted with an unknown master key"
+            )
+
+        try:
+            file_key = AESGCM(master_keys[key_id]).decrypt(
+                nonce,
+                wrapped_key,
+                header[:len(MAGIC) + 4 + KEY_ID_SIZE]
+            )
+        except InvalidTag:
+            raise DecryptionError("The key of this file was tampered with")
+
+        self.cipher = AESGCM(file_key)
+        self.chunk_size = chunk_size
+
+        file.seek(0, os.SEEK_END)
+        encrypted_size = file.tell() - HEADER.size
+        encrypted_chunk_size = chunk_size + TAG_SIZE
+        self.num_chunks = max(
+            -(-encrypted_size // encrypted_chunk_size),
+            1
+        )
+        self.size = encrypted_size - self.num_chunks * TAG_SIZE
+        if self.size < 0:
+            raise DecryptionError("This file was truncated")
+
+        self.position = 0
+        self._chunk_index = None
+        self._chunk = b''
+
+    @staticmethod
+    def plaintext_size(encrypted_size: int, chunk_size: int) -> int:
+        encrypted_size -= HEADER.size
+        num_chunks = max(-(-encrypted_size // (chunk_size + TAG_SIZE)), 1)
+        return encrypted_size - num_chunks * TAG_SIZE
+
+    def _load_chunk(self, index: int) -> bytes:
+        if self._chunk_index != index:
+            self.encrypted_file.seek(
+                HEADER.size + index * (self.chunk_size + TAG_SIZE)
+            )
+            encrypted = self.encrypted_file.read(self.chunk_size + TAG_SIZE)
+            last = index == self.num_chunks - 1
+            try:
+                self._chunk = self.cipher.decrypt(
+                    _chunk_nonce(index, last),
+                    encrypted,
+                    None
+                )
+            except InvalidTag:
+                raise DecryptionError(
+                    f"Chunk {index} was tampered with, or the file was "
+                    f"truncated"
+                )
+            self._chunk_index = index
+        return self._chunk
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+
+        index, offset = divmod(self.position, self.chunk_size)
+        chunk = self._load_chunk(index)
+        data = chunk[offset:offset + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self.size - self.position, 0)
+        # Read whole chunks at once, instead of one readinto() per chunk
+        parts = []
+        while size > 0:
+            buffer = bytearray(min(size, self.chunk_size))
+            read = self.readinto(buffer)
+            if not read:
+                break
+            parts.append(bytes(buffer[:read]))
+            size -= read
+        return b''.join(parts)
+
+    def close(self):
+        try:
+            self.encrypted_file.close()
+        finally:
+            super().close()
+
+
+@deconstructible
+class EncryptedFileStorage(CDHFileStorage):
+    """Filesystem storage encrypting files at rest, see the module
+    documentation for details.
+
+    Files stored before switching to this storage are still readable, as
+    they are recognized by their missing header. The web server cannot
+    decrypt files, so the offload delivery backends will let Python send
+    them instead.
+    """
+    encrypted = True
+    # Size of the plaintext in every chunk; stored per file, so it can be
+    # changed at any time
+    encryption_chunk_size = 64 * 2 ** 10
+
+    @cached_property
+    def master_keys(self) -> Dict[bytes, bytes]:
+        """The master keys by their id; the first one is used to encrypt"""
+        return {_key_id(key): key for key in get_master_keys()}
+
+    def _save(self, name, content):
+        return super()._save(name, EncryptingContent(
+            content,
+            next(iter(self.master_keys.values())),
+            self.encryption_chunk_size,
+        ))
+
+    def _is_encrypted(self, file) -> bool:
+        magic = file.read(len(MAGIC))
+        file.seek(0)
+        return magic == MAGIC
+
+    def _open(self, name, mode='rb'):
+        file = super()._open(name, mode)
+        if not self._is_encrypted(file):
+            return file
+        if mode not in ('rb', 'r'):
+            file.close()
+            raise ValueError("Encrypted files can only be opened for reading")
+
+        try:
+            reader = DecryptingReader(file.file, self.master_keys)
+        except BaseException:
+            file.close()
+            raise
+        return File(reader, name=file.name)
+
+    def size(self, name):
+        size = super().size(name)
+        with open(self.path(name), 'rb') as file:
+            header = file.read(HEADER.size)
+        if len(header) != HEADER.size or not header.startswith(MAGIC):
+            return size
+        chunk_size = HEADER.unpack(header)[1]
+        return DecryptingReader.plaintext_size(size, chunk_size)
@@ -1,2 +1,4 @@
 from .fields import FileField, TrackedFileField
+from .resolver import FileResolver, FileResolverFormMixin, \
+    FileResolverFormSetMixin
 from .widgets import SimpleFileInput
\ No newline at end of file
@@ -25,17 +25,22 @@ class FileField(Field):
     }
 
     def __init__(self, queryset, *, max_length=None, allow_empty_file=False,
-                 **kwargs):
+                 storage=None, **kwargs):
         self.queryset = queryset
         self.max_length = max_length
         self.allow_empty_file = allow_empty_file
+        self.storage_name = storage
+        # Set by a FileResolver, which loads the values of many fields at once
+        self.resolver = None
         if 'limit_choices_to' in kwargs:
             del kwargs['limit_choices_to']
         super().__init__(**kwargs)
+        # Resumable uploads should end up in our storage
+        self.widget.storage_name = storage
 
     @cached_property
     def storage(self):
-        return get_storage()
+        return get_storage(self.storage_name)
 
     def to_python(self, data):
         # Handle no incoming data
@@ -91,6 +96,11 @@ class FileField(Field):
 
     def prepare_value(self, value):
         ret = None
+        if self.resolver is not None:
+            try:
+                return self.resolver.get(self, value)
+            except KeyError:
+                pass
         if self.queryset is not None:
             try:
                 # If value is a data-tuple from get_value_from_datadict,
@@ -103,6 +113,9 @@ class FileField(Field):
                     else:
                         # If not, return None
                         return ret
+                elif value in self.empty_values:
+                    # Nothing to look up
+                    return ret
                 else:
                     # Otherwise, we assume we got a PK from the form
                     model = self.queryset.get(pk=value)
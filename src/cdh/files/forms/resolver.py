@@ -0,0 +1,215 @@
+import uuid as uuid_lib
+
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, \
+    ValidationError
+from django.db.models import Q
+
+
+def _get_file_fields(form) -> list:
+    """Returns the (name, field) pairs of the FileFields of a form"""
+    # Local import to prevent cycles
+    from .fields import FileField
+    return [
+        (name, field) for name, field in form.fields.items()
+        if isinstance(field, FileField) and field.queryset is not None
+    ]
+
+
+def _get_queryset_key(queryset):
+    """Returns a key shared by all querysets returning the same files, so
+    they can be combined in one query"""
+    if not queryset.query.has_filters():
+        return queryset.model, queryset.db
+
+    # Form fields get a copy of the queryset per form, so filtered querysets
+    # are compared by the query they run
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        # Nothing to combine; it doesn't return any files anyway
+        return id(queryset)
+    return queryset.model, queryset.db, sql, repr(params)
+
+
+def get_value_key(value):
+    """Returns the key a FileField form value is resolved under, or None if
+    the value doesn't refer to a file"""
+    if isinstance(value, tuple):
+        # A data-tuple from the widget; we only need the UUID
+        return ('uuid', str(value[1])) if value[1] else None
+    if value in (None, '') or hasattr(value, '_meta'):
+        return None
+    return 'pk', str(value)
+
+
+class FileResolver:
+    """Resolves the values of the FileFields of a group of forms, like the
+    forms of a formset, in one query per File model.
+
+    Rendering a FileField needs the File its value refers to, which is
+    otherwise retrieved per field per form. Forms added to the resolver have
+    all their files loaded the first time one of them is needed. The model
+    instances of ModelForms get the files cached as well, so saving the forms
+    doesn't retrieve them again.
+    """
+
+    def __init__(self, forms=()):
+        self._pending = []
+        # Per form field, the wrappers (or None) per value key
+        self._resolved = {}
+        for form in forms:
+            self.add(form)
+
+    def add(self, form) -> None:
+        """Adds a form, whose files will be loaded with the next resolve()"""
+        for name, field in _get_file_fields(form):
+            field.resolver = self
+        form.file_resolver = self
+        self._pending.append(form)
+
+    def get(self, field, value):
+        """Returns the FileWrapper the value of the given field refers to,
+        or None if it doesn't exist. Raises KeyError if the value wasn't
+        resolved, in which case the field should look it up itself."""
+        self.resolve()
+        key = get_value_key(value)
+        if key is None:
+            raise KeyError(value)
+        return self._resolved[field][key]
+
+    def resolve(self) -> None:
+        """Loads the files of all forms added since the last call"""
+        if not self._pending:
+            return
+        forms, self._pending = self._pending, []
+
+        groups = {}
+        for form in forms:
+            for name, field in _get_file_fields(form):
+                queryset, pks, uuids, fields = groups.setdefault(
+                    _get_queryset_key(field.queryset),
+                    (field.queryset, set(), set(), [])
+                )
+                fields.append(field)
+
+                initial = form.get_initial_for_field(field, name)
+                key = get_value_key(initial)
+                if key is not None:
+                    pks.add(key[1])
+                if form.is_bound and hasattr(field.widget, 'id_from_datadict'):
+                    uuid = field.widget.id_from_datadict(
+                        form.data,
+                        form.add_prefix(name)
+                    )
+                    if uuid:
+                        uuids.add(str(uuid))
+
+        files = {}
+        for queryset, pks, uuids, fields in groups.values():
+            resolved = self._resolve_queryset(queryset, pks, uuids, files)
+            for field in fields:
+                self._resolved[field] = resolved
+
+        for form in forms:
+            self._cache_on_instance(form, files)
+
+    @staticmethod
+    def _resolve_queryset(queryset, pks, uuids, files) -> dict:
+        pk_field = queryset.model._meta.pk
+        valid_pks = set()
+        for pk in pks:
+            try:
+                valid_pks.add(pk_field.to_python(pk))
+            except ValidationError:
+                pass
+        valid_uuids = set()
+        for uuid in uuids:
+            try:
+                valid_uuids.add(uuid_lib.UUID(uuid))
+            except ValueError:
+                pass
+
+        # Invalid values are left to the field, so it can complain about
+        # them the way it always did
+        resolved = {('pk', str(pk)): None for pk in valid_pks}
+        resolved.update({('uuid', str(uuid)): None for uuid in valid_uuids})
+        if not resolved:
+            return resolved
+
+        for file in queryset.filter(
+                Q(pk__in=valid_pks) | Q(uuid__in=valid_uuids)
+        ):
+            file_wrapper = file.get_file_wrapper()
+            resolved[('pk', str(file.pk))] = file_wrapper
+            resolved[('uuid', str(file.uuid))] = file_wrapper
+            files[(file.__class__, file.pk)] = file
+
+        return resolved
+
+    @staticmethod
+    def _cache_on_instance(form, files) -> None:
+        """Caches the resolved files on the model instance of a ModelForm,
+        like prefetch_files does"""
+        # Local import to prevent cycles
+        from ..db import FileField
+
+        instance = getattr(form, 'instance', None)
+        if instance is None or not hasattr(instance, '_meta'):
+            return
+
+        for name, field in _get_file_fields(form):
+            try:
+                model_field = instance._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if not isinstance(model_field, FileField) or \
+                    model_field.is_cached(instance):
+                continue
+
+            file = files.get((
+                model_field.remote_field.model,
+                getattr(instance, model_field.attname)
+            ))
+            if file is not None:
+                # We know this File is attached to this field, no need to
+                # check
+                model_field.set_cached_value(
+                    instance,
+                    file.get_file_wrapper(model_field, only_existing=False)
+                )
+
+
+class FileResolverFormMixin:
+    """Form mixin that loads the files of all FileFields of the form at once,
+    instead of one query per field. See FileResolver."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        FileResolver([self])
+
+    def full_clean(self):
+        # Saving a ModelForm assigns the values to the instance, which
+        # can use the resolved files
+        self.file_resolver.resolve()
+        super().full_clean()
+
+
+class FileResolverFormSetMixin:
+    """Formset mixin that loads the files of all FileFields of all its forms
+    in one query per File model, instead of one query per field per form.
+    See FileResolver."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file_resolver = FileResolver()
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        self.file_resolver.add(form)
+        return form
+
+    def full_clean(self):
+        # Constructing the forms adds them to the resolver
+        if self.forms:
+            self.file_resolver.resolve()
+        super().full_clean()
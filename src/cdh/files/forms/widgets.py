@@ -1,6 +1,11 @@
+from django.core.exceptions import ValidationError
 from django.forms.widgets import FileInput
+from django.urls import NoReverseMatch, reverse
+from django.utils.http import urlencode
 from django.utils.translation import gettext_lazy as _
 
+from cdh.files import settings
+
 
 class SimpleFileInput(FileInput):
     clear_checkbox_label = _('Clear')
@@ -19,6 +24,15 @@ class SimpleFileInput(FileInput):
         'select_file': _('Select File'),
     }
 
+    # Whether files should be sent as resumable uploads if possible. Needs
+    # cdh.files.urls to be included in your urlconf, and cdh.core's
+    # ThreadLocalUserMiddleware to check who is submitting an upload.
+    chunked_upload = True
+
+    # The storage the field stores files in (see CDH_FILES_STORAGES), set by
+    # the form field. Resumable uploads are written to it as well.
+    storage_name = None
+
     def __init__(self, attrs=None):
         """Update strings from attrs if present"""
         if attrs:
@@ -36,26 +50,84 @@ class SimpleFileInput(FileInput):
             'input_text': self.input_text,
             'initial_text': self.initial_text,
             'clear_checkbox_label': self.clear_checkbox_label,
+            'upload_url': self.get_upload_url(),
         })
         return context
 
+    def get_upload_url(self) -> str:
+        """Returns the URL resumable uploads are started at, or an empty
+        string if they are not available"""
+        if not self.chunked_upload or not settings._tlum_loaded:  # NoQA
+            return ''
+        if not settings.CHUNKED_UPLOAD_ALLOW_ANONYMOUS and \
+                self.get_user() is None:
+            return ''
+        try:
+            url = reverse('cdh.files:upload_create')
+        except NoReverseMatch:
+            return ''
+        if self.storage_name:
+            url += '?' + urlencode({'storage': self.storage_name})
+        return url
+
+    @staticmethod
+    def get_chunked_upload(upload_id, storage_name=None, user=None):
+        """Returns the completed resumable upload with the given id as an
+        UploadedFile, or None if there is no such upload. Only uploads
+        started by the given user (None for anonymous users) in the given
+        storage are returned."""
+        # Local import to prevent cycles
+        from ..db import UploadSession
+        try:
+            session = UploadSession.objects.filter(
+                uuid=upload_id,
+                completed_on__isnull=False,
+                created_by=user,
+                storage_name=storage_name or '',
+            ).first()
+            if session is not None:
+                return session.as_uploaded_file(session.storage)
+        except (ValidationError, FileNotFoundError):
+            # Not a valid UUID, or the upload was already used
+            pass
+        return None
+
+    @staticmethod
+    def get_user():
+        """Returns the user submitting the form, or None for anonymous
+        users"""
+        from cdh.core.middleware import get_current_authenticated_user
+        return get_current_authenticated_user()
+
     def value_from_datadict(self, data, files, name):
         file = files.get(name)
-        uuid = data.get(f"{name}_id")
+        # Without the middleware we cannot tell whose upload it is
+        if file is None and data.get(f"{name}_upload") and \
+                settings._tlum_loaded:  # NoQA
+            file = self.get_chunked_upload(
+                data.get(f"{name}_upload"),
+                self.storage_name,
+                self.get_user(),
+            )
+        uuid = self.id_from_datadict(data, name)
         changed = data.get(f"{name}_changed") == self.CHANGED
 
-        # If ID is not set, an empty string is returned. In which case we set
-        # it to None, as it's a bit nicer to work with
-        if not uuid:
-            uuid = None
-
         return file, uuid, changed
 
+    def id_from_datadict(self, data, name):
+        """Returns the UUID of the current file as sent by the widget, or
+        None"""
+        # If ID is not set, an empty string is returned. In which case we
+        # return None, as it's a bit nicer to work with
+        return data.get(f"{name}_id") or None
+
     def value_omitted_from_data(self, data, files, name):
         changed = data.get(f"{name}_changed") == self.CHANGED
-        # If we don't see ourselves in the files-dict OR the data dict
-        # indicates nothing changed, act like we didn't get any data
-        return name not in files or not changed
+        # If we don't see ourselves in the files-dict (or a resumable upload)
+        # OR the data dict indicates nothing changed, act like we didn't get
+        # any data
+        uploaded = name in files or bool(data.get(f"{name}_upload"))
+        return not uploaded or not changed
 
 
 class TrackedFileInput(SimpleFileInput):
@@ -69,6 +141,9 @@ class TrackedFileInput(SimpleFileInput):
         'select_existing': _('Select existing'),
     }
 
+    # The number of previous files listed; None lists all of them
+    history_limit = 20
+
     def get_context(self, name, value, attrs):
         context = super().get_context(name, value, attrs)
         context['widget'].update({
@@ -76,5 +151,7 @@ class TrackedFileInput(SimpleFileInput):
             'input_text': self.input_text,
             'initial_text': self.initial_text,
             'clear_checkbox_label': self.clear_checkbox_label,
+            'history': value.history(limit=self.history_limit)
+            if hasattr(value, 'history') else [],
         })
         return context
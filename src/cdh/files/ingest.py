@@ -0,0 +1,351 @@
+"""Bulk import of directory trees into cdh.files.
+
+Saving files one by one through FileWrapper.save() is fine for uploads, but
+slow for importing an archive of 100k files. ingest() walks a directory
+tree instead, and lets a pool of worker processes hash, sniff and copy the
+files into the storage, reading every file only once. The File rows are
+created by the calling process with bulk_create(), one batch at a time,
+while the workers are busy with the next batch.
+
+Every imported file is recorded in a manifest, a CSV file with the path of
+the file (relative to the directory) and the UUID of its File. This lets
+you link the new Files to your own models, and makes imports resumable: a
+file already in the manifest is not imported again.
+
+Nothing refers to the new Files yet, so they are recorded as UnlinkedFiles,
+which files_gc leaves alone. Once a File is linked to a model, files_gc drops
+its record. If an import is interrupted between creating a batch of rows and
+adding them to the manifest, those rows are kept without being in the
+manifest, and their files are imported again on the next run. Delete the
+UnlinkedFiles created around that time to have files_gc remove them.
+"""
+import csv
+import hashlib
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, NamedTuple, Optional, Type
+
+import django
+import magic
+from django.core.files import File
+from django.db import connections, transaction
+from django.utils import timezone
+
+from cdh.files.storage import StagedBlob
+from cdh.files.uploadhandler import SNIFF_LENGTH
+from cdh.files.utils import get_storage
+
+logger = logging.getLogger('cdh.files')
+
+
+class IngestedFile(NamedTuple):
+    """The outcome of importing one file, as reported by a worker"""
+    path: str
+    uuid: str
+    original_filename: str
+    content_type: str = ''
+    size: int = 0
+    checksum: str = ''
+    encoding: str = ''
+    # Only for content addressed storages; committed by the main process
+    staged: Optional[StagedBlob] = None
+    error: str = ''
+
+
+class IngestResult:
+    """Running totals of an import"""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / max(self.elapsed, 1e-6)
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / max(self.elapsed, 1e-6)
+
+    def __str__(self):
+        return (
+            f"{self.files} files ({self.bytes / 2 ** 20:.1f} MB) in "
+            f"{self.elapsed:.1f}s; {self.files_per_second:.1f} files/s, "
+            f"{self.bytes_per_second / 2 ** 20:.1f} MB/s; "
+            f"{self.skipped} skipped, {self.failed} failed"
+        )
+
+
+class _HashingFile(File):
+    """Calculates the checksum and size of a file while the storage reads
+    it"""
+
+    def __init__(self, file, name=None):
+        super().__init__(file, name)
+        self.checksum = hashlib.sha256()
+        self.read_size = 0
+
+    def chunks(self, chunk_size=None):
+        for chunk in super().chunks(chunk_size):
+            self.checksum.update(chunk)
+            self.read_size += len(chunk)
+            yield chunk
+
+
+def scan(directory: str, include_hidden: bool = False) -> Iterator[str]:
+    """Yields the paths of all regular files below the given directory,
+    relative to it and in a stable order. Symlinks are not followed."""
+    stack = ['']
+    while stack:
+        relative_directory = stack.pop()
+        with os.scandir(os.path.join(directory, relative_directory)) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        subdirectories = []
+        for entry in entries:
+            if entry.name.startswith('.') and not include_hidden:
+                continue
+            relative_path = os.path.join(relative_directory, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(relative_path)
+            elif entry.is_file(follow_symlinks=False):
+                yield relative_path
+        stack.extend(reversed(subdirectories))
+
+
+def _store(task) -> IngestedFile:
+    """Copies one file into the storage. Runs in a worker process, so it
+    doesn't touch the database."""
+    path, relative_path, file_uuid = task
+    original_filename = os.path.basename(path)[:255]
+    storage = get_storage()
+
+    try:
+        with open(path, 'rb') as source:
+            content_type = magic.from_buffer(
+                source.read(SNIFF_LENGTH),
+                mime=True
+            )
+            source.seek(0)
+            size = os.fstat(source.fileno()).st_size
+
+            if getattr(storage, 'content_addressed', False):
+                staged = storage.stage_blob(File(source))
+                return IngestedFile(
+                    relative_path,
+                    file_uuid,
+                    original_filename,
+                    content_type,
+                    staged.size,
+                    staged.checksum,
+                    staged=staged,
+                )
+
+            content = _HashingFile(source, original_filename)
+            encoding = ''
+            # Storages compressing at rest decide per file
+            if hasattr(storage, 'get_encoding'):
+                encoding = storage.get_encoding(content_type, size)
+            storage.save(
+                file_uuid,
+                storage.encode(content, encoding) if encoding else content
+            )
+            return IngestedFile(
+                relative_path,
+                file_uuid,
+                original_filename,
+                content_type,
+                content.read_size,
+                content.checksum.hexdigest(),
+                encoding,
+            )
+    except OSError as e:
+        return IngestedFile(
+            relative_path,
+            file_uuid,
+            original_filename,
+            error=str(e)
+        )
+
+
+def read_manifest(manifest: str) -> dict:
+    """Returns the files recorded in the given manifest, as a dict of
+    relative paths to File UUIDs"""
+    if not os.path.exists(manifest):
+        return {}
+    with open(manifest, newline='') as file:
+        return {row[0]: row[1] for row in csv.reader(file) if row}
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ingest(
+        directory: str,
+        manifest: str,
+        model: Type = None,
+        workers: int = None,
+        batch_size: int = 500,
+        include_hidden: bool = False,
+        created_by=None,
+        progress: Callable[[IngestResult], None] = None,
+) -> IngestResult:
+    """Imports all files below the given directory, see the module
+    documentation.
+
+    :param directory: The directory to import
+    :param manifest: Path of the manifest CSV file; appended to if it exists
+    :param model: The File model to create rows of; defaults to File
+    :param workers: Number of worker processes; 1 does everything in this
+                    process. Defaults to the number of CPUs.
+    :param batch_size: Number of files per bulk_create()
+    :param include_hidden: Whether to import files and directories whose
+                           name starts with a dot
+    :param created_by: The user to record as the creator of the files
+    :param progress: Called with the running totals after every batch
+    """
+    if model is None:
+        # Local import to prevent cycles
+        from cdh.files.db import File as model
+    if batch_size < 1:
+        raise ValueError("batch_size should be at least 1")
+
+    directory = os.path.abspath(directory)
+    workers = workers or os.cpu_count() or 1
+    storage = get_storage()
+    result = IngestResult()
+
+    done = read_manifest(manifest)
+    result.skipped = len(done)
+    paths = (
+        path for path in scan(directory, include_hidden) if path not in done
+    )
+    batches = (
+        [
+            (os.path.join(directory, path), path, str(uuid.uuid4()))
+            for path in batch
+        ]
+        for batch in _batched(paths, batch_size)
+    )
+
+    pool = None
+    if workers > 1:
+        # Forked workers should not share our database connections
+        connections.close_all()
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=django.setup,
+        )
+
+    def submit(batch):
+        if pool is None:
+            return [_store(task) for task in batch]
+        return [pool.submit(_store, task) for task in batch]
+
+    def collect(submitted):
+        if pool is None:
+            return submitted
+        return [future.result() for future in submitted]
+
+    try:
+        with open(manifest, 'a', newline='') as manifest_file:
+            writer = csv.writer(manifest_file)
+            # Keep the workers busy with the next batch while we create the
+            # rows of the current one
+            pending = deque()
+            for batch in batches:
+                pending.append(submit(batch))
+                if len(pending) > 1:
+                    _create_rows(
+                        collect(pending.popleft()), model, storage,
+                        created_by, writer, manifest_file, result
+                    )
+                    if progress:
+                        progress(result)
+            while pending:
+                _create_rows(
+                    collect(pending.popleft()), model, storage,
+                    created_by, writer, manifest_file, result
+                )
+                if progress:
+                    progress(result)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return result
+
+
+def _create_rows(ingested, model, storage, created_by, writer, manifest_file,
+                 result):
+    failed = [file for file in ingested if file.error]
+    for file in failed:
+        logger.error(f"Could not import {file.path}: {file.error}")
+    result.failed += len(failed)
+    ingested = [file for file in ingested if not file.error]
+    if not ingested:
+        return
+
+    now = timezone.now()
+    rows = [
+        model(
+            uuid=file.uuid,
+            original_filename=file.original_filename,
+            content_type=file.content_type,
+            size=file.size,
+            checksum=file.checksum,
+            encoding=file.encoding,
+            stored_at=now,
+            created_by=created_by,
+        )
+        for file in ingested
+    ]
+
+    # Local import to prevent cycles
+    from cdh.files.db import Blob, UnlinkedFile
+
+    try:
+        with transaction.atomic(using=model.objects.db):
+            if getattr(storage, 'content_addressed', False):
+                for row, file in zip(rows, ingested):
+                    row.blob = Blob.objects.acquire(file.checksum, file.size)
+                    storage.commit_blob(file.staged)
+            model.objects.bulk_create(rows)
+            UnlinkedFile.objects.record(model, [row.uuid for row in rows])
+    except BaseException:
+        # Don't leave copies without rows behind. (Blobs without a row are
+        # left to files_gc, as they might be shared.)
+        if not getattr(storage, 'content_addressed', False):
+            for file in ingested:
+                storage.delete(file.uuid)
+        raise
+    finally:
+        for file in ingested:
+            if file.staged:
+                storage.discard_blob(file.staged)
+
+    for file in ingested:
+        writer.writerow([file.path, file.uuid])
+    manifest_file.flush()
+    os.fsync(manifest_file.fileno())
+
+    result.files += len(ingested)
+    result.bytes += sum(file.size for file in ingested)
@@ -0,0 +1,62 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from cdh.files.db import TrackedFileField
+
+
+class Command(BaseCommand):
+    help = "Adds the indexes and constraints of the linking tables of " \
+           "TrackedFileFields created before these were introduced. " \
+           "Linking tables are created automatically, so Django's migrations " \
+           "won't pick up changes to them. Indexes that already exist are " \
+           "left alone, so this can be run safely at any time."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database',
+            default=DEFAULT_DB_ALIAS,
+            help="The database to add the indexes to",
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        added = 0
+
+        for model in apps.get_models():
+            for field in model._meta.local_many_to_many:
+                if not isinstance(field, TrackedFileField):
+                    continue
+                added += self._add_missing(
+                    connection,
+                    field.remote_field.through
+                )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done; added {added} indexes and constraints"
+        ))
+
+    def _add_missing(self, connection, through):
+        table = through._meta.db_table
+        with connection.cursor() as cursor:
+            existing = connection.introspection.get_constraints(cursor, table)
+
+        added = 0
+        with connection.schema_editor() as schema_editor:
+            for index in through._meta.indexes:
+                if index.name not in existing:
+                    schema_editor.add_index(through, index)
+                    self.stdout.write(f"{table}: added {index.name}")
+                    added += 1
+
+            for constraint in through._meta.constraints:
+                # Would be silently skipped by the schema editor
+                if constraint.condition is not None and \
+                        not connection.features.supports_partial_indexes:
+                    continue
+                if constraint.name not in existing:
+                    schema_editor.add_constraint(through, constraint)
+                    self.stdout.write(f"{table}: added {constraint.name}")
+                    added += 1
+
+        return added
@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand
+
+from cdh.files.utils import get_file_models
+
+
+class Command(BaseCommand):
+    help = "Fills the size, checksum and stored_at columns of files stored " \
+           "before these were recorded. Only rows without stored_at are " \
+           "processed, so the command can be safely interrupted and " \
+           "restarted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Number of File rows to fetch and update per query",
+        )
+        parser.add_argument(
+            '--no-checksum',
+            action='store_false',
+            dest='checksum',
+            help="Only record the size, without reading the files to "
+                 "calculate their checksums",
+        )
+
+    def handle(self, *args, **options):
+        for model in get_file_models():
+            self._backfill_model(
+                model,
+                options['batch_size'],
+                options['checksum']
+            )
+
+    def _backfill_model(self, model, batch_size, checksum):
+        updated = missing = 0
+        last_pk = None
+
+        while True:
+            qs = model.objects.filter(stored_at__isnull=True).select_related(
+                'blob'
+            ).order_by('pk')
+            if last_pk is not None:
+                qs = qs.filter(pk__gt=last_pk)
+            batch = list(qs[:batch_size])
+            if not batch:
+                break
+
+            changed = []
+            for file_instance in batch:
+                last_pk = file_instance.pk
+                if self._backfill_instance(file_instance, checksum):
+                    changed.append(file_instance)
+                else:
+                    missing += 1
+
+            # bulk_update leaves modified_on alone, which is what we want
+            model.objects.bulk_update(
+                changed,
+                ['size', 'checksum', 'stored_at']
+            )
+            updated += len(changed)
+
+            self.stdout.write(
+                f"{model._meta.label}: {updated} updated, "
+                f"{missing} missing on disk"
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{model._meta.label}: done; {updated} updated, "
+            f"{missing} missing on disk"
+        ))
+
+    @staticmethod
+    def _backfill_instance(file_instance, checksum) -> bool:
+        wrapper = file_instance.get_file_wrapper()
+
+        if file_instance.blob_id:
+            # Blobs already know everything we need
+            file_instance.size = file_instance.blob.size
+            file_instance.checksum = file_instance.blob_id
+        else:
+            storage = wrapper.storage
+            if not storage.exists(wrapper.name_on_disk):
+                return False
+
+            file_instance.size = storage.size(wrapper.name_on_disk)
+            if checksum:
+                with storage.open(wrapper.name_on_disk, 'rb') as file:
+                    file_instance.checksum = wrapper.inspect_content(file)[0]
+
+        # The best guess we have for when the contents were stored
+        file_instance.stored_at = file_instance.modified_on
+        return True
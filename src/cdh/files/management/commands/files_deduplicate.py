@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cdh.files.db import Blob
+from cdh.files.storage import open_decoded
+from cdh.files.utils import get_file_models, get_storage
+
+
+class Command(BaseCommand):
+    help = "Converts files stored under their UUID to shared blobs. Requires " \
+           "a content addressed storage (e.g. " \
+           "cdh.files.storage.ContentAddressedFileStorage). Files are " \
+           "converted in place without copying, and the command can be " \
+           "safely interrupted and restarted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Number of File rows to fetch per query",
+        )
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        if not getattr(storage, 'content_addressed', False):
+            raise CommandError(
+                "CDH_FILES_STORAGE is not a content addressed storage"
+            )
+
+        for model in get_file_models():
+            self._convert_model(model, storage, options['batch_size'])
+
+    def _convert_model(self, model, storage, batch_size):
+        converted = missing = 0
+        last_pk = None
+
+        while True:
+            qs = model.objects.filter(blob__isnull=True).order_by('pk')
+            if last_pk is not None:
+                qs = qs.filter(pk__gt=last_pk)
+            batch = list(
+                qs.values_list('pk', 'uuid', 'encoding')[:batch_size]
+            )
+            if not batch:
+                break
+
+            for pk, uuid, encoding in batch:
+                last_pk = pk
+                name = str(uuid)
+                if not storage.exists(name):
+                    missing += 1
+                    continue
+
+                if encoding:
+                    # Blobs are stored as is, so these need to be decoded
+                    # into a new file instead
+                    with open_decoded(storage.open(name), encoding) as file:
+                        staged = storage.stage_blob(file)
+                else:
+                    staged = storage.stage_existing(name)
+                try:
+                    with transaction.atomic():
+                        blob = Blob.objects.acquire(
+                            staged.checksum,
+                            staged.size
+                        )
+                        storage.commit_blob(staged)
+                        model.objects.filter(pk=pk).update(
+                            blob=blob,
+                            encoding='',
+                        )
+                finally:
+                    storage.discard_blob(staged)
+                storage.delete(name)
+                converted += 1
+
+            self.stdout.write(
+                f"{model._meta.label}: {converted} converted, "
+                f"{missing} missing on disk"
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{model._meta.label}: done; {converted} converted, "
+            f"{missing} missing on disk"
+        ))
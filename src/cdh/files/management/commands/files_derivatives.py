@@ -0,0 +1,137 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from cdh.files import derivatives
+from cdh.files.utils import get_file_models, get_storage
+
+
+def _generate(task):
+    """Generates the missing derivatives of one file. Runs in a worker
+    process, so it only gets plain data and doesn't touch the database."""
+    storage_name, name_on_disk, content_type, encoding, missing = task
+    storage = get_storage(storage_name)
+    generated = 0
+    for spec, name in missing:
+        if derivatives.generate(
+                storage,
+                name_on_disk,
+                content_type,
+                encoding,
+                spec,
+                name,
+        ):
+            generated += 1
+    return generated
+
+
+class Command(BaseCommand):
+    help = "Generates the derivatives (e.g. thumbnails) of all images and " \
+           "PDFs that don't have them yet, using a pool of worker " \
+           "processes. Derivatives are otherwise generated on first use, " \
+           "which makes the first view of a page listing many files slow."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--spec',
+            action='append',
+            dest='specs',
+            help="Only generate derivatives with this spec; can be given "
+                 "more than once. Defaults to all of CDH_FILES_DERIVATIVES",
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of worker processes; 1 generates everything in "
+                 "this process",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help="Number of files to hand to the workers at once",
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help="Regenerate derivatives that already exist",
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size should be at least 1")
+        try:
+            specs = [
+                derivatives.get_spec(name) for name in options['specs']
+            ] if options['specs'] else derivatives.get_specs()
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.specs = specs
+        self.force = options['force']
+
+        if options['workers'] > 1:
+            # Forked workers should not share our database connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                    max_workers=options['workers'],
+                    initializer=django.setup,
+            ) as pool:
+                generated = self._generate_all(pool.map, options)
+        else:
+            generated = self._generate_all(map, options)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done; generated {generated} derivatives"
+        ))
+
+    def _generate_all(self, map_function, options):
+        generated = 0
+        for model in get_file_models():
+            for batch in self._batches(model, options['batch_size']):
+                tasks = [task for task in map(self._get_task, batch) if task]
+                generated += sum(map_function(_generate, tasks))
+                self.stdout.write(
+                    f"{model._meta.label}: generated {generated} derivatives"
+                )
+        return generated
+
+    def _batches(self, model, batch_size):
+        content_types = derivatives.IMAGE_CONTENT_TYPES + \
+            derivatives.PDF_CONTENT_TYPES
+        queryset = model.objects.filter(
+            content_type__in=content_types,
+            stored_at__isnull=False,
+        ).order_by('pk')
+
+        last_pk = None
+        while True:
+            batch_queryset = queryset
+            if last_pk is not None:
+                batch_queryset = queryset.filter(pk__gt=last_pk)
+            batch = list(batch_queryset[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            yield batch
+
+    def _get_task(self, file):
+        file_wrapper = file.get_file_wrapper(only_existing=False)
+        missing = []
+        for spec in self.specs:
+            name = derivatives.get_name(file.uuid, spec)
+            if self.force or not file_wrapper.storage.exists(name):
+                missing.append((spec, name))
+        if not missing:
+            return None
+        return (
+            file_wrapper.storage_name,
+            file_wrapper.name_on_disk,
+            file.content_type,
+            file.encoding,
+            missing,
+        )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from cdh.files.db import UploadSession
+
+
+class Command(BaseCommand):
+    help = "Removes resumable uploads that saw no activity for " \
+           "CDH_FILES_CHUNKED_UPLOAD_EXPIRY seconds, along with everything " \
+           "received for them. Expired uploads are also removed whenever a " \
+           "new upload is started, a few at a time; run this periodically " \
+           "to clean up the rest."
+
+    def handle(self, *args, **options):
+        removed = UploadSession.objects.expire()
+        self.stdout.write(self.style.SUCCESS(
+            f"Done; removed {removed} expired uploads"
+        ))
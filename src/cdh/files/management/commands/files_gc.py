@@ -0,0 +1,272 @@
+import os
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import chain, islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from cdh.files.db import Blob, UnlinkedFile, UploadSession
+from cdh.files.deletion import deletion_batch
+from cdh.files.utils import DEFAULT_STORAGE, get_file_models, storages
+
+CHECKSUM_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _scan(directory, skip_directories):
+    """Yields the DirEntry of every file below the given directory, except
+    for hidden files (e.g. staged blobs) and the given directories"""
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in skip_directories:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+
+
+def _file_key(name):
+    """Returns the UUID of the File a file on disk belongs to, or None if
+    it's not one of ours. Files may have a suffix after the UUID (e.g.
+    derivatives), separated by a dot."""
+    try:
+        return str(uuid.UUID(name.split('.', 1)[0]))
+    except ValueError:
+        return None
+
+
+def _blob_key(name):
+    return name if CHECKSUM_RE.match(name) else None
+
+
+class Command(BaseCommand):
+    help = "Removes files from the storage that have no File (or Blob) row, " \
+           "and File rows no model refers to anymore. The storage and the " \
+           "database are compared in batches, so this can run on storages " \
+           "with millions of files. Anything created within the grace " \
+           "period is left alone, as it might be part of a request still " \
+           "in progress."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only report what would be removed",
+        )
+        parser.add_argument(
+            '--grace-period',
+            type=float,
+            default=24,
+            help="Hours; only files and rows older than this are removed",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help="Number of files or rows to compare per query",
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help="Number of threads removing files from the storage",
+        )
+        parser.add_argument(
+            '--skip-rows',
+            action='store_true',
+            help="Don't look for unreferenced File rows",
+        )
+        parser.add_argument(
+            '--skip-storage',
+            action='store_true',
+            help="Don't look for files without a File or Blob row",
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+        if self.batch_size < 1:
+            raise CommandError("--batch-size should be at least 1")
+
+        cutoff = timezone.now() - timedelta(hours=options['grace_period'])
+
+        # Rows first; their files are removed along with them, so they
+        # won't show up as orphans below
+        if not options['skip_rows']:
+            for model in get_file_models():
+                self._collect_rows(model, cutoff)
+
+        if not options['skip_storage']:
+            scanned_roots = set()
+            with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+                for name, storage in storages.all().items():
+                    try:
+                        root = storage.path('')
+                    except NotImplementedError:
+                        raise CommandError(
+                            f"The storage '{name}' is not a filesystem "
+                            f"storage; cannot scan it for orphaned files"
+                        )
+                    # Several names may refer to the same location, and
+                    # nothing might have been stored yet
+                    if root in scanned_roots or not os.path.isdir(root):
+                        continue
+                    scanned_roots.add(root)
+
+                    prefix = '' if name == DEFAULT_STORAGE else f"{name}: "
+                    self._collect_storage(prefix, storage, root, cutoff, pool)
+
+    def _collect_storage(self, prefix, storage, root, cutoff, pool):
+        blob_root = storage.path(
+            getattr(storage, 'blob_directory', 'blobs')
+        )
+        entries = _scan(root, {blob_root})
+        # Files moved to the cold tier of a TieredFileStorage
+        if getattr(storage, 'tiered', False) and \
+                os.path.isdir(storage.cold_location):
+            entries = chain(
+                entries,
+                _scan(storage.cold_location, set())
+            )
+
+        self._collect_files(
+            f'{prefix}files',
+            entries,
+            _file_key,
+            self._existing_files,
+            cutoff,
+            pool,
+        )
+        if getattr(storage, 'content_addressed', False) and \
+                os.path.isdir(blob_root):
+            self._collect_files(
+                f'{prefix}blobs',
+                _scan(blob_root, set()),
+                _blob_key,
+                self._existing_blobs,
+                cutoff,
+                pool,
+            )
+
+    def _collect_rows(self, model, cutoff):
+        label = model._meta.label
+        if not self.dry_run:
+            # Imported Files that are linked by now are no longer special
+            UnlinkedFile.objects.release_linked(model)
+        queryset = model.objects.unreferenced().filter(
+            created_on__lt=cutoff
+        ).order_by('pk')
+
+        found = 0
+        last_pk = None
+        while True:
+            batch_queryset = queryset
+            if last_pk is not None:
+                batch_queryset = queryset.filter(pk__gt=last_pk)
+            pks = list(
+                batch_queryset.values_list('pk', flat=True)[:self.batch_size]
+            )
+            if not pks:
+                break
+            last_pk = pks[-1]
+            found += len(pks)
+
+            if not self.dry_run:
+                # Check again, something might refer to them by now. The
+                # files on disk are removed by our pre_delete signal
+                with deletion_batch(model.objects.db):
+                    model.objects.unreferenced().filter(pk__in=pks).delete()
+
+            self.stdout.write(f"{label}: {found} unreferenced rows")
+
+        self._report(f"{label}: {found} unreferenced rows", found)
+
+    @staticmethod
+    def _existing_files(keys):
+        # Resumable uploads are stored under the UUID of their session until
+        # they are used; files_expire_uploads takes care of those
+        existing = {
+            str(value) for value in
+            UploadSession.objects.filter(uuid__in=keys).values_list(
+                'uuid',
+                flat=True
+            )
+        }
+        for model in get_file_models():
+            existing.update(
+                str(value) for value in
+                model.objects.filter(uuid__in=keys).values_list(
+                    'uuid',
+                    flat=True
+                )
+            )
+        return existing
+
+    @staticmethod
+    def _existing_blobs(keys):
+        return set(
+            Blob.objects.filter(pk__in=keys).values_list('pk', flat=True)
+        )
+
+    def _collect_files(self, label, entries, get_key, get_existing, cutoff,
+                       pool):
+        cutoff = cutoff.timestamp()
+        scanned = found = 0
+
+        for batch in _batched(entries, self.batch_size):
+            scanned += len(batch)
+            keyed = [(get_key(entry.name), entry) for entry in batch]
+            keys = {key for key, _ in keyed if key is not None}
+            existing = get_existing(keys) if keys else set()
+
+            orphans = []
+            for key, entry in keyed:
+                if key is None or key in existing:
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                # ctime also changes when a file is linked or moved into
+                # place, which doesn't update the mtime
+                if max(stat.st_mtime, stat.st_ctime) >= cutoff:
+                    continue
+                orphans.append(entry.path)
+
+            found += len(orphans)
+            if self.verbosity >= 2:
+                for path in orphans:
+                    self.stdout.write(f"Orphaned: {path}")
+            if orphans and not self.dry_run:
+                list(pool.map(self._remove, orphans))
+
+            self.stdout.write(
+                f"{label}: scanned {scanned}, {found} orphaned"
+            )
+
+        self._report(f"{label}: scanned {scanned}, {found} orphaned", found)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.stderr.write(f"Could not remove {path}: {e}")
+
+    def _report(self, message, found):
+        if self.dry_run:
+            message += " (dry run, nothing removed)"
+        elif found:
+            message += ", removed"
+        self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,84 @@
+import os
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from cdh.files.db import BaseFile
+from cdh.files.ingest import ingest
+
+
+class Command(BaseCommand):
+    help = "Imports all files below a directory into cdh.files, using a " \
+           "pool of worker processes to hash and copy the files and " \
+           "creating the File rows in batches. Imported files are listed " \
+           "in a manifest (a CSV file of paths and File UUIDs), which is " \
+           "used to skip them when the import is run again. The new Files " \
+           "should be linked to your models using the manifest; until " \
+           "then, files_gc leaves them alone."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'directory',
+            help="The directory to import",
+        )
+        parser.add_argument(
+            '--manifest',
+            default=None,
+            help="The manifest to write to and resume from. Defaults to "
+                 "<directory name>.ingest.csv in the current directory",
+        )
+        parser.add_argument(
+            '--model',
+            default='files.File',
+            help="The File model to import into, as app_label.ModelName",
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of worker processes; 1 imports everything in this "
+                 "process",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Number of files per batch of rows",
+        )
+        parser.add_argument(
+            '--include-hidden',
+            action='store_true',
+            help="Also import files and directories starting with a dot",
+        )
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size should be at least 1")
+
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError):
+            raise CommandError(f"Unknown model {options['model']}")
+        if not issubclass(model, BaseFile):
+            raise CommandError(f"{options['model']} is not a File model")
+
+        manifest = options['manifest'] or os.path.basename(
+            os.path.normpath(os.path.abspath(directory))
+        ) + '.ingest.csv'
+
+        result = ingest(
+            directory,
+            manifest,
+            model=model,
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            include_hidden=options['include_hidden'],
+            progress=lambda progress: self.stdout.write(str(progress)),
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done; imported {result}. The manifest is {manifest}"
+        ))
@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import mmap
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from cdh.files import settings
+from cdh.files.storage import open_decoded
+from cdh.files.utils import get_file_models, get_storage
+
+logger = logging.getLogger('cdh.files')
+
+CHUNK_SIZE = 2 ** 20
+
+OK = 'ok'
+MISSING = 'missing'
+CORRUPT = 'corrupt'
+
+
+def _throttle(started, done, rate):
+    """Sleeps until reading `done` bytes since `started` is within the given
+    rate (in bytes per second)"""
+    if rate:
+        delay = done / rate - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _hash_mapped(path, size, rate):
+    """Hashes a file on disk through a memory map, which saves copying the
+    data to Python objects"""
+    digest = hashlib.sha256()
+    started = time.monotonic()
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size != size:
+            return None
+        # Empty files cannot be mapped
+        if not size:
+            return digest.hexdigest()
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, CHUNK_SIZE):
+                    digest.update(view[offset:offset + CHUNK_SIZE])
+                    _throttle(
+                        started,
+                        min(offset + CHUNK_SIZE, size),
+                        rate
+                    )
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+def _hash_decoded(storage, name, encoding, rate):
+    """Hashes a file as read through the storage, for files that are stored
+    encoded or encrypted"""
+    digest = hashlib.sha256()
+    started = time.monotonic()
+    done = 0
+    with open_decoded(storage.open(name, 'rb'), encoding) as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            done += len(chunk)
+            _throttle(started, done, rate)
+    return digest.hexdigest()
+
+
+def _verify(task):
+    """Verifies the contents of one file against its checksum. Runs in a
+    worker process, so it only gets plain data and doesn't touch the
+    database. Every worker reads at most `rate` bytes per second."""
+    storage_name, name_on_disk, encoding, checksum, size, rate = task
+    storage = get_storage(storage_name)
+
+    try:
+        path = None
+        if not encoding and not getattr(storage, 'encrypted', False) and \
+                size is not None:
+            try:
+                path = storage.path(name_on_disk)
+            except NotImplementedError:
+                pass
+
+        if path is not None:
+            digest = _hash_mapped(path, size, rate)
+        else:
+            digest = _hash_decoded(storage, name_on_disk, encoding, rate)
+    except FileNotFoundError:
+        return MISSING
+    except (OSError, EOFError, zlib.error):
+        # Includes DecryptionError and truncated gzip streams
+        return CORRUPT
+
+    return OK if digest == checksum else CORRUPT
+
+
+class Command(BaseCommand):
+    help = "Verifies the contents of stored files against their recorded " \
+           "checksums, to detect bit rot and truncated files. Only files " \
+           "not verified within the interval (CDH_FILES_SCRUB_INTERVAL_DAYS) " \
+           "are read, so this can be run regularly and can be interrupted " \
+           "at any time. Use --max-rate to limit the I/O load on a live " \
+           "site. Exits with an error if any file is missing or corrupt. " \
+           "Missing and corrupt files are logged to the cdh.files logger, " \
+           "and listed on stderr with --verbosity 2 or higher."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=None,
+            help="Days; only files not verified within this period are "
+                 "verified. Defaults to CDH_FILES_SCRUB_INTERVAL_DAYS",
+        )
+        parser.add_argument(
+            '--max-rate',
+            type=float,
+            default=0,
+            help="Maximum number of MB per second to read, over all "
+                 "workers. 0 means unlimited",
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of worker processes; 1 verifies everything in this "
+                 "process",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help="Number of files to hand to the workers at once",
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size should be at least 1")
+        if options['workers'] < 1:
+            raise CommandError("--workers should be at least 1")
+        if options['max_rate'] < 0:
+            raise CommandError("--max-rate cannot be negative")
+
+        interval = options['interval']
+        if interval is None:
+            interval = settings.SCRUB_INTERVAL_DAYS
+        self.cutoff = timezone.now() - timedelta(days=interval)
+        # Every worker gets its share of the rate
+        self.rate = options['max_rate'] * 2 ** 20 / options['workers']
+        self.totals = {OK: 0, MISSING: 0, CORRUPT: 0}
+        self.verbosity = options['verbosity']
+
+        if options['workers'] > 1:
+            # Forked workers should not share our database connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                    max_workers=options['workers'],
+                    initializer=django.setup,
+            ) as pool:
+                self._verify_all(pool.map, options['batch_size'])
+        else:
+            self._verify_all(map, options['batch_size'])
+
+        message = f"Done; verified {self.totals[OK]} files, " \
+                  f"{self.totals[CORRUPT]} corrupt, " \
+                  f"{self.totals[MISSING]} missing"
+        if self.totals[CORRUPT] or self.totals[MISSING]:
+            raise CommandError(message)
+        self.stdout.write(self.style.SUCCESS(message))
+
+    def _verify_all(self, map_function, batch_size):
+        for model in get_file_models():
+            label = model._meta.label
+            for batch, started in self._batches(model, batch_size):
+                # Files sharing a blob only need to be read once
+                tasks = {}
+                for file in batch:
+                    file_wrapper = file.get_file_wrapper(only_existing=False)
+                    tasks.setdefault(
+                        (file_wrapper.storage_name, file_wrapper.name_on_disk),
+                        []
+                    ).append(file)
+
+                results = map_function(_verify, [
+                    (storage_name, name, files[0].encoding, files[0].checksum,
+                     files[0].size, self.rate)
+                    for (storage_name, name), files in tasks.items()
+                ])
+
+                verified = []
+                for ((_, name), files), result in zip(tasks.items(), results):
+                    self.totals[result] += len(files)
+                    if result == OK:
+                        verified.extend(file.pk for file in files)
+                        continue
+                    for file in files:
+                        message = f"{label}: {file.uuid} is {result} " \
+                                  f"({name})"
+                        logger.error(message)
+                        if self.verbosity > 1:
+                            self.stderr.write(message)
+
+                # Leave files saved with new contents in the meantime for
+                # the next run
+                if verified:
+                    model.objects.filter(
+                        pk__in=verified,
+                        stored_at__lt=started,
+                    ).update(verified_at=timezone.now())
+
+                self.stdout.write(
+                    f"{label}: verified {self.totals[OK]}, "
+                    f"{self.totals[CORRUPT]} corrupt, "
+                    f"{self.totals[MISSING]} missing"
+                )
+
+    def _batches(self, model, batch_size):
+        """Yields batches of files due for verification, and the time each
+        batch was fetched"""
+        queryset = model.objects.filter(
+            Q(verified_at__isnull=True) |
+            Q(verified_at__lt=self.cutoff) |
+            Q(verified_at__lt=F('stored_at')),
+            stored_at__isnull=False,
+        ).exclude(checksum='').order_by('pk')
+
+        last_pk = None
+        while True:
+            batch_queryset = queryset
+            if last_pk is not None:
+                batch_queryset = queryset.filter(pk__gt=last_pk)
+            started = timezone.now()
+            batch = list(batch_queryset[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            yield batch, started
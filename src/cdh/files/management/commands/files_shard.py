@@ -0,0 +1,81 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cdh.files.utils import get_storage
+
+
+class Command(BaseCommand):
+    help = "Moves files stored directly in CDH_FILES_FILE_ROOT to their " \
+           "sharded location, as configured by CDH_FILES_SHARD_DEPTH. " \
+           "Files are moved with atomic renames in small batches, so this " \
+           "can run while the site is up. It can be interrupted and " \
+           "restarted at any time."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help="Number of files to move before pausing",
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help="Seconds to pause between batches, to limit the I/O load",
+        )
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        if not getattr(storage, 'shard_depth', 0):
+            raise CommandError(
+                "Sharding is not enabled; please set CDH_FILES_SHARD_DEPTH"
+            )
+
+        root = storage.path('')
+        moved = 0
+        in_batch = 0
+
+        # scandir only lists the top level, which is exactly what we need;
+        # anything in a subdirectory is either sharded already or not ours
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or \
+                        not entry.is_file(follow_symlinks=False):
+                    continue
+
+                sharded_path = os.path.join(
+                    root,
+                    *storage.shard_name(entry.name).split('/')
+                )
+                if sharded_path == entry.path:
+                    continue
+
+                if os.path.lexists(sharded_path):
+                    # Should not happen, as saving removes the flat file
+                    self.stderr.write(
+                        f"Skipping {entry.name}: a file already exists in "
+                        f"its sharded location"
+                    )
+                    continue
+
+                os.makedirs(
+                    os.path.dirname(sharded_path),
+                    mode=storage.directory_permissions_mode or 0o777,
+                    exist_ok=True,
+                )
+                os.replace(entry.path, sharded_path)
+
+                moved += 1
+                in_batch += 1
+                if in_batch >= options['batch_size']:
+                    self.stdout.write(f"Moved {moved} files")
+                    in_batch = 0
+                    if options['pause']:
+                        time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Done; moved {moved} files"
+        ))
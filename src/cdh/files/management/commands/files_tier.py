@@ -0,0 +1,166 @@
+import time
+from datetime import timedelta
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+from cdh.files import settings
+from cdh.files.storage import TieredFileStorage
+from cdh.files.utils import get_file_models, get_storage, storages
+
+
+class Command(BaseCommand):
+    help = "Moves files that were stored longer ago than the policy " \
+           "threshold (CDH_FILES_COLD_AFTER_DAYS) from the hot tier of a " \
+           "TieredFileStorage to the cold tier, on every storage with " \
+           "tiers (or the ones given with --storage). Files are moved in " \
+           "small batches and stay readable while they are moved, so this " \
+           "can run while the site is up. It can be interrupted and " \
+           "restarted at any time."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=float,
+            default=None,
+            help="Days; only files stored longer ago than this are moved. "
+                 "Defaults to CDH_FILES_COLD_AFTER_DAYS",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help="Number of files to move before pausing",
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help="Seconds to pause between batches, to limit the I/O load",
+        )
+        parser.add_argument(
+            '--storage',
+            action='append',
+            dest='storages',
+            metavar='NAME',
+            help="Only move the files on this storage (see "
+                 "CDH_FILES_STORAGES, 'default' for CDH_FILES_STORAGE). "
+                 "Can be given more than once",
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only report what would be moved",
+        )
+
+    def handle(self, *args, **options):
+        tiered_storages = self._get_storages(options['storages'])
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size should be at least 1")
+
+        older_than = options['older_than']
+        if older_than is None:
+            older_than = settings.COLD_AFTER_DAYS
+        cutoff = timezone.now() - timedelta(days=older_than)
+
+        moved = 0
+        for model in get_file_models():
+            moved += self._move(model, tiered_storages, cutoff, options)
+
+        message = f"Done; moved {moved} files to the cold tier"
+        if options['dry_run']:
+            message += " (dry run, nothing moved)"
+        self.stdout.write(self.style.SUCCESS(message))
+
+    def _get_storages(self, names) -> list:
+        """Returns the storages to move files on; the given ones, or all
+        storages with tiers"""
+        if names:
+            try:
+                selected = {name: get_storage(name) for name in names}
+            except ImproperlyConfigured as e:
+                raise CommandError(str(e))
+        else:
+            selected = {
+                name: storage for name, storage in storages.all().items()
+                if getattr(storage, 'tiered', False)
+            }
+            if not selected:
+                raise CommandError(
+                    "No storage has tiers; please use TieredFileStorage"
+                )
+
+        tiered_storages = []
+        for name, storage in selected.items():
+            if not getattr(storage, 'tiered', False):
+                raise CommandError(
+                    f"The storage '{name}' has no tiers; please use "
+                    f"TieredFileStorage"
+                )
+            if getattr(storage, 'content_addressed', False):
+                raise CommandError(
+                    f"The blobs of the storage '{name}' are shared, and "
+                    f"cannot be moved per file"
+                )
+            # Several names may refer to the same storage
+            if not any(storage is other for other in tiered_storages):
+                tiered_storages.append(storage)
+        return tiered_storages
+
+    def _move(self, model, tiered_storages, cutoff, options):
+        # Rows not backfilled yet have no stored_at; created_on will do
+        queryset = model.objects.filter(
+            Q(stored_at__lt=cutoff) |
+            Q(stored_at__isnull=True, created_on__lt=cutoff),
+            tier=TieredFileStorage.HOT,
+            blob__isnull=True,
+        ).order_by('pk')
+
+        moved = 0
+        last_pk = None
+        while True:
+            batch_queryset = queryset
+            if last_pk is not None:
+                batch_queryset = queryset.filter(pk__gt=last_pk)
+            batch = list(batch_queryset[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            done = []
+            for file in batch:
+                # Files on other storages are left alone
+                storage = file.get_file_wrapper(only_existing=False).storage
+                if not any(storage is other for other in tiered_storages):
+                    continue
+                if options['dry_run']:
+                    done.append(file.pk)
+                    continue
+                # The file first; if we're interrupted before the row is
+                # updated, the next run will find it in the cold tier and
+                # only update the row
+                try:
+                    storage.move(str(file.uuid), storage.COLD)
+                except FileNotFoundError:
+                    self.stderr.write(
+                        f"{model._meta.label}: {file.uuid} has no "
+                        f"contents, skipping"
+                    )
+                    continue
+                done.append(file.pk)
+
+            if done and not options['dry_run']:
+                # Only rows still in the hot tier; they might have been
+                # saved with new contents in the meantime
+                queryset.filter(pk__in=done).update(
+                    tier=TieredFileStorage.COLD
+                )
+
+            moved += len(done)
+            self.stdout.write(f"{model._meta.label}: moved {moved} files")
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        return moved
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_file_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='tier',
+            field=models.CharField(default='hot', editable=False, max_length=10),
+        ),
+    ]
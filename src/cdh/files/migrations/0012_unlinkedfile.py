@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0011_uploadsession_storage_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnlinkedFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('uuid', models.UUIDField()),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('model', 'uuid')},
+            },
+        ),
+    ]
@@ -0,0 +1,286 @@
+"""Helpers for building streaming, partial and conditional file responses.
+
+These are used by the download views; they only deal with HTTP semantics
+(RFC 7232 and RFC 7233) and leave permission checks and file lookups to the
+views themselves.
+"""
+import re
+from typing import AsyncIterator, Callable, Iterable, Iterator, List, \
+    NamedTuple, Optional
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class ByteRange(NamedTuple):
+    """An inclusive byte range, as used in HTTP Range headers"""
+    start: int
+    end: int
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start + 1
+
+    def content_range(self, size: int) -> str:
+        return f"bytes {self.start}-{self.end}/{size}"
+
+
+def parse_range_header(
+        header: Optional[str],
+        size: int,
+        max_ranges: int = 16
+) -> Optional[List[ByteRange]]:
+    """Parses a Range header for a representation of the given size.
+
+    Returns None if the header should be ignored (missing, malformed, or
+    asking for too many ranges), in which case the full file should be sent.
+    An empty list means the ranges were syntactically valid but none of them
+    can be satisfied; this should result in a 416 response.
+
+    Overlapping and adjacent ranges are coalesced, as allowed by RFC 7233.
+    """
+    if not header:
+        return None
+
+    unit, _, ranges_spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+
+    ranges = []
+    for spec in ranges_spec.split(','):
+        match = RANGE_RE.match(spec)
+        if not match:
+            return None
+
+        start, end = match.groups()
+        if start == '' and end == '':
+            return None
+
+        if start == '':
+            # Suffix range, e.g. the last 500 bytes
+            suffix_length = int(end)
+            if suffix_length == 0:
+                continue
+            start = max(size - suffix_length, 0)
+            end = size - 1
+        else:
+            start = int(start)
+            if end != '' and int(end) < start:
+                # Last byte before the first byte is a syntax error
+                return None
+            end = size - 1 if end == '' else min(int(end), size - 1)
+
+        if start >= size:
+            continue
+
+        ranges.append(ByteRange(start, end))
+
+    if len(ranges) > max_ranges:
+        return None
+
+    ranges.sort()
+    coalesced = []
+    for byte_range in ranges:
+        if coalesced and byte_range.start <= coalesced[-1].end + 1:
+            previous = coalesced.pop()
+            byte_range = ByteRange(
+                previous.start,
+                max(previous.end, byte_range.end)
+            )
+        coalesced.append(byte_range)
+
+    return coalesced
+
+
+def accepts_encoding(request, encoding: str) -> bool:
+    """Whether the Accept-Encoding header of the request allows the given
+    content coding"""
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    wildcard = False
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding == encoding:
+            return quality > 0
+        if coding == '*':
+            wildcard = quality > 0
+
+    return wildcard
+
+
+def if_range_matches(request, etag: str, last_modified: Optional[int]) -> bool:
+    """Checks the If-Range precondition. Returns True if the Range header
+    may be honoured."""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+
+    if_range = if_range.strip()
+    # Weak validators never match, as If-Range requires strong comparison
+    if if_range.startswith('"'):
+        return if_range == etag
+
+    if_range_date = parse_http_date_safe(if_range)
+    return if_range_date is not None and last_modified is not None and \
+        if_range_date == last_modified
+
+
+def _multipart_boundary(etag: str) -> str:
+    # The boundary only needs to not appear in the content; an ETag derived
+    # value keeps responses for the same file byte-identical
+    return 'cdh-files-' + re.sub(r'[^0-9a-zA-Z]', '', etag)
+
+
+def _multipart_part_header(boundary, content_type, byte_range, size) -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Range: {byte_range.content_range(size)}\r\n"
+        f"\r\n"
+    ).encode('ascii')
+
+
+def _multipart_length(boundary, content_type, ranges, size) -> int:
+    length = 0
+    for byte_range in ranges:
+        length += len(_multipart_part_header(
+            boundary, content_type, byte_range, size
+        ))
+        length += byte_range.length + 2
+    length += len(f"--{boundary}--\r\n")
+    return length
+
+
+def _iter_multipart(
+        stream: Callable[[int, int], Iterable[bytes]],
+        boundary: str,
+        content_type: str,
+        ranges: List[ByteRange],
+        size: int,
+) -> Iterator[bytes]:
+    for byte_range in ranges:
+        yield _multipart_part_header(boundary, content_type, byte_range, size)
+        yield from stream(byte_range.start, byte_range.length)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode('ascii')
+
+
+async def _aiter_multipart(
+        stream: Callable[[int, int], AsyncIterator[bytes]],
+        boundary: str,
+        content_type: str,
+        ranges: List[ByteRange],
+        size: int,
+) -> AsyncIterator[bytes]:
+    for byte_range in ranges:
+        yield _multipart_part_header(boundary, content_type, byte_range, size)
+        async for chunk in stream(byte_range.start, byte_range.length):
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode('ascii')
+
+
+def build_file_response(
+        request,
+        stream: Callable[[int, Optional[int]], Iterable[bytes]],
+        size: int,
+        content_type: str,
+        etag: str,
+        last_modified: Optional[int] = None,
+        max_ranges: int = 16,
+        asynchronous: bool = False,
+) -> HttpResponse:
+    """Builds a (partial) response for a file.
+
+    :param request: The current request
+    :param stream: A callable which, given an offset and a length, returns a
+                   lazy iterable (e.g. a generator) of chunks for that part
+                   of the file. It is never called for HEAD requests, so
+                   those never open the file.
+    :param size: The size of the file in bytes
+    :param content_type: The MIME type of the file
+    :param etag: A (quoted) strong ETag for the file
+    :param last_modified: Last modified timestamp, for If-Range evaluation
+    :param max_ranges: The maximum number of ranges we are willing to serve in
+                       one response. Requests for more ranges get the
+                       whole file instead.
+    :param asynchronous: Whether stream returns async iterables instead, for
+                         async views
+    """
+    is_head = request.method == 'HEAD'
+
+    ranges = None
+    if if_range_matches(request, etag, last_modified):
+        ranges = parse_range_header(
+            request.META.get('HTTP_RANGE'),
+            size,
+            max_ranges
+        )
+
+    if ranges is not None and len(ranges) == 0:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        return response
+
+    if not ranges:
+        status = 200
+        length = size
+        response_type = content_type
+    elif len(ranges) == 1:
+        status = 206
+        length = ranges[0].length
+        response_type = content_type
+    else:
+        status = 206
+        boundary = _multipart_boundary(etag)
+        length = _multipart_length(boundary, content_type, ranges, size)
+        response_type = f"multipart/byteranges; boundary={boundary}"
+
+    if is_head:
+        response = HttpResponse(status=status, content_type=response_type)
+    else:
+        if not ranges:
+            body = stream(0, size)
+        elif len(ranges) == 1:
+            body = stream(ranges[0].start, ranges[0].length)
+        else:
+            iter_multipart = _aiter_multipart if asynchronous else \
+                _iter_multipart
+            body = iter_multipart(
+                stream, boundary, content_type, ranges, size
+            )
+        response = StreamingHttpResponse(
+            body,
+            status=status,
+            content_type=response_type,
+        )
+
+    if status == 206 and len(ranges) == 1:
+        response['Content-Range'] = ranges[0].content_range(size)
+
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    set_validators(response, etag, last_modified)
+
+    return response
+
+
+def set_validators(
+        response: HttpResponse,
+        etag: str,
+        last_modified: Optional[int] = None,
+) -> HttpResponse:
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -6,6 +6,14 @@ STORAGE = getattr(
     'cdh.files.storage.default_storage',
 )
 
+# Additional storages by name, which FileField and TrackedFileField can
+# select with their storage argument. (e.g. {'archive': 'myapp.ArchiveStorage'})
+STORAGES = getattr(
+    settings,
+    'CDH_FILES_STORAGES',
+    {},
+)
+
 FILE_ROOT = getattr(
     settings,
     'CDH_FILES_FILE_ROOT',
@@ -32,3 +40,132 @@ TRACK_CREATED_BY = getattr(
     'CDH_FILES_TRACK_CREATED_BY',
     _tlum_loaded,
 )
+
+DELIVERY_BACKEND = getattr(
+    settings,
+    'CDH_FILES_DELIVERY_BACKEND',
+    'cdh.files.delivery.PythonDeliveryBackend',
+)
+
+# Only used by the X-Accel-Redirect and X-LiteSpeed-Location backends
+DELIVERY_URL_PREFIX = getattr(
+    settings,
+    'CDH_FILES_DELIVERY_URL_PREFIX',
+    '/protected-files/',
+)
+
+# Number of directory levels files are fanned out over, using the first
+# characters of their name. (e.g. 2 levels of width 2: ab/cd/abcdef...)
+# 0 stores all files directly in CDH_FILES_FILE_ROOT
+SHARD_DEPTH = getattr(
+    settings,
+    'CDH_FILES_SHARD_DEPTH',
+    0,
+)
+
+SHARD_WIDTH = getattr(
+    settings,
+    'CDH_FILES_SHARD_WIDTH',
+    2,
+)
+
+# Whether reads should fall back to the flat location if a file is not found
+# in its sharded location. Can be disabled once files_shard has completed.
+SHARD_FALLBACK = getattr(
+    settings,
+    'CDH_FILES_SHARD_FALLBACK',
+    True,
+)
+
+# Whether files should only be removed from the storage once the transaction
+# removing them commits. See cdh.files.deletion
+DEFER_DELETION = getattr(
+    settings,
+    'CDH_FILES_DEFER_DELETION',
+    True,
+)
+
+# Whether deferred removals should be done by a background thread, instead of
+# at the end of the transaction
+DELETION_WORKER = getattr(
+    settings,
+    'CDH_FILES_DELETION_WORKER',
+    False,
+)
+
+# Size of the chunks resumable uploads are sent in, in bytes
+CHUNKED_UPLOAD_CHUNK_SIZE = getattr(
+    settings,
+    'CDH_FILES_CHUNKED_UPLOAD_CHUNK_SIZE',
+    4 * 2 ** 20,
+)
+
+# Maximum size of a resumable upload in bytes, or None for no limit. The
+# space is reserved as soon as an upload is started.
+CHUNKED_UPLOAD_MAX_SIZE = getattr(
+    settings,
+    'CDH_FILES_CHUNKED_UPLOAD_MAX_SIZE',
+    2 * 2 ** 30,
+)
+
+# Whether users that are not logged in may start resumable uploads
+CHUNKED_UPLOAD_ALLOW_ANONYMOUS = getattr(
+    settings,
+    'CDH_FILES_CHUNKED_UPLOAD_ALLOW_ANONYMOUS',
+    False,
+)
+
+# Seconds after its last activity an unfinished (or unused) resumable upload
+# is removed
+CHUNKED_UPLOAD_EXPIRY = getattr(
+    settings,
+    'CDH_FILES_CHUNKED_UPLOAD_EXPIRY',
+    24 * 60 * 60,
+)
+
+# Master key(s) used by EncryptedFileStorage; a list allows for key rotation,
+# in which case the first key is used to encrypt new files
+ENCRYPTION_KEYS = getattr(
+    settings,
+    'CDH_FILES_ENCRYPTION_KEYS',
+    getattr(settings, 'FIELD_ENCRYPTION_KEY', None),
+)
+
+# The location TieredFileStorage moves rarely read files to
+COLD_FILE_ROOT = getattr(
+    settings,
+    'CDH_FILES_COLD_FILE_ROOT',
+    None,
+)
+
+# Days after they are stored that files_tier moves files to the cold tier
+COLD_AFTER_DAYS = getattr(
+    settings,
+    'CDH_FILES_COLD_AFTER_DAYS',
+    90,
+)
+
+# Whether downloading a file from the cold tier moves it back to the hot tier
+PROMOTE_ON_ACCESS = getattr(
+    settings,
+    'CDH_FILES_PROMOTE_ON_ACCESS',
+    False,
+)
+
+# Derivatives (e.g. thumbnails) FileWrapper.derivative() can generate, by
+# name. See cdh.files.derivatives.DerivativeSpec for the options
+DERIVATIVES = getattr(
+    settings,
+    'CDH_FILES_DERIVATIVES',
+    {
+        'thumb-256': {'width': 256, 'height': 256},
+        'preview-1024': {'width': 1024, 'height': 1024},
+    },
+)
+
+# Days after which files_scrub verifies the checksum of a file again
+SCRUB_INTERVAL_DAYS = getattr(
+    settings,
+    'CDH_FILES_SCRUB_INTERVAL_DAYS',
+    30,
+)
@@ -12,7 +12,7 @@ $(function () {
 
         el.name = jq_el.data('name');
         el.filenameEl = jq_el.find('.uil-files-filename');
-        el.noFileText = el.filenameEl.html(); // By default it's filled with this text
+        el.noFileText = el.filenameEl.text(); // By default it's filled with this text
         el.changedInput = jq_el.find('input[name="'+ el.name +'_changed"]')
         el.removeEl = jq_el.find('.uil-files-remove');
         el.selectEl = jq_el.find('.uil-files-select');
@@ -27,7 +27,7 @@ $(function () {
         el.showSelect = function (text="") {
             el.removeEl.hide();
             if (text !== "") {
-                el.filenameEl.html(text);
+                el.filenameEl.text(text);
             }
             el.selectEl.show();
         }
@@ -35,11 +35,12 @@ $(function () {
             el.selectEl.hide();
             if (filename !== "") {
                 if (url !== "") {
-                    el.filenameEl.html(
-                        '<a href="'+url+'" target="_blank">' + filename + '</a>'
+                    // Filenames come from the user; never treat them as HTML
+                    el.filenameEl.empty().append(
+                        $('<a target="_blank">').attr('href', url).text(filename)
                     );
                 } else {
-                    el.filenameEl.html(filename);
+                    el.filenameEl.text(filename);
                 }
             }
             el.removeEl.show();
@@ -51,6 +52,7 @@ $(function () {
 
         el.removeEl.click(function () {
             el.changedInput.val(1);
+            el.uploadInput.val('');
             el.showSelect(el.noFileText);
         })
 
@@ -62,8 +64,165 @@ $(function () {
             if($(this).val() != "") {
                 el.showFile(this.files[0].name)
                 el.changedInput.val(1);
+                el.uploadInput.val('');
+                if (el.canUploadChunked)
+                    el.uploadChunked(this.files[0]);
             }
         });
+
+        // Resumable uploads. The file is sent in chunks as soon as it's
+        // selected, after which only the id of the upload is submitted with
+        // the form. If anything goes wrong, the file is submitted with the
+        // form as usual.
+        el.uploadUrl = jq_el.data('upload-url');
+        el.uploadInput = jq_el.find('input[name="'+ el.name +'_upload"]');
+        el.form = jq_el.closest('form');
+        el.parallelUploads = 3;
+        el.upload = null; // Promise of the upload in progress, if any
+        el.canUploadChunked = !!(
+            el.uploadUrl && window.fetch && window.Promise && window.FormData
+        );
+
+        el.csrfToken = function () {
+            let input = el.form.find('input[name="csrfmiddlewaretoken"]');
+            if (input.length)
+                return input.val();
+            let match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+            return match ? decodeURIComponent(match[1]) : '';
+        }
+
+        el.request = function (method, url, body=null) {
+            return fetch(url, {
+                method: method,
+                body: body,
+                credentials: 'same-origin',
+                headers: {'X-CSRFToken': el.csrfToken()},
+            }).then(function (response) {
+                if (!response.ok)
+                    throw new Error(method + ' ' + url + ': ' + response.status);
+                return response.status === 204 ? null : response.json();
+            });
+        }
+
+        // Retries a request a few times, waiting twice as long every time
+        el.retry = function (request, attempts=5, delay=1000) {
+            return request().catch(function (error) {
+                if (attempts <= 1)
+                    throw error;
+                return new Promise(function (resolve) {
+                    setTimeout(resolve, delay);
+                }).then(function () {
+                    return el.retry(request, attempts - 1, delay * 2);
+                });
+            });
+        }
+
+        // Remembers sessions per file, so a reload of the page can resume
+        // where we left off
+        el.rememberSession = function (file, url=null) {
+            let key = 'cdh.files.upload:' +
+                [file.name, file.size, file.lastModified].join(':');
+            try {
+                if (url === null)
+                    return window.localStorage.getItem(key);
+                if (url === '')
+                    window.localStorage.removeItem(key);
+                else
+                    window.localStorage.setItem(key, url);
+            } catch (e) {
+                // No (usable) localStorage; we just won't be able to resume
+            }
+            return null;
+        }
+
+        el.getSession = function (file) {
+            let start = function () {
+                let data = new FormData();
+                data.append('filename', file.name);
+                data.append('size', file.size);
+                data.append('content_type', file.type);
+                return el.request('POST', el.uploadUrl, data).then(
+                    function (session) {
+                        el.rememberSession(file, session.url);
+                        return session;
+                    }
+                );
+            }
+
+            let url = el.rememberSession(file);
+            if (!url)
+                return start();
+            // The session might have expired in the meantime
+            return el.request('GET', url).catch(start);
+        }
+
+        el.uploadChunked = function (file) {
+            let upload = el.getSession(file).then(function (session) {
+                let queue = session.missing_chunks.slice();
+                let total = Math.ceil(file.size / session.chunk_size);
+                let done = total - queue.length;
+
+                let worker = function () {
+                    let index = queue.shift();
+                    if (typeof (index) === "undefined")
+                        return Promise.resolve();
+
+                    let offset = index * session.chunk_size;
+                    let chunk = file.slice(offset, offset + session.chunk_size);
+                    return el.retry(function () {
+                        return el.request(
+                            'PUT', session.url + '?offset=' + offset, chunk
+                        );
+                    }).then(function () {
+                        done++;
+                        el.filenameEl.text(
+                            file.name + ' (' + Math.floor(100 * done / total) +
+                            '%)'
+                        );
+                        return worker();
+                    });
+                }
+
+                let workers = [];
+                for (let i = 0; i < el.parallelUploads; i++)
+                    workers.push(worker());
+
+                return Promise.all(workers).then(function () {
+                    return el.retry(function () {
+                        return el.request('POST', session.url);
+                    });
+                });
+            }).then(function (session) {
+                // Another file might have been selected in the meantime
+                if (el.upload !== upload)
+                    return;
+                el.rememberSession(file, '');
+                el.uploadInput.val(session.id);
+                // The file itself no longer needs to be sent with the form
+                el.selectInput.val('');
+                el.showFile(file.name);
+            }).catch(function () {
+                if (el.upload !== upload)
+                    return;
+                el.uploadInput.val('');
+                el.showFile(file.name);
+            }).finally(function () {
+                if (el.upload === upload)
+                    el.upload = null;
+            });
+            el.upload = upload;
+        }
+
+        // Wait for uploads in progress before submitting
+        el.form.on('submit', function (event) {
+            if (el.upload === null)
+                return;
+            event.preventDefault();
+            let form = this;
+            el.upload.finally(function () {
+                form.submit();
+            });
+        });
     });
 
     cont.trigger('setup');
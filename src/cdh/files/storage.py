@@ -1,16 +1,34 @@
+import gzip
+import hashlib
 import os
+import shutil
+import tempfile
+import zlib
+from typing import NamedTuple
 
+import magic
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.move import file_move_safe
 from django.core.files.storage import FileSystemStorage
+from django.utils._os import safe_join
 from django.utils.deconstruct import deconstructible
 from django.utils.functional import LazyObject, cached_property
 
 from cdh.files import settings
+from cdh.files.archives import is_compressed
+from cdh.files.uploadhandler import SNIFF_LENGTH
 
 
 @deconstructible
 class CDHFileStorage(FileSystemStorage):
     """
     Standard filesystem storage
+
+    If CDH_FILES_SHARD_DEPTH is set, files are fanned out over
+    subdirectories based on the first characters of their name. This is
+    transparent to users of the storage, as it's done in path(). Names
+    already containing a directory are left alone.
     """
     # The combination of O_CREAT and O_EXCL makes os.open() raise OSError if
     # the file already exists before it's opened.
@@ -20,6 +38,53 @@ class CDHFileStorage(FileSystemStorage):
         # Override init to strip arguments
         super().__init__()
 
+    @cached_property
+    def shard_depth(self):
+        return settings.SHARD_DEPTH
+
+    @cached_property
+    def shard_width(self):
+        return settings.SHARD_WIDTH
+
+    @cached_property
+    def shard_fallback(self):
+        return settings.SHARD_FALLBACK
+
+    def shard_name(self, name: str) -> str:
+        """Returns the sharded name for a flat name"""
+        if not self.shard_depth or not name or '/' in name or os.sep in name:
+            return name
+
+        width = self.shard_width
+        shards = [
+            name[level * width:(level + 1) * width]
+            for level in range(self.shard_depth)
+        ]
+        return '/'.join(shards + [name])
+
+    def path(self, name):
+        sharded_name = self.shard_name(name)
+        path = super().path(sharded_name)
+
+        # Files not yet moved by files_shard still live in the flat location
+        if sharded_name != name and self.shard_fallback and \
+                not os.path.lexists(path):
+            flat_path = super().path(name)
+            if os.path.lexists(flat_path):
+                return flat_path
+
+        return path
+
+    def _open(self, name, mode='rb'):
+        try:
+            return super()._open(name, mode)
+        except FileNotFoundError:
+            # The file might have been moved to its sharded location between
+            # resolving the path and opening it; try again once
+            if self.shard_depth and self.shard_fallback:
+                return super()._open(name, mode)
+            raise
+
     @cached_property
     def base_location(self):
         return settings.FILE_ROOT
@@ -33,6 +98,385 @@ class CDHFileStorage(FileSystemStorage):
         return settings.FILE_UPLOAD_DIRECTORY_PERMISSIONS
 
 
+class StagedBlob(NamedTuple):
+    """Content written to disk and hashed, but not yet stored as a blob"""
+    path: str
+    checksum: str
+    size: int
+    # Whether the staged file is ours to remove after committing
+    temporary: bool = True
+    # Sniffed while staging, if it was
+    content_type: str = ''
+
+
+@deconstructible
+class ContentAddressedFileStorage(CDHFileStorage):
+    """Filesystem storage that stores every distinct content only once.
+
+    Files are stored as blobs, named after the SHA-256 of their contents.
+    Reference counting is done by the Blob model; FileWrapper detects this
+    storage through the ``content_addressed`` attribute and will use the
+    blob methods below instead of saving under the File's UUID.
+
+    Files stored under their UUID (e.g. before switching to this storage)
+    can still be read, and can be converted with the files_deduplicate
+    management command.
+    """
+    content_addressed = True
+    blob_directory = 'blobs'
+    hash_chunk_size = 64 * 2 ** 10
+
+    def shard_name(self, name: str) -> str:
+        # Blob names are fanned out by blob_name() already. Sharding the
+        # directory holding them would put it (and the staged blobs) in
+        # another tree than the blobs.
+        if name == self.blob_directory:
+            return name
+        return super().shard_name(name)
+
+    def blob_name(self, checksum: str) -> str:
+        """Returns the storage name of the blob for the given checksum.
+        Blobs are fanned out over two directory levels to keep directories
+        small."""
+        return '/'.join(
+            [self.blob_directory, checksum[:2], checksum[2:4], checksum]
+        )
+
+    def _staging_directory(self):
+        directory = self.path(self.blob_directory)
+        os.makedirs(
+            directory,
+            mode=self.directory_permissions_mode or 0o777,
+            exist_ok=True
+        )
+        return directory
+
+    def stage_blob(self, content) -> StagedBlob:
+        """Writes the content to a temporary file next to the blobs,
+        calculating its checksum and sniffing its MIME type in the same
+        pass."""
+        checksum = hashlib.sha256()
+        size = 0
+        head = b''
+
+        fd, path = tempfile.mkstemp(
+            prefix='.staging-',
+            dir=self._staging_directory()
+        )
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks(self.hash_chunk_size):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    if len(head) < SNIFF_LENGTH:
+                        head += chunk[:SNIFF_LENGTH - len(head)]
+                    checksum.update(chunk)
+                    size += len(chunk)
+                    file.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+
+        return StagedBlob(
+            path,
+            checksum.hexdigest(),
+            size,
+            content_type=magic.from_buffer(head, mime=True),
+        )
+
+    def stage_existing(self, name: str) -> StagedBlob:
+        """Hashes a file already in this storage, so it can be converted to
+        a blob without copying it"""
+        checksum = hashlib.sha256()
+        size = 0
+        path = self.path(name)
+
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(self.hash_chunk_size), b''):
+                checksum.update(chunk)
+                size += len(chunk)
+
+        return StagedBlob(path, checksum.hexdigest(), size, temporary=False)
+
+    def commit_blob(self, staged: StagedBlob) -> str:
+        """Stores the staged content as a blob, unless that blob is already
+        present. Should be called while holding a lock on the Blob row, so
+        it cannot be removed concurrently. Returns the name of the blob."""
+        name = self.blob_name(staged.checksum)
+        full_path = self.path(name)
+
+        if os.path.exists(full_path):
+            return name
+
+        directory = os.path.dirname(full_path)
+        os.makedirs(
+            directory,
+            mode=self.directory_permissions_mode or 0o777,
+            exist_ok=True
+        )
+
+        if staged.temporary:
+            file_move_safe(staged.path, full_path)
+        else:
+            try:
+                # A hard link keeps the original in place until it's
+                # explicitly removed, without copying the data
+                os.link(staged.path, full_path)
+            except OSError:
+                file_move_safe(
+                    staged.path,
+                    full_path,
+                    allow_overwrite=False
+                )
+
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+
+        return name
+
+    def discard_blob(self, staged: StagedBlob) -> None:
+        """Removes the staged file, if it's still present"""
+        if not staged.temporary:
+            return
+
+        try:
+            os.remove(staged.path)
+        except FileNotFoundError:
+            pass
+
+
+class GzipEncodedContent:
+    """Gzip compressed view of a file, compressing while it's being read.
+    Passing this to Storage.save() compresses straight into the storage."""
+
+    def __init__(self, content, compress_level: int = 6):
+        self.content = content
+        self.name = getattr(content, 'name', None)
+        self.compress_level = compress_level
+
+    def chunks(self, chunk_size=None):
+        # wbits 16 + MAX_WBITS makes zlib write a gzip header and trailer
+        compressor = zlib.compressobj(
+            self.compress_level,
+            zlib.DEFLATED,
+            16 + zlib.MAX_WBITS
+        )
+        for chunk in self.content.chunks(chunk_size):
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class DecodedFile(File):
+    """File decoding a file opened from the storage while it's being read.
+    Closing it also closes the underlying file."""
+
+    def __init__(self, file, encoding: str):
+        if encoding != 'gzip':
+            raise ValueError(f"Unknown content encoding '{encoding}'")
+        self.encoded_file = file
+        super().__init__(
+            gzip.GzipFile(fileobj=file, mode='rb'),
+            name=getattr(file, 'name', None),
+        )
+
+    @property
+    def size(self):
+        raise AttributeError(
+            "The decoded size is not known; use the size of the File model"
+        )
+
+    def open(self, mode=None):
+        self.encoded_file.open(mode)
+        self.file = gzip.GzipFile(fileobj=self.encoded_file, mode='rb')
+        return self
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.encoded_file.close()
+
+
+def open_decoded(file, encoding: str):
+    """Returns the given file as is if it's not encoded, or a DecodedFile
+    reading its decoded contents"""
+    if not encoding:
+        return file
+    return DecodedFile(file, encoding)
+
+
+def read_chunks(file, start=0, length=None, chunk_size=64 * 2 ** 10):
+    """Generator reading an open file in chunks of at most chunk_size,
+    starting at the offset start and stopping after length bytes (or at the
+    end of the file, if not given). Closing the file is left to the caller.
+    """
+    if start:
+        file.seek(start)
+    remaining = length
+    while remaining is None or remaining > 0:
+        to_read = chunk_size if remaining is None else \
+            min(chunk_size, remaining)
+        data = file.read(to_read)
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        yield data
+
+
+@deconstructible
+class CompressedFileStorage(CDHFileStorage):
+    """Filesystem storage compressing files with gzip at rest.
+
+    Whether a file is compressed is decided when it's saved, based on its
+    MIME type; files that are already compressed (e.g. images, archives)
+    and small files are stored as is. FileWrapper records the encoding on
+    the File, and decompresses on the fly when the file is read. The
+    download views can send the compressed file as is to clients accepting
+    gzip.
+
+    As the encoding is recorded per file, switching to or away from this
+    storage is safe; existing files stay readable.
+    """
+    compress_level = 6
+    # Below this size, the gains are eaten by the gzip overhead
+    min_compress_size = 1024
+
+    def get_encoding(self, content_type: str, size: int) -> str:
+        """Returns the content encoding a file should be stored with, or an
+        empty string if it should be stored as is"""
+        if size < self.min_compress_size or is_compressed(content_type):
+            return ''
+        return 'gzip'
+
+    def encode(self, content, encoding: str):
+        """Returns the given content encoded with the given encoding"""
+        if encoding != 'gzip':
+            raise ValueError(f"Unknown content encoding '{encoding}'")
+        return GzipEncodedContent(content, self.compress_level)
+
+
+@deconstructible
+class TieredFileStorage(CDHFileStorage):
+    """Filesystem storage with a fast 'hot' location (CDH_FILES_FILE_ROOT)
+    for new files, and a cheaper 'cold' location
+    (CDH_FILES_COLD_FILE_ROOT) for files that are rarely read anymore.
+
+    Files are saved in the hot location, and moved to the cold one by the
+    files_tier management command. Reads are transparent: path() looks in
+    the hot location first and falls back to the cold one, so it doesn't
+    matter where a file is (or whether it's being moved) when it's read. The
+    tier of every file is also recorded on its File, so files can be
+    selected by tier without touching the storage.
+    """
+    tiered = True
+    HOT = 'hot'
+    COLD = 'cold'
+    tiers = (HOT, COLD)
+
+    @cached_property
+    def cold_location(self):
+        if not settings.COLD_FILE_ROOT:
+            raise ImproperlyConfigured(
+                "TieredFileStorage needs CDH_FILES_COLD_FILE_ROOT to be set"
+            )
+        return os.path.abspath(settings.COLD_FILE_ROOT)
+
+    def tier_path(self, name: str, tier: str) -> str:
+        """Returns the path the given file has (or would have) in the given
+        tier"""
+        if tier == self.HOT:
+            return super().path(name)
+        if tier == self.COLD:
+            return safe_join(self.cold_location, self.shard_name(name))
+        raise ValueError(f"Unknown tier '{tier}'")
+
+    def tier_of(self, name: str):
+        """Returns the tier the given file is currently in, or None if it
+        doesn't exist"""
+        for tier in self.tiers:
+            if os.path.lexists(self.tier_path(name, tier)):
+                return tier
+        return None
+
+    def path(self, name):
+        # New files are saved in the hot tier
+        return self.tier_path(name, self.tier_of(name) or self.HOT)
+
+    def move(self, name: str, tier: str) -> bool:
+        """Moves the given file to the given tier. Returns whether the file
+        was moved; it's not if it's already there.
+
+        Across filesystems, the file is copied under a temporary name first,
+        so it only appears in its new location once it's complete. The file
+        is readable from its old location until it's in place.
+        """
+        destination = self.tier_path(name, tier)
+        sources = [
+            self.tier_path(name, other) for other in self.tiers
+            if other != tier
+        ]
+        source = next(
+            (path for path in sources if os.path.lexists(path)),
+            None
+        )
+        if source is None:
+            if os.path.lexists(destination):
+                return False
+            raise FileNotFoundError(f"'{name}' does not exist in any tier")
+
+        directory = os.path.dirname(destination)
+        os.makedirs(
+            directory,
+            mode=self.directory_permissions_mode or 0o777,
+            exist_ok=True,
+        )
+        try:
+            os.rename(source, destination)
+            return True
+        except OSError:
+            # Most likely another filesystem
+            pass
+
+        # Hidden, so files_gc leaves it alone
+        fd, temp_path = tempfile.mkstemp(
+            dir=directory,
+            prefix=f'.{os.path.basename(destination)}.'
+        )
+        try:
+            with open(source, 'rb') as source_file, \
+                    os.fdopen(fd, 'wb') as temp_file:
+                shutil.copyfileobj(source_file, temp_file)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            shutil.copystat(source, temp_path)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            os.replace(temp_path, destination)
+        except BaseException:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.remove(source)
+        return True
+
+    def delete(self, name):
+        if not name:
+            raise ValueError("The name must be given to delete().")
+        # Remove the file from every tier, in case a move was interrupted
+        for tier in self.tiers:
+            try:
+                os.remove(self.tier_path(name, tier))
+            except FileNotFoundError:
+                pass
+
+
 class DefaultStorage(LazyObject):
     def _setup(self):
         self._wrapped = CDHFileStorage()
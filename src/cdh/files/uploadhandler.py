@@ -0,0 +1,188 @@
+"""Upload handler writing uploaded files straight into cdh.files storage.
+
+Django normally spools uploads to memory or a temporary file, after which
+FileWrapper.save copies them into the storage and reads them back to
+determine the MIME type. StorageUploadHandler does all of that in a single
+pass: chunks are written into a new file in the storage as they arrive,
+while the checksum, size and MIME type are determined on the fly.
+FileWrapper.save then only needs to rename the file into place.
+
+To use it, add it in front of the default handlers in your settings. It
+needs to be configured globally, as middleware (e.g. CSRF) may parse the
+request body before your view runs::
+
+    FILE_UPLOAD_HANDLERS = [
+        'cdh.files.uploadhandler.StorageUploadHandler',
+        'django.core.files.uploadhandler.MemoryFileUploadHandler',
+        'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+    ]
+
+Uploaded files not saved by the end of the request are removed again.
+"""
+import hashlib
+import os
+import uuid
+
+import magic
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, \
+    StopFutureHandlers
+
+from cdh.files.utils import get_storage
+
+# The number of bytes used to determine the MIME type
+SNIFF_LENGTH = 2048
+
+
+class StoredUploadedFile(UploadedFile):
+    """An uploaded file that has already been written to the storage.
+
+    Apart from the usual UploadedFile attributes, it provides the checksum
+    (SHA-256) and MIME type calculated while it was being received.
+    """
+
+    def __init__(self, storage, stored_name, checksum, sniffed_content_type,
+                 name, content_type, size, charset,
+                 content_type_extra=None):
+        self.storage = storage
+        self.stored_name = stored_name
+        self.checksum = checksum
+        self.sniffed_content_type = sniffed_content_type
+        file = open(storage.path(stored_name), 'rb')
+        super().__init__(
+            file, name, content_type, size, charset, content_type_extra
+        )
+
+    def is_stored_in(self, storage) -> bool:
+        """Whether we can be moved into the given storage with a rename"""
+        return getattr(storage, 'location', None) == self.storage.location
+
+    def temporary_file_path(self):
+        # Lets FileSystemStorage move us into place, for the cases where
+        # FileWrapper cannot take the fast path
+        return self.storage.path(self.stored_name)
+
+    def stored(self):
+        """Called by FileWrapper once we've been moved into place"""
+        pass
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            # If we were not moved into place by now, we never will be
+            self.storage.delete(self.stored_name)
+
+
+class ChunkedUploadedFile(StoredUploadedFile):
+    """A completed resumable upload, see cdh.files.views.UploadSessionView.
+
+    Unlike uploads received by StorageUploadHandler, these outlive the
+    request; if the form turns out to be invalid, it can be submitted again
+    with the same upload. Its session is removed once the file is stored, or
+    otherwise when it expires.
+    """
+
+    def __init__(self, session, storage):
+        self.session = session
+        super().__init__(
+            storage=storage,
+            stored_name=session.stored_name,
+            checksum=session.checksum,
+            sniffed_content_type=session.sniffed_content_type,
+            name=session.original_filename,
+            content_type=session.content_type,
+            size=session.size,
+            charset=None,
+        )
+
+    def stored(self):
+        self.session.delete()
+        # Only still there if we were copied instead of moved, e.g. to be
+        # compressed
+        self.storage.delete(self.stored_name)
+
+    def close(self):
+        return self.file.close()
+
+
+class StorageUploadHandler(FileUploadHandler):
+    """Streams uploaded files directly into the cdh.files storage. See the
+    module documentation for details.
+
+    Only works with filesystem based storages; for other storages the
+    upload is left to the next handler.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.storage = get_storage()
+        self.file = None
+
+        try:
+            self.stored_name = str(uuid.uuid4())
+            path = self.storage.path(self.stored_name)
+        except (AttributeError, NotImplementedError):
+            # Not a filesystem storage; let the other handlers do their job
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # O_EXCL makes sure we never write into an existing file
+        fd = os.open(path, self.storage.OS_OPEN_FLAGS, 0o666)
+        self.file = os.fdopen(fd, 'wb')
+        self.checksum = hashlib.sha256()
+        self.head = b''
+        self.sniffed_content_type = None
+
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.file is None:
+            return raw_data
+
+        if self.sniffed_content_type is None and len(self.head) < SNIFF_LENGTH:
+            self.head += raw_data[:SNIFF_LENGTH - len(self.head)]
+            if len(self.head) >= SNIFF_LENGTH:
+                self._sniff()
+
+        self.file.write(raw_data)
+        self.checksum.update(raw_data)
+
+        return None
+
+    def _sniff(self):
+        self.sniffed_content_type = magic.from_buffer(self.head, mime=True)
+
+    def file_complete(self, file_size):
+        if self.file is None:
+            return None
+
+        self.file.close()
+        self.file = None
+
+        if self.sniffed_content_type is None:
+            self._sniff()
+
+        if self.storage.file_permissions_mode is not None:
+            os.chmod(
+                self.storage.path(self.stored_name),
+                self.storage.file_permissions_mode
+            )
+
+        return StoredUploadedFile(
+            storage=self.storage,
+            stored_name=self.stored_name,
+            checksum=self.checksum.hexdigest(),
+            sniffed_content_type=self.sniffed_content_type,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+
+    def upload_interrupted(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.storage.delete(self.stored_name)
@@ -0,0 +1,11 @@
+from django.urls import path
+
+from .views import UploadSessionCreateView, UploadSessionView
+
+app_name = 'cdh.files'
+
+urlpatterns = [
+    path('uploads/', UploadSessionCreateView.as_view(), name='upload_create'),
+    path('uploads/<uuid:uuid>/', UploadSessionView.as_view(),
+         name='upload_session'),
+]
@@ -1,14 +1,16 @@
 import importlib
+import threading
 
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import Storage
 
 import cdh.files.settings as settings # NoQA, absolute import somehow needed
 
+DEFAULT_STORAGE = 'default'
 
-def get_storage() -> Storage:
-    storage = settings.STORAGE  # type: str
-    module_name, class_name = storage.rsplit('.', 1)
+
+def _load_storage(path: str, setting: str) -> Storage:
+    module_name, class_name = path.rsplit('.', 1)
     try:
         module = importlib.import_module(module_name)
         cls = getattr(module, class_name)
@@ -20,5 +22,82 @@ def get_storage() -> Storage:
         raise ImproperlyConfigured
     except (ImportError, AttributeError, ImproperlyConfigured):
         raise ImproperlyConfigured(
-            "CDH_FILES_STORAGE doesn't seem to be set to an importable class!"
+            f"{setting} doesn't seem to be set to an importable class!"
         )
+
+
+class StorageRegistry:
+    """Process-wide cache of the configured storages. Every storage is
+    imported and instantiated once, on first use, instead of every time a
+    FileWrapper or form field needs it.
+
+    Storages are cached by their dotted path, so changing CDH_FILES_STORAGE
+    at runtime (e.g. in tests) is picked up. Settings read by the storages
+    themselves are not; call clear() after changing those.
+    """
+
+    def __init__(self):
+        self._storages = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_path(name: str = None) -> str:
+        """Returns the dotted path of the storage with the given name, as
+        configured in CDH_FILES_STORAGES. No name (or 'default') gives
+        CDH_FILES_STORAGE."""
+        if name is None or name == DEFAULT_STORAGE:
+            return settings.STORAGE
+        try:
+            return settings.STORAGES[name]
+        except KeyError:
+            raise ImproperlyConfigured(
+                f"Unknown storage '{name}'; please add it to "
+                f"CDH_FILES_STORAGES"
+            )
+
+    def get(self, name: str = None) -> Storage:
+        path = self.get_path(name)
+        try:
+            return self._storages[path]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if path not in self._storages:
+                setting = 'CDH_FILES_STORAGE' if path == settings.STORAGE \
+                    else f"CDH_FILES_STORAGES['{name}']"
+                self._storages[path] = _load_storage(path, setting)
+            return self._storages[path]
+
+    def all(self) -> dict:
+        """Returns all configured storages by name, including the default
+        storage. Names referring to the same storage share an instance."""
+        return {
+            name: self.get(name)
+            for name in [DEFAULT_STORAGE, *settings.STORAGES]
+        }
+
+    def clear(self) -> None:
+        """Forgets all storages, so they are instantiated again on next
+        use"""
+        with self._lock:
+            self._storages.clear()
+
+
+storages = StorageRegistry()
+
+
+def get_storage(name: str = None) -> Storage:
+    """Returns the storage with the given name (see CDH_FILES_STORAGES), or
+    the default storage"""
+    return storages.get(name)
+
+
+def get_file_models() -> list:
+    """Returns all concrete (sub)classes of BaseFile"""
+    from django.apps import apps
+    from cdh.files.db import BaseFile
+
+    return [
+        model for model in apps.get_models() if issubclass(model, BaseFile)
+    ]
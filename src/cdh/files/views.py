@@ -1,56 +1,336 @@
+import logging
+import os
+
+from asgiref.sync import sync_to_async
 from django.apps import apps
 from django.core.exceptions import ImproperlyConfigured
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseBadRequest, \
+    HttpResponseForbidden, HttpResponseNotFound, JsonResponse, \
+    StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils.functional import cached_property
 from django.views import generic
 from typing import Optional
 
+from cdh.files import settings
+from cdh.files.archives import stream_zip
 from cdh.files.db import TrackedFileField
-from cdh.files.db import File
+from cdh.files.db import File, UploadSession
 from cdh.files.db.wrappers import FileWrapper
+from cdh.files.delivery import DeliveryBackend, get_delivery_backend
+from cdh.files.responses import accepts_encoding, set_validators
+from cdh.files.utils import get_storage
+
+logger = logging.getLogger('cdh.files')
 
 
 class BaseFileView(generic.View):
+    """Base view for downloading files.
+
+    The file is streamed to the client in chunks, so it is never loaded into
+    memory as a whole. Single and multiple byte ranges (HTTP Range requests)
+    are supported, as are conditional requests. The validators (ETag and
+    Last-Modified) are derived from the File instance, which means that
+    conditional requests resulting in a 304 never touch the storage.
+
+    How the file is actually sent is up to the delivery backend, see
+    cdh.files.delivery. By default, CDH_FILES_DELIVERY_BACKEND is used.
+
+    Files stored compressed (see CompressedFileStorage) are sent as stored
+    to clients accepting their encoding, unless they ask for a range.
+    Everyone else gets the decompressed file.
+    """
     http_method_names = ['get', 'head', 'options']
     uuid_path_parameter = 'uuid'
     file_class = File
     always_download = False
+    chunk_size = FileWrapper.DEFAULT_CHUNK_SIZE
+    # Requests for more ranges than this will get the whole file instead
+    max_ranges = 16
+    # Dotted path to a delivery backend; None means the configured default
+    delivery_backend = None
+    # Whether files stored compressed may be sent without decompressing them
+    pass_through_encoding = True
+    # Whether files in the cold tier of a TieredFileStorage are moved back to
+    # the hot tier when downloaded; None means CDH_FILES_PROMOTE_ON_ACCESS
+    promote_on_access = None
 
     def get(self, request, **kwargs):
         if self._file_wrapper is None:
             return HttpResponseNotFound()
 
-        if self.always_download:
-            content_disposition = f"attachment; " \
-                                  f"filename={self.get_name()}"
+        etag = self.get_etag()
+        last_modified = self.get_last_modified()
+
+        response = get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=last_modified,
+        )
+        if response is not None:
+            response = set_validators(response, etag, last_modified)
         else:
-            content_disposition = f"inline; " \
-                                  f"filename={self.get_name()}"
+            self.promote()
+            response = self.get_delivery_backend().deliver(self)
 
-        with self._file_wrapper.file as file:
-            response = HttpResponse(
-                content=file,
-                content_type=self._file_wrapper.content_type,
+            if response.status_code in (200, 206):
+                response['Content-Disposition'] = \
+                    self.get_content_disposition()
+                if self.get_content_encoding():
+                    response['Content-Encoding'] = self.get_content_encoding()
+
+        # Whether we send the file encoded depends on the client
+        if self._file_wrapper.encoding:
+            patch_vary_headers(response, ('Accept-Encoding',))
+
+        return response
+
+    def promote(self) -> None:
+        """Moves the file back to the hot tier if it's in the cold tier and
+        promote_on_access is enabled. A file that's read again is likely to
+        be read more often."""
+        promote_on_access = self.promote_on_access
+        if promote_on_access is None:
+            promote_on_access = settings.PROMOTE_ON_ACCESS
+        file_wrapper = self._file_wrapper
+        if not promote_on_access or file_wrapper.tier != 'cold' or \
+                not getattr(file_wrapper.storage, 'tiered', False):
+            return
+
+        try:
+            file_wrapper.move_to_tier('hot')
+        except OSError:
+            # It's still readable where it is
+            logger.exception(
+                f"Could not promote {file_wrapper.name_on_disk} to the hot "
+                f"tier"
             )
 
-            response['Content-Disposition'] = content_disposition
-            return response
+    def get_delivery_backend(self) -> DeliveryBackend:
+        return get_delivery_backend(self.delivery_backend)
+
+    def get_content_type(self) -> str:
+        return self._file_wrapper.content_type
+
+    def get_content_disposition(self) -> str:
+        if self.always_download:
+            return f"attachment; filename={self.get_name()}"
+
+        return f"inline; filename={self.get_name()}"
 
     def get_name(self) -> str:
         return self._file_wrapper.name
 
+    def get_content_encoding(self) -> str:
+        """Returns the Content-Encoding the file is sent with, or an empty
+        string if it's sent as is (or decoded)"""
+        encoding = self._file_wrapper.encoding
+        if not encoding or not self.pass_through_encoding:
+            return ''
+        # Ranges are taken from the decoded file, as that's what clients
+        # resuming a download expect
+        if 'HTTP_RANGE' in self.request.META:
+            return ''
+        if not accepts_encoding(self.request, encoding):
+            return ''
+        return encoding
+
+    def get_etag(self) -> str:
+        """Returns a strong ETag for the current file, derived from the File
+        instance only. (modified_on is updated whenever the contents change)"""
+        file_instance = self._file_wrapper.file_instance
+        modified_on = file_instance.modified_on
+        version = int(modified_on.timestamp() * 1000000) if modified_on else 0
+        # The encoded and decoded file are different representations
+        encoding = self.get_content_encoding()
+        suffix = f"-{encoding}" if encoding else ''
+        return f'"{file_instance.uuid.hex}-{version:x}{suffix}"'
+
+    def get_last_modified(self) -> Optional[int]:
+        modified_on = self._file_wrapper.modified_on
+        if modified_on is None:
+            return None
+        return int(modified_on.timestamp())
+
+    def get_size(self) -> int:
+        """Returns the size of the file in bytes, as recorded in the database.
+        Raises FileNotFoundError if the file has no stored contents."""
+        if not self._file_wrapper:
+            raise FileNotFoundError(self._file_wrapper.name_on_disk)
+        if self.get_content_encoding():
+            return self._file_wrapper.storage.size(
+                self._file_wrapper.name_on_disk
+            )
+        return self._file_wrapper.size
+
+    def stream(self, start: int, length: int):
+        return self._file_wrapper.stream(
+            start,
+            length,
+            chunk_size=self.chunk_size,
+            decode=not self.get_content_encoding(),
+        )
+
     def get_queryset(self):
         uuid = self.kwargs.get(self.uuid_path_parameter)
         return self.file_class.objects.filter(uuid=uuid)
 
+    def get_file_wrapper(self, file) -> Optional[FileWrapper]:
+        """Returns the FileWrapper to send for the File found, or None if it
+        may not be sent"""
+        return file.get_file_wrapper()
+
     @cached_property
     def _file_wrapper(self) -> Optional[FileWrapper]:
-        qs = self.get_queryset()
-        if qs.exists():
-            return qs.get().get_file_wrapper()
+        file = self.get_queryset().first()
+        if file is not None:
+            return self.get_file_wrapper(file)
         return None
 
 
+def _next_chunk(iterator) -> Optional[bytes]:
+    # StopIteration can't be raised through sync_to_async
+    return next(iterator, None)
+
+
+class AsyncFileViewMixin:
+    """Makes a file view async, for use under ASGI. Needs Django 4.2 or
+    newer.
+
+    The File is retrieved with the async ORM, and the file is streamed by
+    reading every chunk in a thread of the default executor. No thread is
+    kept busy while the client receives the chunks, so slow downloads don't
+    use up the thread pool. The rest of the view runs as it would in a sync
+    view; offload delivery backends work as before.
+
+    Permission checks can be added by overriding aget_file_wrapper(). By
+    default it calls the (sync) get_file_wrapper(), so existing checks keep
+    working.
+    """
+
+    async def get(self, request, **kwargs):
+        file = await self.get_queryset().afirst()
+        # Saves the sync lookup the trouble
+        self._file_wrapper = None
+        if file is not None:
+            self._file_wrapper = await self.aget_file_wrapper(file)
+        return await sync_to_async(super().get)(request, **kwargs)
+
+    async def aget_file_wrapper(self, file) -> Optional[FileWrapper]:
+        """Async version of get_file_wrapper()"""
+        return await sync_to_async(self.get_file_wrapper)(file)
+
+    async def astream(self, start: int, length: int):
+        """Async version of stream(), used by the PythonDeliveryBackend
+        for async views"""
+        iterator = iter(self.stream(start, length))
+        read = sync_to_async(_next_chunk, thread_sensitive=False)
+        try:
+            while True:
+                chunk = await read(iterator)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # Closes the file if the client went away halfway
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                await sync_to_async(close, thread_sensitive=False)()
+
+
+class AsyncBaseFileView(AsyncFileViewMixin, BaseFileView):
+    """Async version of BaseFileView, see AsyncFileViewMixin"""
+    pass
+
+
+class DerivativeViewMixin:
+    """Makes a file view send a derivative of the file (e.g. a thumbnail)
+    instead of the file itself, see cdh.files.derivatives. Derivatives are
+    generated on the first request for them.
+
+    The name of the spec is taken from the URL, or from the spec attribute.
+    To be combined with BaseFileView or BaseFieldLimitedFileView, e.g.::
+
+        class ThumbnailView(DerivativeViewMixin, FileView):
+            spec = 'thumb-256'
+    """
+    spec_path_parameter = 'spec'
+    spec = None
+    # Derivatives are small, and the offload backends only know how to find
+    # the files themselves
+    delivery_backend = 'cdh.files.delivery.PythonDeliveryBackend'
+
+    def get_spec(self) -> Optional[str]:
+        return self.kwargs.get(self.spec_path_parameter, self.spec)
+
+    @cached_property
+    def _derivative(self):
+        if self._file_wrapper is None:
+            return None
+        try:
+            return self._file_wrapper.derivative(self.get_spec())
+        except ValueError:
+            return None
+
+    def get(self, request, **kwargs):
+        if self._derivative is None:
+            return HttpResponseNotFound()
+        return super().get(request, **kwargs)
+
+    def get_name(self) -> str:
+        name = os.path.splitext(super().get_name())[0]
+        spec = self._derivative.spec
+        return f"{name}-{spec.name}.{spec.extension}"
+
+    def get_content_type(self) -> str:
+        return self._derivative.content_type
+
+    def get_content_encoding(self) -> str:
+        return ''
+
+    def get_etag(self) -> str:
+        # Derivatives change when the file does
+        return super().get_etag()[:-1] + f'-{self._derivative.spec.name}"'
+
+    def get_size(self) -> int:
+        return self._derivative.size
+
+    def stream(self, start: int, length: int):
+        return self._derivative.stream(start, length, self.chunk_size)
+
+    def promote(self) -> None:
+        pass
+
+
+class BaseZipView(generic.View):
+    """Base view for downloading multiple files as one ZIP archive.
+
+    The archive is built while it's being sent, see cdh.files.archives.
+    Override get_files() to return the files to include; this is also the
+    place for permission checks.
+    """
+    http_method_names = ['get', 'options']
+    archive_name = 'files.zip'
+    chunk_size = FileWrapper.DEFAULT_CHUNK_SIZE
+
+    def get(self, request, **kwargs):
+        response = StreamingHttpResponse(
+            stream_zip(self.get_files(), chunk_size=self.chunk_size),
+            content_type='application/zip',
+        )
+        response['Content-Disposition'] = \
+            f"attachment; filename={self.get_archive_name()}"
+        return response
+
+    def get_files(self):
+        """Returns the files to include, in any form stream_zip accepts"""
+        raise NotImplementedError
+
+    def get_archive_name(self) -> str:
+        return self.archive_name
+
+
 class FieldLimitedFileViewMetaclass(type):
     """This metaclass makes sure the class attributes are all filled in.
 
@@ -65,7 +345,8 @@ class FieldLimitedFileViewMetaclass(type):
         # If we are making the base class, we stop here as the base should be
         # regarded as an abstract class
         if attrs['__module__'] == 'cdh.files.views' and \
-            attrs['__qualname__'] == 'BaseFieldLimitedFileView':
+            attrs['__qualname__'] in ('BaseFieldLimitedFileView',
+                                      'AsyncBaseFieldLimitedFileView'):
             return cls
 
         if cls.model_field is None and (
@@ -132,16 +413,210 @@ class BaseFieldLimitedFileView(
     model = None
     model_field_name = None
 
+    def get_file_wrapper(self, file) -> Optional[FileWrapper]:
+        if self.model_field in file._child_fields:
+            return file.get_file_wrapper(self.model_field)
+
+        return None
+
+
+class AsyncBaseFieldLimitedFileView(
+    AsyncFileViewMixin,
+    BaseFieldLimitedFileView,
+):
+    """Async version of BaseFieldLimitedFileView, see AsyncFileViewMixin"""
+
+    async def aget_file_wrapper(self, file) -> Optional[FileWrapper]:
+        # Only our own field matters, unlike _child_fields
+        referenced = await self.model_field.model._base_manager.filter(**{
+            self.model_field.attname: getattr(
+                file,
+                self.model_field.target_field.attname
+            )
+        }).aexists()
+        if referenced:
+            return file.get_file_wrapper(self.model_field, only_existing=False)
+
+        return None
+
+
+class UploadSessionMixin:
+    """Shared bits of the resumable upload views"""
+    # Expired sessions removed when a new upload is started, so they are
+    # cleaned up without having to run files_expire_uploads
+    expire_batch_size = 10
+
+    def get_storage_name(self) -> str:
+        """Returns the name of the storage (see CDH_FILES_STORAGES) the
+        upload is written to; empty for the default storage"""
+        return ''
+
     @cached_property
-    def _file_wrapper(self) -> Optional[FileWrapper]:
-        qs = self.get_queryset()
+    def storage(self):
+        return get_storage(self.get_storage_name() or None)
 
-        if not qs.exists():
+    def get_user(self):
+        user = getattr(self.request, 'user', None)
+        if user is None or not user.is_authenticated:
             return None
+        return user
 
-        file = qs.get()
+    def get_session_data(self, session: UploadSession) -> dict:
+        return {
+            'id': str(session.uuid),
+            'url': reverse(
+                'cdh.files:upload_session',
+                kwargs={'uuid': session.uuid}
+            ),
+            'size': session.size,
+            'chunk_size': session.chunk_size,
+            'missing_chunks': session.missing_chunks,
+            'completed': session.completed_on is not None,
+        }
 
-        if self.model_field in file._child_fields:
-            return file.get_file_wrapper(self.model_field)
 
-        return None
+class UploadSessionCreateView(UploadSessionMixin, generic.View):
+    """Starts a resumable upload. Expects the filename, size and
+    content_type of the file as POST data, and returns the session as JSON.
+    Only logged in users may start uploads, unless
+    CDH_FILES_CHUNKED_UPLOAD_ALLOW_ANONYMOUS is enabled.
+
+    The file is then sent in chunks of chunk_size bytes to the returned url,
+    see UploadSessionView.
+    """
+    http_method_names = ['post', 'options']
+
+    def get_storage_name(self) -> str:
+        # Set by the widget of a form field using another storage
+        return self.request.GET.get('storage', '')
+
+    def post(self, request, **kwargs):
+        if self.get_user() is None and \
+                not settings.CHUNKED_UPLOAD_ALLOW_ANONYMOUS:
+            return HttpResponseForbidden()
+
+        UploadSession.objects.expire(self.expire_batch_size)
+
+        try:
+            storage = self.storage
+        except ImproperlyConfigured:
+            return HttpResponseBadRequest("Invalid storage")
+
+        filename = request.POST.get('filename', '')
+        try:
+            size = int(request.POST.get('size', ''))
+        except ValueError:
+            return HttpResponseBadRequest("Invalid size")
+        if not filename or len(filename) > 255:
+            return HttpResponseBadRequest("Invalid filename")
+
+        try:
+            session = UploadSession.objects.start(
+                storage,
+                original_filename=filename,
+                size=size,
+                content_type=request.POST.get('content_type', '')[:100],
+                created_by=self.get_user(),
+                storage_name=self.get_storage_name(),
+            )
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        return JsonResponse(self.get_session_data(session), status=201)
+
+
+class UploadSessionView(UploadSessionMixin, generic.View):
+    """A resumable upload.
+
+    GET returns the session as JSON, including the chunks that still need
+    to be sent. Chunks are sent with PUT, using the offset of the chunk as
+    the 'offset' query parameter and its contents as the request body; they
+    can be sent in any order and in parallel. Once all chunks are in, POST
+    completes the upload, after which its id can be submitted with a form.
+    DELETE aborts the upload.
+    """
+    http_method_names = ['get', 'put', 'post', 'delete', 'options']
+    uuid_path_parameter = 'uuid'
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method.lower() in self.http_method_names and \
+                self.session is None:
+            return HttpResponseNotFound()
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, **kwargs):
+        return JsonResponse(self.get_session_data(self.session))
+
+    def put(self, request, **kwargs):
+        try:
+            offset = int(request.GET.get('offset', ''))
+            self.session.write_chunk(self.storage, offset, request)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        return HttpResponse(status=204)
+
+    def post(self, request, **kwargs):
+        try:
+            self.session.complete(self.storage)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        return JsonResponse(self.get_session_data(self.session))
+
+    def delete(self, request, **kwargs):
+        self.session.abort(self.storage)
+        return HttpResponse(status=204)
+
+    def get_storage_name(self) -> str:
+        return self.session.storage_name
+
+    def get_session_queryset(self, user):
+        return UploadSession.objects.filter(
+            uuid=self.kwargs.get(self.uuid_path_parameter),
+            created_by=user,
+        )
+
+    @cached_property
+    def session(self) -> Optional[UploadSession]:
+        return self.get_session_queryset(self.get_user()).first()
+
+
+class AsyncUploadSessionCreateView(UploadSessionCreateView):
+    """Async version of UploadSessionCreateView. Needs Django 4.2 or newer.
+
+    Starting an upload creates files in the storage, which is done in a
+    thread.
+    """
+
+    async def post(self, request, **kwargs):
+        return await sync_to_async(super().post)(request, **kwargs)
+
+
+class AsyncUploadSessionView(UploadSessionView):
+    """Async version of UploadSessionView. Needs Django 4.2 or newer.
+
+    The session is retrieved with the async ORM. The chunks are written to
+    the storage in a thread; ASGI servers have received the whole request
+    body by then, so no thread waits on slow clients.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method.lower() in self.http_method_names:
+            user = await sync_to_async(self.get_user)()
+            self.session = await self.get_session_queryset(user).afirst()
+            if self.session is None:
+                return HttpResponseNotFound()
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def get(self, request, **kwargs):
+        return await sync_to_async(super().get)(request, **kwargs)
+
+    async def put(self, request, **kwargs):
+        return await sync_to_async(super().put)(request, **kwargs)
+
+    async def post(self, request, **kwargs):
+        return await sync_to_async(super().post)(request, **kwargs)
+
+    async def delete(self, request, **kwargs):
+        return await sync_to_async(super().delete)(request, **kwargs)